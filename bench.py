@@ -0,0 +1,623 @@
+"""
+转发引擎的离线基准测试：用进程内的假 TelegramClient 驱动 teleporter 的转发流水线，
+不需要真实账号，也不会触发封号。
+
+用法：
+    python bench.py                        # 运行全部场景
+    python bench.py single fanout          # 只运行指定场景
+    python bench.py --mode copy --latency 0.005 --flood-rate 0.01
+    python bench.py --trace trace.jsonl --speed 10   # 按 10 倍速重放 teleporter 记录的消息流轨迹（TRACE_FILE）
+
+每个场景在独立的子进程和临时目录中运行，输出吞吐量、每条消息的 API 调用数、端到端延迟和内存峰值。
+"""
+import argparse
+import asyncio
+import bisect
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from telethon import utils
+from telethon.errors import FloodWaitError, RandomIdDuplicateError
+from telethon.helpers import TotalList
+from telethon.tl.types import (Channel, ChatPhotoEmpty, Document, Message, MessageFwdHeader, MessageMediaDocument,
+                               MessageMediaPhoto, MessageReplyHeader, PeerChannel, Photo, UpdateMessageID,
+                               UpdateNewChannelMessage, Updates)
+
+import teleporter
+
+# 模拟的聊天ID从这里开始编号（未加 -100 前缀）
+FIRST_CHAT_ID = 1000000
+# 单个场景的超时时间（秒）
+SCENARIO_TIMEOUT = 600
+
+class FakeTelegramClient:
+    """进程内模拟的 TelegramClient：消息保存在内存中，每次调用可加延迟，发送类调用可注入 FloodWait"""
+
+    def __init__(self, latency: float = 0.0, flood_rate: float = 0.0, flood_seconds: int = 1, seed: int = 0,
+                 shared: Optional["FakeTelegramClient"] = None):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.random = random.Random(seed)
+
+        # 聊天ID（带 -100 前缀）-> 消息列表和对应的ID列表（按ID升序）；多个账号共享同一份聊天数据
+        self.history: Dict[int, List[Message]] = shared.history if shared else {}
+        self.history_ids: Dict[int, List[int]] = shared.history_ids if shared else {}
+        # 聊天ID -> (是否为广播频道, 讨论组ID)
+        self.channels: Dict[int, tuple] = shared.channels if shared else {}
+        self.calls: Dict[str, int] = {}
+        self.delivered = 0
+        self.flood_waits = 0
+        # 已用过的 (聊天ID, random_id)，与服务端一样拒绝重复发送
+        self.random_ids = shared.random_ids if shared else set()
+        self.duplicates = 0
+        # 重放轨迹时按记录的时间注入的 FloodWait 秒数，依次作用于之后的发送
+        self.pending_floods: List[int] = []
+        self.next_photo_id = 1
+        self.handlers = []
+
+    # ---- 模拟数据 ----
+
+    def add_channel(self, broadcast: bool = True, linked_chat_id: Optional[int] = None) -> int:
+        chat_id = utils.get_peer_id(PeerChannel(FIRST_CHAT_ID + len(self.channels)))
+        self.channels[chat_id] = (broadcast, linked_chat_id)
+        self.history[chat_id] = []
+        self.history_ids[chat_id] = []
+        return chat_id
+
+    def make_photo(self) -> MessageMediaPhoto:
+        photo_id = self.next_photo_id
+        self.next_photo_id += 1
+        return MessageMediaPhoto(photo=Photo(
+            id=photo_id, access_hash=photo_id, file_reference=b"", date=datetime.now(timezone.utc), sizes=[], dc_id=2
+        ))
+
+    def make_document(self, size: int) -> MessageMediaDocument:
+        document_id = self.next_photo_id
+        self.next_photo_id += 1
+        return MessageMediaDocument(document=Document(
+            id=document_id, access_hash=document_id, file_reference=b"", date=datetime.now(timezone.utc),
+            mime_type="application/octet-stream", size=size, dc_id=2, attributes=[]
+        ))
+
+    def post(self, chat_id: int, text: str = "", media=None, grouped_id: Optional[int] = None,
+             reply_to=None, fwd_from=None, date: Optional[datetime] = None) -> Message:
+        ids = self.history_ids[chat_id]
+        message = Message(
+            id=ids[-1] + 1 if ids else 1,
+            peer_id=utils.get_peer(chat_id),
+            date=date or datetime.now(timezone.utc),
+            message=text,
+            media=media,
+            grouped_id=grouped_id,
+            reply_to=reply_to,
+            fwd_from=fwd_from
+        )
+        self.history[chat_id].append(message)
+        ids.append(message.id)
+        return message
+
+    def _slice(self, chat_id: int, min_id: int = 0, max_id: int = 0) -> List[Message]:
+        ids = self.history_ids.get(chat_id, [])
+        start = bisect.bisect_right(ids, min_id)
+        end = bisect.bisect_left(ids, max_id) if max_id else len(ids)
+        return self.history[chat_id][start:end]
+
+    def _find(self, chat_id: int, message_id: int) -> Optional[Message]:
+        ids = self.history_ids.get(chat_id, [])
+        index = bisect.bisect_left(ids, message_id)
+        return self.history[chat_id][index] if index < len(ids) and ids[index] == message_id else None
+
+    async def _call(self, name: str, send: bool = False):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        await asyncio.sleep(self.latency)
+        if send and self.pending_floods:
+            self.flood_waits += 1
+            raise FloodWaitError(request=None, capture=self.pending_floods.pop(0))
+        if send and self.flood_rate and self.random.random() < self.flood_rate:
+            self.flood_waits += 1
+            raise FloodWaitError(request=None, capture=self.flood_seconds)
+
+    def _deliver(self, chat_id: int, text: str, media=None, reply_to: Optional[int] = None) -> Message:
+        if media is not None:
+            # 目标中的副本有自己的文件ID，与真实发送一致
+            media = self.make_photo()
+        self.delivered += 1
+        return self.post(chat_id, text, media=media,
+                         reply_to=MessageReplyHeader(reply_to_msg_id=reply_to) if reply_to else None)
+
+    @property
+    def api_calls(self) -> int:
+        return sum(self.calls.values())
+
+    # ---- TelegramClient 接口 ----
+
+    async def get_messages(self, entity, limit=None, min_id=0, max_id=0, reverse=False, ids=None, **kwargs):
+        await self._call("get_messages")
+        if ids is not None:
+            if isinstance(ids, list):
+                return [self._find(entity, i) for i in ids]
+            return self._find(entity, ids)
+
+        messages = self._slice(entity, min_id, max_id)
+        total = len(self.history.get(entity, []))
+        if not reverse:
+            messages = messages[::-1]
+        result = TotalList(messages[:limit] if limit is not None else messages)
+        result.total = total
+        return result
+
+    async def iter_messages(self, entity, limit=None, min_id=0, max_id=0, reverse=False, **kwargs):
+        # 与真实客户端一样按每页100条请求
+        messages = self._slice(entity, min_id, max_id)
+        if not reverse:
+            messages = messages[::-1]
+        if limit is not None:
+            messages = messages[:limit]
+        for start in range(0, len(messages), 100):
+            await self._call("iter_messages")
+            for message in messages[start:start + 100]:
+                yield message
+
+    def _updates(self, chat_id: int, request, sends: list) -> Updates:
+        """按 random_id 去重后投递消息，返回与服务端相同结构的 Updates；sends 为 (random_id, 文本, 媒体, 回复ID)"""
+        if any((chat_id, random_id) in self.random_ids for random_id, *_ in sends):
+            self.duplicates += 1
+            raise RandomIdDuplicateError(request=request)
+        updates = []
+        for random_id, text, media, reply_to in sends:
+            self.random_ids.add((chat_id, random_id))
+            message = self._deliver(chat_id, text, media=media, reply_to=reply_to)
+            updates.append(UpdateMessageID(id=message.id, random_id=random_id))
+            updates.append(UpdateNewChannelMessage(message=message, pts=0, pts_count=1))
+        return Updates(updates=updates, users=[], chats=[], date=datetime.now(timezone.utc), seq=0)
+
+    async def _send(self, request):
+        name = type(request).__name__
+        await self._call(name, send=True)
+        reply_to = request.reply_to.reply_to_msg_id if getattr(request, "reply_to", None) else None
+        if name == "SendMessageRequest":
+            return self._updates(request.peer, request, [(request.random_id, request.message, None, reply_to)])
+        if name == "SendMediaRequest":
+            return self._updates(request.peer, request, [(request.random_id, request.message, request.media, reply_to)])
+        if name == "SendMultiMediaRequest":
+            return self._updates(request.peer, request, [
+                (single.random_id, single.message, single.media, reply_to) for single in request.multi_media
+            ])
+        # ForwardMessagesRequest
+        sources = [self._find(request.from_peer, i) for i in request.id]
+        return self._updates(request.to_peer, request, [
+            (random_id, m.message, m.media, None) for random_id, m in zip(request.random_id, sources) if m
+        ])
+
+    async def edit_message(self, entity, message, text=None, **kwargs):
+        await self._call("edit_message", send=True)
+
+    async def delete_messages(self, entity, message_ids, **kwargs):
+        await self._call("delete_messages", send=True)
+
+    async def get_input_entity(self, entity):
+        return entity
+
+    async def get_entity(self, entity):
+        await self._call("get_entity")
+        broadcast, _ = self.channels.get(entity, (False, None))
+        return Channel(
+            id=utils.resolve_id(entity)[0], title=str(entity), photo=ChatPhotoEmpty(), date=datetime.now(timezone.utc),
+            broadcast=broadcast, megagroup=not broadcast, access_hash=0
+        )
+
+    async def __call__(self, request):
+        name = type(request).__name__
+        if name in ("SendMessageRequest", "SendMediaRequest", "SendMultiMediaRequest", "ForwardMessagesRequest"):
+            return await self._send(request)
+        await self._call(name)
+        if name == "UploadMediaRequest":
+            return request.media
+        if name == "GetFullChannelRequest":
+            chat_id = utils.get_peer_id(request.channel)
+            _, linked_chat_id = self.channels.get(chat_id, (False, None))
+            linked = utils.resolve_id(linked_chat_id)[0] if linked_chat_id else None
+            return SimpleNamespace(full_chat=SimpleNamespace(linked_chat_id=linked))
+        if name == "GetDiscussionMessageRequest":
+            return SimpleNamespace(messages=[])
+        raise NotImplementedError(f"FakeTelegramClient 不支持 {name}")
+
+    def add_event_handler(self, callback, event=None):
+        self.handlers.append((callback, event))
+
+    def remove_event_handler(self, callback, event=None):
+        self.handlers = [(c, e) for c, e in self.handlers if c != callback]
+
+# ---- 场景 ----
+
+def add_rule(client: FakeTelegramClient, source_chat_id: int, target_chat_id: int, mode: str, backfill: bool = False) -> str:
+    rule_name = f"bench-{len(teleporter.forwarding_rules)}"
+    teleporter.put_rule(rule_name, {
+        "source_chat_id": source_chat_id,
+        "target_chat_id": target_chat_id,
+        "mode": mode
+    })
+    if backfill:
+        # 与 /add 新建的规则一样补发源的全部历史
+        teleporter.pending_backfills.add(rule_name)
+    else:
+        # 从源当前的最新消息开始转发，之后发布的消息走实时流水线
+        ids = client.history_ids[source_chat_id]
+        teleporter.last_message_ids[(source_chat_id, target_chat_id)] = ids[-1] if ids else 0
+    return rule_name
+
+def seed(client: FakeTelegramClient, chat_id: int):
+    """源里先放一条消息作为检查点起点"""
+    client.post(chat_id, "seed")
+
+def publish(client: FakeTelegramClient, chat_id: int, count: int, album_size: int = 0, media_every: int = 5) -> int:
+    """向源发布消息，返回发送到目标时预期的消息数"""
+    start = datetime.now(timezone.utc)
+    published = 0
+    grouped_id = 0
+    while published < count:
+        if album_size:
+            size = min(random.randint(2, album_size), count - published)
+            grouped_id += 1
+            for _ in range(size):
+                client.post(chat_id, "", media=client.make_photo(), grouped_id=grouped_id, date=start)
+            published += size
+        else:
+            media = client.make_photo() if media_every and published % media_every == 0 else None
+            client.post(chat_id, f"message {published}", media=media, date=start)
+            published += 1
+    return published
+
+def scenario_single(client: FakeTelegramClient, args) -> int:
+    source = client.add_channel()
+    target = client.add_channel()
+    seed(client, source)
+    add_rule(client, source, target, args.mode)
+    return publish(client, source, args.messages)
+
+def scenario_chatty(client: FakeTelegramClient, args) -> int:
+    """繁忙的聊天群：全部是短文本"""
+    source = client.add_channel(broadcast=False)
+    target = client.add_channel()
+    seed(client, source)
+    add_rule(client, source, target, args.mode)
+    return publish(client, source, args.messages, media_every=0)
+
+def scenario_rules100(client: FakeTelegramClient, args) -> int:
+    expected = 0
+    per_rule = max(args.messages // 100, 1)
+    for _ in range(100):
+        source = client.add_channel()
+        target = client.add_channel()
+        seed(client, source)
+        add_rule(client, source, target, args.mode)
+        expected += publish(client, source, per_rule)
+    return expected
+
+def scenario_albums(client: FakeTelegramClient, args) -> int:
+    source = client.add_channel()
+    target = client.add_channel()
+    seed(client, source)
+    add_rule(client, source, target, args.mode)
+    return publish(client, source, args.messages, album_size=teleporter.ALBUM_MAX_SIZE)
+
+def scenario_fanout(client: FakeTelegramClient, args) -> int:
+    source = client.add_channel()
+    seed(client, source)
+    targets = [client.add_channel() for _ in range(args.fanout)]
+    for target in targets:
+        add_rule(client, source, target, args.mode)
+    return publish(client, source, args.messages) * len(targets)
+
+def scenario_backfill(client: FakeTelegramClient, args) -> int:
+    source = client.add_channel()
+    target = client.add_channel()
+    expected = publish(client, source, args.backfill)
+    add_rule(client, source, target, args.mode, backfill=True)
+    return expected
+
+def scenario_comments(client: FakeTelegramClient, args) -> int:
+    discussion = client.add_channel(broadcast=False)
+    source = client.add_channel(linked_chat_id=discussion)
+    target = client.add_channel()
+    seed(client, source)
+    seed(client, discussion)
+    add_rule(client, source, target, args.mode)
+    teleporter.last_message_ids[(discussion, target)] = 1
+
+    # 每个帖子自动转发到讨论组，评论回复该副本
+    posts = max(args.messages // 10, 1)
+    for _ in range(posts):
+        post = client.post(source, "post")
+        copy = client.post(discussion, "post", fwd_from=MessageFwdHeader(
+            date=post.date, from_id=utils.get_peer(source), channel_post=post.id
+        ))
+        for index in range(9):
+            client.post(discussion, f"comment {index}", reply_to=MessageReplyHeader(reply_to_msg_id=copy.id))
+    return posts * 10
+
+def load_trace(path: str) -> List[dict]:
+    """读取 teleporter 记录的轨迹文件（每行一个 JSON 事件），按时间排序"""
+    events = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                events.append(json.loads(line))
+    events.sort(key=lambda event: event["t"])
+    return events
+
+def scenario_trace(client: FakeTelegramClient, args):
+    """重放记录的消息流：按轨迹中的规则建立源、讨论组和目标，再按记录的节奏（除以 --speed）发布消息和注入 FloodWait"""
+    events = load_trace(args.trace)
+    rules = {}
+    links = {}
+    for event in events:
+        if event["ev"] == "rules":
+            rules.update(event["rules"])
+        elif event["ev"] == "link":
+            links[event["source"]] = event["discussion"]
+
+    # 轨迹中的聊天ID -> 模拟的聊天ID
+    chats = {}
+    sources = {}
+    for rule in rules.values():
+        source = rule["source"]
+        if source not in chats:
+            discussion = links.get(source)
+            if discussion is not None:
+                chats[discussion] = client.add_channel(broadcast=False)
+                seed(client, chats[discussion])
+            chats[source] = client.add_channel(broadcast=discussion is not None,
+                                               linked_chat_id=chats.get(discussion))
+            seed(client, chats[source])
+        if rule.get("paused"):
+            continue
+        chats.setdefault(rule["target"], client.add_channel())
+        rule_name = add_rule(client, chats[source], chats[rule["target"]], rule.get("mode", args.mode))
+        if rule.get("digest"):
+            teleporter.forwarding_rules[rule_name]["digest"] = rule["digest"]
+        sources[source] = sources.get(source, 0) + 1
+        discussion = links.get(source)
+        if discussion is not None:
+            sources[discussion] = sources[source]
+            teleporter.last_message_ids[(chats[discussion], chats[rule["target"]])] = 1
+
+    # 预期送达数：系统消息、空消息和频道帖子在讨论组中的自动转发副本不转发
+    replayed = [
+        event for event in events
+        if event["ev"] == "flood" or event["ev"] == "msg" and event["chat"] in sources
+    ]
+    expected = sum(
+        sources[event["chat"]] for event in replayed
+        if event["ev"] == "msg" and not event.get("service") and not event.get("post")
+        and (event.get("len") or event.get("kind", "text") != "text")
+    )
+
+    async def feed():
+        if not replayed:
+            return
+        started = time.perf_counter()
+        first = replayed[0]["t"]
+        # 轨迹中的 (聊天ID, 消息ID) -> 重放时的消息ID，用于回复和评论挂帖
+        message_ids = {}
+        album = []
+        for index, event in enumerate(replayed):
+            delay = (event["t"] - first) / args.speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if event["ev"] == "flood":
+                client.pending_floods.append(max(1, round(event["seconds"] / args.speed)))
+                continue
+            if event.get("service"):
+                continue
+
+            chat = event["chat"]
+            kind = event.get("kind", "text")
+            media = None
+            if kind == "photo":
+                media = client.make_photo()
+            elif kind != "text":
+                media = client.make_document(event.get("size") or 0)
+            reply_to = None
+            if event.get("reply") and (chat, event["reply"]) in message_ids:
+                top = message_ids.get((chat, event.get("top")))
+                reply_to = MessageReplyHeader(reply_to_msg_id=message_ids[(chat, event["reply"])], reply_to_top_id=top)
+            fwd_from = None
+            if event.get("post"):
+                source = next(source for source, discussion in links.items() if discussion == chat)
+                fwd_from = MessageFwdHeader(date=datetime.now(timezone.utc), from_id=utils.get_peer(chats[source]),
+                                            channel_post=message_ids.get((source, event["post"]), 0))
+            message = client.post(chats[chat], "x" * (event.get("len") or 0), media=media,
+                                  grouped_id=event.get("group"), reply_to=reply_to, fwd_from=fwd_from)
+            message_ids[(chat, event["id"])] = message.id
+
+            # 源的新消息与真实运行一样经实时推送进入流水线（相册整体推送），讨论组的评论由评论任务轮询
+            if chat in links.values():
+                continue
+            album.append(message)
+            following = replayed[index + 1] if index + 1 < len(replayed) else {}
+            if event.get("group") and following.get("chat") == chat and following.get("group") == event["group"]:
+                continue
+            for session_name in teleporter.session_pool.clients:
+                teleporter.dispatch_pushed_messages(session_name, chats[chat], album)
+            album = []
+
+    return expected, feed()
+
+SCENARIOS = {
+    "single": scenario_single,
+    "chatty": scenario_chatty,
+    "rules100": scenario_rules100,
+    "albums": scenario_albums,
+    "fanout": scenario_fanout,
+    "backfill": scenario_backfill,
+    "comments": scenario_comments,
+    "trace": scenario_trace,
+}
+
+def configure_engine(args):
+    """基准测试默认放开限速，测的是引擎本身的开销"""
+    if not args.real_rates:
+        for name in ("ACCOUNT_SEND_RATE", "ACCOUNT_MAX_RATE", "TARGET_SEND_RATE", "TARGET_MAX_RATE"):
+            setattr(teleporter, name, 1e6)
+        teleporter.ACCOUNT_SEND_BURST = 1e6
+        teleporter.TARGET_SEND_BURST = 1e6
+    teleporter.POLL_INTERVAL = 0.05
+    teleporter.rate_limiter = teleporter.RateLimiter()
+    logging.getLogger("teleporter").setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+async def run_scenario(name: str, args) -> dict:
+    configure_engine(args)
+    client = FakeTelegramClient(latency=args.latency, flood_rate=args.flood_rate, flood_seconds=args.flood_seconds)
+    # 第一个账号作为管理账号，其余账号共享同一份聊天数据
+    clients = [client] + [
+        FakeTelegramClient(latency=args.latency, flood_rate=args.flood_rate, flood_seconds=args.flood_seconds,
+                           seed=index, shared=client)
+        for index in range(1, args.sessions)
+    ]
+    teleporter.WORKER_SESSIONS = [teleporter.ADMIN_SESSION] + [f"bench-session-{i}" for i in range(1, args.sessions)]
+    for session_name, session_client in zip(teleporter.WORKER_SESSIONS, clients):
+        teleporter.session_pool.add(session_name, session_client)
+
+    teleporter.load_checkpoints()
+    teleporter.load_backfill_jobs()
+    teleporter.load_chat_info_cache()
+    expected = SCENARIOS[name](client, args)
+    # 重放轨迹的场景在运行期间按节奏发布消息
+    feed = None
+    if isinstance(expected, tuple):
+        expected, feed = expected
+    if args.digest:
+        for rule in teleporter.forwarding_rules.values():
+            rule["digest"] = {"window": args.digest, "size": teleporter.MESSAGE_LENGTH_LIMIT}
+    setup_calls = sum(c.api_calls for c in clients)
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    teleporter.apply_rule_changes()
+    tasks = [
+        asyncio.create_task(teleporter.check_new_messages(client)),
+        asyncio.create_task(teleporter.checkpoint_flush_loop())
+    ]
+    if feed is not None:
+        tasks.append(asyncio.create_task(feed))
+    # 合并模式和重放轨迹时目标消息数与源消息数不一致，按规则统计的已送达源消息计数
+    if args.digest or feed is not None:
+        progress = lambda: sum(metrics.messages for metrics in teleporter.rule_metrics.values())
+    else:
+        progress = lambda: sum(c.delivered for c in clients)
+    try:
+        deadline = started + SCENARIO_TIMEOUT
+        while progress() < expected and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        for task in tasks:
+            task.cancel()
+        for worker in list(teleporter.rule_workers.values()):
+            worker.stop()
+        for worker in list(teleporter.source_workers.values()):
+            worker.stop()
+        for job in list(teleporter.backfill_jobs.values()):
+            job.stop()
+        teleporter.flush_checkpoints()
+
+    delivered = progress()
+    calls = sum(c.api_calls for c in clients) - setup_calls
+    latencies = sorted(sample for metrics in teleporter.rule_metrics.values() for sample in metrics.recent_latencies)
+    percentile = lambda fraction: round(latencies[min(int(len(latencies) * fraction), len(latencies) - 1)], 3) if latencies else None
+    return {
+        "scenario": name,
+        "expected": expected,
+        "delivered": delivered,
+        "seconds": round(elapsed, 3),
+        "msgs_per_sec": round(delivered / elapsed, 1) if elapsed else 0,
+        "api_calls": calls,
+        "calls_per_msg": round(calls / delivered, 3) if delivered else 0,
+        "flood_waits": sum(c.flood_waits for c in clients),
+        "latency_p50": percentile(0.5),
+        "latency_p95": percentile(0.95),
+        "peak_mem_mb": round(peak / 1024 / 1024, 1),
+        "timed_out": delivered < expected,
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="teleporter 转发引擎基准测试")
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help=f"要运行的场景（{', '.join(SCENARIOS)}），默认全部")
+    parser.add_argument("--mode", choices=[teleporter.MODE_FORWARD, teleporter.MODE_COPY], default=teleporter.MODE_FORWARD)
+    parser.add_argument("--messages", type=int, default=2000, help="实时场景的消息总数")
+    parser.add_argument("--backfill", type=int, default=100000, help="补发场景的历史消息数")
+    parser.add_argument("--fanout", type=int, default=20, help="一对多场景的目标数")
+    parser.add_argument("--latency", type=float, default=0.0, help="每次 API 调用的模拟延迟（秒）")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="发送类调用触发 FloodWait 的概率")
+    parser.add_argument("--flood-seconds", type=int, default=1, help="注入的 FloodWait 秒数")
+    parser.add_argument("--real-rates", action="store_true", help="使用 teleporter 的真实限速配置")
+    parser.add_argument("--digest", type=int, default=0, metavar="SECONDS", help="所有规则开启合并模式，窗口为该秒数")
+    parser.add_argument("--trace", metavar="FILE", help="trace 场景重放的轨迹文件（teleporter 的 TRACE_FILE）")
+    parser.add_argument("--speed", type=float, default=1.0, help="重放轨迹的倍速")
+    parser.add_argument("--sessions", type=int, default=1, help="转发账号数（配合 --real-rates 观察吞吐量随账号数的变化）")
+    parser.add_argument("--json", action="store_true", help="以 JSON 行输出结果")
+    parser.add_argument("--verbose", action="store_true", help="输出 teleporter 的日志")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"未知的场景: {', '.join(unknown)}")
+    if args.trace:
+        args.trace = os.path.abspath(args.trace)
+    elif "trace" in args.scenarios:
+        parser.error("trace 场景需要用 --trace 指定轨迹文件")
+    if args.speed <= 0:
+        parser.error("--speed 应大于 0")
+    return args
+
+def main():
+    args = parse_args()
+
+    if args.child:
+        # 子进程：在临时目录里运行一个场景，数据库和规则文件不会影响当前目录
+        os.chdir(tempfile.mkdtemp(prefix="teleporter-bench-"))
+        result = asyncio.run(run_scenario(args.scenarios[0], args))
+        print(json.dumps(result, ensure_ascii=False))
+        return
+
+    script = os.path.abspath(__file__)
+    child_args = [arg for arg in sys.argv[1:] if arg not in SCENARIOS and arg != "--json"]
+    results = []
+    # 默认运行全部合成场景；指定了轨迹文件时默认只重放轨迹
+    default = ["trace"] if args.trace else [name for name in SCENARIOS if name != "trace"]
+    for name in args.scenarios or default:
+        output = subprocess.run([sys.executable, script, name, "--child"] + child_args,
+                                check=True, stdout=subprocess.PIPE, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        if args.json:
+            print(json.dumps(result, ensure_ascii=False))
+
+    if not args.json:
+        header = (f"{'场景':<10}{'消息数':>9}{'耗时(s)':>10}{'条/秒':>10}{'调用/条':>9}{'FloodWait':>10}"
+                  f"{'延迟p50/p95(s)':>16}{'内存峰值(MB)':>14}")
+        print(header)
+        for r in results:
+            flag = "  超时" if r["timed_out"] else ""
+            latency = f"{r['latency_p50']}/{r['latency_p95']}" if r["latency_p50"] is not None else "-"
+            print(f"{r['scenario']:<10}{r['delivered']:>9}{r['seconds']:>10}{r['msgs_per_sec']:>10}"
+                  f"{r['calls_per_msg']:>9}{r['flood_waits']:>10}{latency:>16}{r['peak_mem_mb']:>14}{flag}")
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,39 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import asyncio
+import contextvars
+import copy
+import hashlib
+import heapq
+import io
 import json
 import logging
+import mmap
 import os
 import re
+import sqlite3
+import tempfile
+import threading
 import time
+from collections import OrderedDict, deque
 from datetime import datetime
 from typing import Dict, List, Optional, Set, Tuple, Union
 
-from telethon import TelegramClient, events
-from telethon.errors import FloodWaitError, ChannelPrivateError
-from telethon.tl.types import Channel, Chat, Message, PeerChannel, PeerChat, PeerUser, User, MessageMediaDocument, MessageMediaPhoto
-from telethon.tl.functions.messages import GetDiscussionMessageRequest
+from telethon import TelegramClient, events, helpers, utils
+from telethon.errors import (FloodWaitError, ChannelPrivateError, ChatForwardsRestrictedError, FileReferenceExpiredError,
+                             FileReferenceInvalidError, MediaEmptyError, MessageNotModifiedError, SlowModeWaitError, ServerError,
+                             FilePartMissingError, RandomIdDuplicateError)
+from telethon.extensions import BinaryReader
+from telethon.tl.types import Channel, Chat, Message, PeerChannel, PeerChat, PeerUser, User, MessageMediaDocument, MessageMediaPhoto, UpdateChannel
+from telethon.tl.types import MessageEmpty, UpdateNewChannelMessage, UpdateNewMessage
+from telethon.tl.types import InputReplyToMessage, InputSingleMedia, UpdateMessageID, UpdateShortSentMessage
+from telethon.tl.types import DocumentAttributeFilename, InputFile, InputFileBig, InputMediaUploadedDocument, InputMediaUploadedPhoto
+from telethon.tl.functions.channels import GetFullChannelRequest
+from telethon.tl.functions.messages import (ForwardMessagesRequest, GetDiscussionMessageRequest, SendMediaRequest,
+                                            SendMessageRequest, SendMultiMediaRequest, UploadMediaRequest)
+from telethon.tl.functions.updates import GetDifferenceRequest, GetStateRequest
+from telethon.tl.functions.upload import SaveBigFilePartRequest, SaveFilePartRequest
+from telethon.tl.types.updates import DifferenceEmpty, DifferenceSlice, DifferenceTooLong
 
 # 配置日志记录
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -28,19 +49,174 @@ PASSWORD = "20010201ghbBHG"
 # 白名单用户列表，只有这些用户可以操作机器人
 ALLOWED_USERS = {6360839781, 7696971263, 5904666183}
 
-# 数据文件路径
+# 会话：管理机器人固定使用 ADMIN_SESSION，转发规则按稳定哈希分配到 WORKER_SESSIONS 中的账号
+ADMIN_SESSION = "session_name"
+WORKER_SESSIONS = [ADMIN_SESSION]
+# 账号收到超过该秒数的 FloodWait 时，其规则暂时迁移到其他账号
+SESSION_FLOOD_MOVE_SECONDS = 120
+
+# 数据文件路径（规则和用户状态保存在数据库中，旧版的 JSON 文件在首次启动时导入）
 RULES_FILE = "rules.json"
 USER_STATE_FILE = "user_state.json"
+DB_FILE = "teleporter.db"
 
 # 用户状态数据结构
 user_states = {}
 
 # 转发规则数据结构
 forwarding_rules = {}
+# 规则索引：源/目标聊天ID -> 规则名集合，查找时不用遍历所有规则
+rules_by_source = {}
+rules_by_target = {}
+# 普通群组源（其删除事件不带聊天ID，只能逐个检查），随规则索引维护
+basic_group_sources = set()
+# 规则名 -> 编译后的过滤和改写（RuleFilter），规则变化时重新编译
+rule_filters = {}
+MEDIA_KINDS = ("text", "photo", "video", "gif", "sticker", "voice", "audio", "document", "poll", "other")
+LINK_PATTERN = re.compile(r"(?:https?://|www\.|t\.me/)\S+", re.IGNORECASE)
 
-# 最后查看的消息ID记录
+# 最后查看的消息ID记录，按 (源ID, 目标ID) 分别记录
 last_message_ids = {}
 
+# 尚未写入数据库的检查点变更（None 表示删除），定期批量提交
+dirty_checkpoints = {}
+CHECKPOINT_FLUSH_INTERVAL = 2
+
+# 已转发消息的ID对应关系：(源ID, 目标ID) -> {源消息ID: [目标消息ID]}
+# 内存中只保留最近的部分，完整索引在数据库 message_map 表中，用于评论挂帖、同步编辑和删除
+forwarded_message_ids = {}
+FORWARDED_ID_LIMIT = 5000
+dirty_message_map = []
+DELETE_BATCH_SIZE = 100
+
+# 发送日志（预写）：发送前记下 (源ID, 目标ID, 源消息ID)，送达后与检查点在同一事务内删除
+# 启动时读取的未完成发送：检查点 -> {源消息ID: random_id 盐}，以及已重新上传的媒体
+stored_send_journal = {}
+stored_journal_uploads = {}
+dirty_journal = []
+
+# 评论区：讨论组中的帖子 (讨论组ID, 消息ID) -> 源频道帖子ID
+comment_thread_posts = OrderedDict()
+COMMENT_PAGE_SIZE = 100
+COMMENT_PASS_LIMIT = 1000
+
+# 媒体缓存：源图片/文件ID -> (第一次发出后得到的 InputMedia, 时间)，按 LRU 和有效期淘汰
+media_cache = OrderedDict()
+MEDIA_CACHE_SIZE = 2000
+MEDIA_CACHE_TTL = 2 * 3600
+
+# 受保护来源的媒体中转：分块大小、并行分块数、最多预下载的文件数、临时文件目录
+TRANSFER_PART_SIZE = 512 * 1024
+TRANSFER_WORKERS = 4
+TRANSFER_PREFETCH_LIMIT = 4
+TRANSFER_BIG_FILE_SIZE = 10 * 1024 * 1024
+TRANSFER_SPOOL_DIR = None
+# 直接引用媒体发送失败时改为下载后重新上传（发送日志中保存的上传文件过期时为 FilePartMissing）
+DIRECT_MEDIA_ERRORS = (ChatForwardsRestrictedError, FileReferenceExpiredError, FileReferenceInvalidError, MediaEmptyError,
+                       FilePartMissingError)
+
+# 聊天信息缓存（是否为广播频道、链接的讨论组、是否禁止转发），持久化到数据库
+chat_info_cache = {}
+ENTITY_CACHE_TTL = 6 * 3600
+# 讨论组ID -> 链接它的频道ID，随聊天信息缓存维护，编辑和删除事件按它直接查找
+linked_channels = {}
+
+# 状态数据库连接（后台线程写入时用锁串行化）
+db_connection = None
+db_lock = threading.Lock()
+
+# 评论区轮询间隔；实时推送正常时主消息只做慢速兜底扫描
+POLL_INTERVAL = 20
+SWEEP_INTERVAL = 300
+
+# 每次拉取的消息数
+FETCH_PAGE_SIZE = 50
+
+# 相册：最多10条；末尾不完整的相册最多等待的秒数
+ALBUM_MAX_SIZE = 10
+ALBUM_HOLD_SECONDS = 3
+
+# 流水线队列上限：下游积压时上游等待，内存保持有界
+MESSAGE_QUEUE_SIZE = 4
+SEND_QUEUE_SIZE = 100
+PUSH_BUFFER_SIZE = 500
+
+# 每个源群组/频道的拉取流水线，以及每条规则的发送流水线
+source_workers = {}
+rule_workers = {}
+
+# 停机或断线后的追赶：定期保存各账号的更新状态，重连后用 GetDifference 取回错过的消息
+UPDATE_STATE_SAVE_INTERVAL = 60
+CONNECTION_CHECK_INTERVAL = 5
+# 正在追赶的账号：追赶完成前该账号的源暂停拉取，实时推送先缓存
+catch_up_gates: Dict[str, asyncio.Event] = {}
+
+# 历史消息补发：运行中的任务（按规则名），以及启动时从数据库读取、尚未恢复的任务
+BACKFILL_PAGE_SIZE = 100
+backfill_jobs = {}
+stored_backfill_jobs = {}
+# 通过 /add 新建、等待补发全部历史的规则名（迁移或导入的规则只从最新消息开始转发）
+pending_backfills = set()
+
+# 发送限速（条/秒）：账号整体和每个目标各一个令牌桶，按 FloodWait 自动调整
+ACCOUNT_SEND_RATE = 1.0
+ACCOUNT_SEND_BURST = 5
+ACCOUNT_MAX_RATE = 5.0
+TARGET_SEND_RATE = 0.5
+TARGET_SEND_BURST = 3
+TARGET_MAX_RATE = 1.0
+MIN_SEND_RATE = 0.05
+RATE_INCREASE_INTERVAL = 20
+RATE_INCREASE_FACTOR = 1.1
+# 低于限流时的实际速率时按此倍数快速恢复；每次限流对该速率估计最多下调的比例
+RATE_RECOVERY_FACTOR = 2.0
+RATE_LIMIT_DECAY = 0.9
+MAX_SEND_RETRIES = 5
+
+# 转发模式：forward 为服务端原生转发（隐藏来源，受保护的源自动回退为复制），copy 为逐条复制发送
+MODE_FORWARD = "forward"
+MODE_COPY = "copy"
+FORWARD_BATCH_SIZE = 100
+
+# 复制发送时的长度上限（按 UTF-16 计），超长的正文和媒体标题自动拆成多条
+MESSAGE_LENGTH_LIMIT = 4096
+CAPTION_LENGTH_LIMIT = 1024
+COMMENT_PREFIX = "💬 评论: "
+
+# 合并模式（按规则开启）：时间窗口内连续的短文本消息合并为一条发送，每条带时间和发送者前缀
+DIGEST_TEXT_LIMIT = 500
+DIGEST_MIN_SIZE = 200
+DIGEST_SEPARATOR = "\n"
+
+# 发送优先级：数值越小越优先
+PRIORITY_LIVE = 0
+PRIORITY_COMMENT = 1
+PRIORITY_BACKFILL = 2
+
+# 监控指标：按规则统计，通过本机的 Prometheus 文本端点和 /stats 命令查看
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464
+LATENCY_BUCKETS = (1, 5, 15, 60, 300, 1800, 3600)
+LATENCY_SAMPLE_SIZE = 500
+# /stats 只列出延迟最高的若干条规则
+STATS_TOP_RULES = 20
+rule_metrics = {}
+source_fetch_calls = {}
+sweep_count = 0
+# 消息流轨迹：引擎看到的消息（ID、相册、媒体类型和大小、时间）以及送达、错误和 FloodWait，
+# 以 JSON 行追加到该文件，用 bench.py --trace 离线重放；None 为不记录
+TRACE_FILE = None
+trace_recorder = None
+# 当前任务正在处理的规则，发送路径上的统计按它归属
+current_rule = contextvars.ContextVar("current_rule", default=None)
+# 当前任务使用的账号，发送时使用该账号的限速器
+current_session = contextvars.ContextVar("current_session", default=ADMIN_SESSION)
+# random_id 的盐：实时转发为空，补发任务各用自己的盐，重新补发已转发过的消息时不会被服务端当成重复
+send_salt = contextvars.ContextVar("send_salt", default="")
+
+# 各账号已注册的源群组/频道实时消息处理器
+source_event_handlers = {}
+
 class BotState:
     IDLE = 0
     WAITING_SOURCE = 1
@@ -50,76 +226,507 @@ class UserState:
     def __init__(self):
         self.state = BotState.IDLE
         self.temp_rule_name = ""
+        self.temp_filters = None
         self.source_chat_id = None
         self.target_chat_id = None
 
-def save_rules():
-    """保存转发规则到文件"""
-    with open(RULES_FILE, 'w', encoding='utf-8') as f:
-        json.dump(forwarding_rules, f, ensure_ascii=False, indent=2)
-    logger.info(f"规则已保存到 {RULES_FILE}")
+def index_rule(rule_name: str, rule: dict):
+    rules_by_source.setdefault(rule["source_chat_id"], set()).add(rule_name)
+    rules_by_target.setdefault(rule["target_chat_id"], set()).add(rule_name)
+    if rule["source_chat_id"] > -1000000000000:
+        basic_group_sources.add(rule["source_chat_id"])
+
+def unindex_rule(rule_name: str, rule: dict):
+    for index, chat_id in ((rules_by_source, rule["source_chat_id"]), (rules_by_target, rule["target_chat_id"])):
+        names = index.get(chat_id)
+        if names:
+            names.discard(rule_name)
+            if not names:
+                del index[chat_id]
+    if rule["source_chat_id"] not in rules_by_source:
+        basic_group_sources.discard(rule["source_chat_id"])
+
+def put_rule(rule_name: str, rule: dict):
+    """添加或替换规则并更新索引（持久化由 save_store 完成）"""
+    old_rule = forwarding_rules.get(rule_name)
+    if old_rule:
+        unindex_rule(rule_name, old_rule)
+    forwarding_rules[rule_name] = rule
+    index_rule(rule_name, rule)
+    if rule.get("filters"):
+        rule_filters[rule_name] = RuleFilter(rule["filters"])
+    else:
+        rule_filters.pop(rule_name, None)
+
+def pop_rule(rule_name: str) -> Optional[dict]:
+    """移除规则并更新索引（持久化由 save_store 完成）"""
+    rule = forwarding_rules.pop(rule_name, None)
+    if rule:
+        unindex_rule(rule_name, rule)
+    rule_filters.pop(rule_name, None)
+    return rule
+
+def find_rules(source_chat_id: Optional[int] = None, target_chat_id: Optional[int] = None) -> List[str]:
+    """按源和/或目标查找规则名"""
+    names = None
+    if source_chat_id is not None:
+        names = rules_by_source.get(source_chat_id, set())
+    if target_chat_id is not None:
+        by_target = rules_by_target.get(target_chat_id, set())
+        names = by_target if names is None else names & by_target
+    return sorted(names or ())
+
+def _write_store(rule_rows: List[Tuple[str, Optional[tuple]]], state_rows: List[Tuple[int, Optional[tuple]]]):
+    """在一个事务内写入变化的规则和用户状态（值为 None 表示删除）"""
+    conn = open_database()
+    with db_lock, conn:
+        for rule_name, row in rule_rows:
+            if row is None:
+                conn.execute("DELETE FROM rules WHERE name = ?", (rule_name,))
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO rules (name, source_chat_id, target_chat_id, data) VALUES (?, ?, ?, ?)",
+                    (rule_name,) + row
+                )
+        for user_id, row in state_rows:
+            if row is None:
+                conn.execute("DELETE FROM user_states WHERE user_id = ?", (user_id,))
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO user_states "
+                    "(user_id, state, temp_rule_name, source_chat_id, target_chat_id, temp_filters) VALUES (?, ?, ?, ?, ?, ?)",
+                    (user_id,) + row
+                )
+
+def _rule_row(rule_name: str) -> Optional[tuple]:
+    rule = forwarding_rules.get(rule_name)
+    if rule is None:
+        return None
+    return (rule["source_chat_id"], rule["target_chat_id"], json.dumps(rule, ensure_ascii=False))
+
+def _user_state_row(user_id: int) -> Optional[tuple]:
+    state = user_states.get(user_id)
+    if state is None:
+        return None
+    temp_filters = json.dumps(state.temp_filters, ensure_ascii=False) if state.temp_filters else None
+    return (state.state, state.temp_rule_name, state.source_chat_id, state.target_chat_id, temp_filters)
+
+async def save_store(rule_names: List[str] = (), user_ids: List[int] = ()):
+    """保存指定规则和用户状态的当前值：逐条原子更新，在线程中写入，不阻塞事件循环"""
+    rule_rows = [(rule_name, _rule_row(rule_name)) for rule_name in rule_names]
+    state_rows = [(user_id, _user_state_row(user_id)) for user_id in user_ids]
+    await asyncio.to_thread(_write_store, rule_rows, state_rows)
+
+def _import_json_file(path: str) -> Optional[dict]:
+    """读取旧版的 JSON 文件，读取后改名，避免下次启动重复导入"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        os.replace(path, path + ".imported")
+        return data
+    except Exception as e:
+        logger.error(f"导入 {path} 失败: {e}")
+        return None
 
 def load_rules():
-    """从文件加载转发规则"""
-    global forwarding_rules, last_message_ids
-    if os.path.exists(RULES_FILE):
-        try:
-            with open(RULES_FILE, 'r', encoding='utf-8') as f:
-                forwarding_rules = json.load(f)
-            
-            # 初始化最后查看的消息ID
-            for rule_name, rule in forwarding_rules.items():
-                source_chat_id = rule["source_chat_id"]
-                if source_chat_id not in last_message_ids:
-                    last_message_ids[source_chat_id] = 0
-            
-            logger.info(f"已从 {RULES_FILE} 加载 {len(forwarding_rules)} 条规则")
-        except Exception as e:
-            logger.error(f"加载规则失败: {e}")
-            forwarding_rules = {}
+    """从数据库加载转发规则（首次运行时导入旧的 rules.json）"""
+    global forwarding_rules
+    conn = open_database()
+    rows = conn.execute("SELECT name, data FROM rules").fetchall()
+    
+    forwarding_rules = {}
+    rules_by_source.clear()
+    basic_group_sources.clear()
+    rules_by_target.clear()
+    rule_filters.clear()
+    if rows:
+        for rule_name, data in rows:
+            put_rule(rule_name, json.loads(data))
     else:
-        logger.info("规则文件不存在，创建新的规则集")
-        forwarding_rules = {}
-
-def save_user_states():
-    """保存用户状态到文件"""
-    states_to_save = {}
-    for user_id, state in user_states.items():
-        states_to_save[str(user_id)] = {
-            "state": state.state,
-            "temp_rule_name": state.temp_rule_name,
-            "source_chat_id": state.source_chat_id,
-            "target_chat_id": state.target_chat_id
-        }
-    
-    with open(USER_STATE_FILE, 'w', encoding='utf-8') as f:
-        json.dump(states_to_save, f, ensure_ascii=False, indent=2)
-    logger.info(f"用户状态已保存到 {USER_STATE_FILE}")
+        imported = _import_json_file(RULES_FILE)
+        if imported:
+            for rule_name, rule in imported.items():
+                put_rule(rule_name, rule)
+            _write_store([(rule_name, _rule_row(rule_name)) for rule_name in forwarding_rules], [])
+            logger.info(f"已从 {RULES_FILE} 导入 {len(forwarding_rules)} 条规则")
+    
+    # 初始化最后查看的消息ID
+    for rule in forwarding_rules.values():
+        checkpoint = (rule["source_chat_id"], rule["target_chat_id"])
+        if checkpoint not in last_message_ids:
+            last_message_ids[checkpoint] = 0
+    
+    logger.info(f"已加载 {len(forwarding_rules)} 条规则")
 
 def load_user_states():
-    """从文件加载用户状态"""
+    """从数据库加载用户状态（首次运行时导入旧的 user_state.json）"""
     global user_states
-    if os.path.exists(USER_STATE_FILE):
+    conn = open_database()
+    rows = conn.execute(
+        "SELECT user_id, state, temp_rule_name, source_chat_id, target_chat_id, temp_filters FROM user_states"
+    ).fetchall()
+    
+    if not rows:
+        imported = _import_json_file(USER_STATE_FILE)
+        if imported:
+            rows = [(int(user_id), s["state"], s["temp_rule_name"], s["source_chat_id"], s["target_chat_id"], None)
+                    for user_id, s in imported.items()]
+            _write_store([], [(row[0], row[1:]) for row in rows])
+            logger.info(f"已从 {USER_STATE_FILE} 导入 {len(rows)} 个用户状态")
+    
+    user_states = {}
+    for user_id, state_value, temp_rule_name, source_chat_id, target_chat_id, temp_filters in rows:
+        state = UserState()
+        state.state = state_value
+        state.temp_rule_name = temp_rule_name
+        state.temp_filters = json.loads(temp_filters) if temp_filters else None
+        state.source_chat_id = source_chat_id
+        state.target_chat_id = target_chat_id
+        user_states[user_id] = state
+    
+    logger.info(f"已加载 {len(user_states)} 个用户状态")
+
+def get_source_chat_ids() -> List[int]:
+    """获取所有规则中的源群组/频道ID"""
+    return sorted(rules_by_source)
+
+def open_database() -> sqlite3.Connection:
+    """打开状态数据库（WAL 模式，崩溃后已提交的数据不会丢失）"""
+    global db_connection
+    with db_lock:
+        if db_connection is not None:
+            return db_connection
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            "source_chat_id INTEGER NOT NULL, "
+            "target_chat_id INTEGER NOT NULL, "
+            "last_message_id INTEGER NOT NULL, "
+            "updated_at REAL NOT NULL, "
+            "PRIMARY KEY (source_chat_id, target_chat_id))"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS backfill_jobs ("
+            "source_chat_id INTEGER NOT NULL, "
+            "target_chat_id INTEGER NOT NULL, "
+            "end_id INTEGER NOT NULL, "
+            "cursor INTEGER NOT NULL, "
+            "total INTEGER NOT NULL, "
+            "done INTEGER NOT NULL, "
+            "updated_at REAL NOT NULL, "
+            "salt TEXT NOT NULL DEFAULT '', "
+            "PRIMARY KEY (source_chat_id, target_chat_id))"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS message_map ("
+            "source_chat_id INTEGER NOT NULL, "
+            "target_chat_id INTEGER NOT NULL, "
+            "source_msg_id INTEGER NOT NULL, "
+            "target_msg_id INTEGER NOT NULL, "
+            "PRIMARY KEY (source_chat_id, target_chat_id, source_msg_id, target_msg_id)) WITHOUT ROWID"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS rules ("
+            "name TEXT PRIMARY KEY, "
+            "source_chat_id INTEGER NOT NULL, "
+            "target_chat_id INTEGER NOT NULL, "
+            "data TEXT NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_states ("
+            "user_id INTEGER PRIMARY KEY, "
+            "state INTEGER NOT NULL, "
+            "temp_rule_name TEXT NOT NULL, "
+            "source_chat_id INTEGER, "
+            "target_chat_id INTEGER, "
+            "temp_filters TEXT)"
+        )
+        # 旧版数据库的 user_states 没有 temp_filters 列
+        if "temp_filters" not in {row[1] for row in conn.execute("PRAGMA table_info(user_states)")}:
+            conn.execute("ALTER TABLE user_states ADD COLUMN temp_filters TEXT")
+        # 旧版数据库的 backfill_jobs 没有 salt 列
+        if "salt" not in {row[1] for row in conn.execute("PRAGMA table_info(backfill_jobs)")}:
+            conn.execute("ALTER TABLE backfill_jobs ADD COLUMN salt TEXT NOT NULL DEFAULT ''")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS chat_info ("
+            "chat_id INTEGER PRIMARY KEY, "
+            "broadcast INTEGER NOT NULL, "
+            "linked_chat_id INTEGER, "
+            "noforwards INTEGER NOT NULL, "
+            "fetched_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS update_state ("
+            "session_name TEXT PRIMARY KEY, "
+            "pts INTEGER NOT NULL, "
+            "qts INTEGER NOT NULL, "
+            "date INTEGER NOT NULL, "
+            "seen TEXT NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS send_journal ("
+            "source_chat_id INTEGER NOT NULL, "
+            "target_chat_id INTEGER NOT NULL, "
+            "source_msg_id INTEGER NOT NULL, "
+            "salt TEXT NOT NULL, "
+            "upload BLOB, "
+            "PRIMARY KEY (source_chat_id, target_chat_id, source_msg_id)) WITHOUT ROWID"
+        )
+        conn.commit()
+        db_connection = conn
+    return db_connection
+
+def load_checkpoints():
+    """从数据库加载各 (源, 目标) 的检查点"""
+    conn = open_database()
+    rows = conn.execute("SELECT source_chat_id, target_chat_id, last_message_id FROM checkpoints").fetchall()
+    for source_chat_id, target_chat_id, last_message_id in rows:
+        last_message_ids[(source_chat_id, target_chat_id)] = last_message_id
+    logger.info(f"已从 {DB_FILE} 加载 {len(rows)} 个检查点")
+
+def advance_checkpoint(checkpoint: Tuple[int, int], message_id: int):
+    """推进检查点，写入会在后台批量提交"""
+    if message_id > last_message_ids.get(checkpoint, 0):
+        last_message_ids[checkpoint] = message_id
+        dirty_checkpoints[checkpoint] = message_id
+
+def forget_checkpoint(checkpoint: Tuple[int, int]):
+    """删除检查点"""
+    last_message_ids.pop(checkpoint, None)
+    dirty_checkpoints[checkpoint] = None
+
+def _write_checkpoints(changes: Dict[Tuple[int, int], Optional[int]], map_rows: List[Tuple[int, int, int, int]],
+                       journal_rows: List[Tuple[int, int, int]] = ()):
+    conn = open_database()
+    now = time.time()
+    with db_lock, conn:
+        conn.executemany("INSERT OR IGNORE INTO message_map VALUES (?, ?, ?, ?)", map_rows)
+        conn.executemany(
+            "DELETE FROM send_journal WHERE source_chat_id = ? AND target_chat_id = ? AND source_msg_id = ?", journal_rows
+        )
+        conn.executemany(
+            "INSERT INTO checkpoints (source_chat_id, target_chat_id, last_message_id, updated_at) "
+            "VALUES (?, ?, ?, ?) ON CONFLICT (source_chat_id, target_chat_id) "
+            "DO UPDATE SET last_message_id = excluded.last_message_id, updated_at = excluded.updated_at",
+            [(source, target, message_id, now) for (source, target), message_id in changes.items() if message_id is not None]
+        )
+        deleted = [checkpoint for checkpoint, message_id in changes.items() if message_id is None]
+        conn.executemany("DELETE FROM checkpoints WHERE source_chat_id = ? AND target_chat_id = ?", deleted)
+        conn.executemany("DELETE FROM message_map WHERE source_chat_id = ? AND target_chat_id = ?", deleted)
+        conn.executemany("DELETE FROM send_journal WHERE source_chat_id = ? AND target_chat_id = ?", deleted)
+
+def load_send_journal():
+    """读取上次退出时未完成的发送"""
+    conn = open_database()
+    rows = conn.execute("SELECT source_chat_id, target_chat_id, source_msg_id, salt, upload FROM send_journal").fetchall()
+    for source_chat_id, target_chat_id, source_msg_id, salt, upload in rows:
+        stored_send_journal.setdefault((source_chat_id, target_chat_id), {})[source_msg_id] = salt
+        if upload:
+            stored_journal_uploads[(source_chat_id, target_chat_id, source_msg_id)] = upload
+    if rows:
+        logger.info(f"发送日志中有 {len(rows)} 条未完成的发送，将沿用原 random_id 重放")
+
+def _write_journal(checkpoint: Tuple[int, int], message_ids: List[int], salt: str):
+    conn = open_database()
+    with db_lock, conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO send_journal (source_chat_id, target_chat_id, source_msg_id, salt) VALUES (?, ?, ?, ?)",
+            [(checkpoint[0], checkpoint[1], message_id, salt) for message_id in message_ids]
+        )
+
+def _write_journal_uploads(rows: List[Tuple[bytes, int, int, int]]):
+    conn = open_database()
+    with db_lock, conn:
+        conn.executemany(
+            "UPDATE send_journal SET upload = ? WHERE source_chat_id = ? AND target_chat_id = ? AND source_msg_id = ?", rows
+        )
+
+async def journal_sends(checkpoint: Tuple[int, int], message_ids: List[int]):
+    """发送前写入发送日志（落盘后才发送）"""
+    await asyncio.to_thread(_write_journal, checkpoint, message_ids, send_salt.get())
+
+def journal_done(checkpoint: Tuple[int, int], message_ids: List[int]):
+    """发送结束（成功或已记录失败），日志条目随下一次检查点提交删除"""
+    dirty_journal.extend((checkpoint[0], checkpoint[1], message_id) for message_id in message_ids)
+
+async def journal_uploads(target_chat_id: int, source_messages: List[Message], files: list):
+    """记下重新上传得到的文件，重放时不必再次下载上传"""
+    rows = []
+    for message, media in zip(source_messages, files):
+        if isinstance(media, (InputMediaUploadedPhoto, InputMediaUploadedDocument)):
+            rows.append((bytes(media), utils.get_peer_id(message.peer_id), target_chat_id, message.id))
+    if rows:
+        await asyncio.to_thread(_write_journal_uploads, rows)
+
+def take_journal_uploads(target_chat_id: int, source_messages: List[Message]) -> Optional[list]:
+    """取出发送日志中这组媒体已上传的文件（必须全部都有）"""
+    keys = [(utils.get_peer_id(m.peer_id), target_chat_id, m.id) for m in source_messages]
+    if not stored_journal_uploads or not all(key in stored_journal_uploads for key in keys):
+        return None
+    return [BinaryReader(stored_journal_uploads.pop(key)).tgread_object() for key in keys]
+
+def load_backfill_jobs():
+    """从数据库加载未完成的补发任务"""
+    conn = open_database()
+    rows = conn.execute("SELECT source_chat_id, target_chat_id, end_id, cursor, total, done, salt FROM backfill_jobs").fetchall()
+    for source_chat_id, target_chat_id, end_id, cursor, total, done, salt in rows:
+        # 旧版任务没有保存盐，沿用当时按 end_id 生成的盐
+        stored_backfill_jobs[(source_chat_id, target_chat_id)] = (end_id, cursor, total, done, salt or f"backfill:{end_id}")
+    if rows:
+        logger.info(f"已从 {DB_FILE} 加载 {len(rows)} 个未完成的补发任务")
+
+def save_backfill_job(checkpoint: Tuple[int, int], end_id: int, cursor: int, total: int, done: int, salt: str):
+    """保存补发进度"""
+    conn = open_database()
+    with db_lock, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO backfill_jobs (source_chat_id, target_chat_id, end_id, cursor, total, done, updated_at, salt) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (checkpoint[0], checkpoint[1], end_id, cursor, total, done, time.time(), salt)
+        )
+
+def delete_backfill_job(checkpoint: Tuple[int, int]):
+    """删除补发任务"""
+    conn = open_database()
+    with db_lock, conn:
+        conn.execute("DELETE FROM backfill_jobs WHERE source_chat_id = ? AND target_chat_id = ?", checkpoint)
+
+def load_update_state(session_name: str) -> Optional[Tuple[int, int, int, Dict[int, int]]]:
+    """读取账号保存的更新状态 (pts, qts, date, 各源当时已见到的最大消息ID)"""
+    conn = open_database()
+    with db_lock:
+        row = conn.execute("SELECT pts, qts, date, seen FROM update_state WHERE session_name = ?", (session_name,)).fetchone()
+    if row is None:
+        return None
+    pts, qts, date, seen = row
+    return pts, qts, date, {int(chat_id): message_id for chat_id, message_id in json.loads(seen).items()}
+
+def save_update_state(session_name: str, pts: int, qts: int, date: int, seen: Dict[int, int]):
+    """保存账号的更新状态"""
+    conn = open_database()
+    with db_lock, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO update_state (session_name, pts, qts, date, seen) VALUES (?, ?, ?, ?, ?)",
+            (session_name, pts, qts, date, json.dumps(seen))
+        )
+
+def load_chat_info_cache():
+    """从数据库加载聊天信息缓存"""
+    conn = open_database()
+    rows = conn.execute("SELECT chat_id, broadcast, linked_chat_id, noforwards, fetched_at FROM chat_info").fetchall()
+    for chat_id, broadcast, linked_chat_id, noforwards, fetched_at in rows:
+        cache_chat_info(chat_id, {
+            "broadcast": bool(broadcast),
+            "linked_chat_id": linked_chat_id,
+            "noforwards": bool(noforwards),
+            "fetched_at": fetched_at
+        })
+    logger.info(f"已从 {DB_FILE} 加载 {len(rows)} 条聊天信息缓存")
+
+def cache_chat_info(chat_id: int, info: dict):
+    """写入聊天信息缓存并更新讨论组索引"""
+    old_info = chat_info_cache.get(chat_id)
+    if old_info and old_info["linked_chat_id"] and linked_channels.get(old_info["linked_chat_id"]) == chat_id:
+        del linked_channels[old_info["linked_chat_id"]]
+    chat_info_cache[chat_id] = info
+    if info["linked_chat_id"]:
+        linked_channels[info["linked_chat_id"]] = chat_id
+
+def _write_chat_info(chat_id: int, info: Optional[dict]):
+    conn = open_database()
+    with db_lock, conn:
+        if info is None:
+            conn.execute("DELETE FROM chat_info WHERE chat_id = ?", (chat_id,))
+        else:
+            conn.execute(
+                "INSERT OR REPLACE INTO chat_info (chat_id, broadcast, linked_chat_id, noforwards, fetched_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (chat_id, info["broadcast"], info["linked_chat_id"], info["noforwards"], info["fetched_at"])
+            )
+
+async def get_chat_info(client: TelegramClient, chat_id: int) -> dict:
+    """获取聊天信息（是否为广播频道、链接的讨论组、是否禁止转发），优先使用缓存"""
+    info = chat_info_cache.get(chat_id)
+    if info and time.time() - info["fetched_at"] < ENTITY_CACHE_TTL:
+        return info
+    
+    entity = await client.get_entity(chat_id)
+    broadcast = isinstance(entity, Channel) and not entity.megagroup
+    linked_chat_id = None
+    if broadcast:
+        # 讨论组只在完整频道信息里
+        full = await client(GetFullChannelRequest(entity))
+        if full.full_chat.linked_chat_id:
+            linked_chat_id = utils.get_peer_id(PeerChannel(full.full_chat.linked_chat_id))
+    
+    info = {
+        "broadcast": broadcast,
+        "linked_chat_id": linked_chat_id,
+        "noforwards": bool(getattr(entity, 'noforwards', False)),
+        "fetched_at": time.time()
+    }
+    new_discussion = linked_chat_id and get_discussion_source(linked_chat_id) is None
+    cache_chat_info(chat_id, info)
+    await asyncio.to_thread(_write_chat_info, chat_id, info)
+    
+    # 发现新的讨论组时重新注册处理器，以同步评论的编辑
+    if new_discussion:
+        register_source_handlers()
+    return info
+
+def invalidate_chat_info(chat_id: int):
+    """聊天信息变化或失去访问权限时立即清除缓存"""
+    info = chat_info_cache.pop(chat_id, None)
+    if info is not None:
+        if info["linked_chat_id"] and linked_channels.get(info["linked_chat_id"]) == chat_id:
+            del linked_channels[info["linked_chat_id"]]
+        logger.info(f"已清除聊天 {chat_id} 的信息缓存")
         try:
-            with open(USER_STATE_FILE, 'r', encoding='utf-8') as f:
-                states_data = json.load(f)
-            
-            for user_id, state_data in states_data.items():
-                user_id = int(user_id)
-                state = UserState()
-                state.state = state_data["state"]
-                state.temp_rule_name = state_data["temp_rule_name"]
-                state.source_chat_id = state_data["source_chat_id"]
-                state.target_chat_id = state_data["target_chat_id"]
-                user_states[user_id] = state
-            
-            logger.info(f"已从 {USER_STATE_FILE} 加载 {len(user_states)} 个用户状态")
+            _write_chat_info(chat_id, None)
         except Exception as e:
-            logger.error(f"加载用户状态失败: {e}")
-            user_states = {}
-    else:
-        logger.info("用户状态文件不存在，创建新的用户状态集")
-        user_states = {}
+            logger.error(f"清除聊天信息缓存失败: {e}")
+
+async def on_channel_update(event):
+    """频道信息变化（如更换讨论组）时清除缓存"""
+    invalidate_chat_info(utils.get_peer_id(PeerChannel(event.channel_id)))
+
+def flush_checkpoints():
+    """立即提交所有未写入的检查点、消息ID对应关系和已完成的发送日志（退出时调用）"""
+    if not dirty_checkpoints and not dirty_message_map and not dirty_journal:
+        return
+    changes = dict(dirty_checkpoints)
+    map_rows = list(dirty_message_map)
+    journal_rows = list(dirty_journal)
+    dirty_checkpoints.clear()
+    dirty_message_map.clear()
+    dirty_journal.clear()
+    _write_checkpoints(changes, map_rows, journal_rows)
+
+async def checkpoint_flush_loop():
+    """定期批量提交检查点和消息ID对应关系，避免每条消息都写盘"""
+    while True:
+        await asyncio.sleep(CHECKPOINT_FLUSH_INTERVAL)
+        if not dirty_checkpoints and not dirty_message_map and not dirty_journal:
+            continue
+        changes = dict(dirty_checkpoints)
+        map_rows = list(dirty_message_map)
+        journal_rows = list(dirty_journal)
+        dirty_checkpoints.clear()
+        dirty_message_map.clear()
+        dirty_journal.clear()
+        try:
+            await asyncio.to_thread(_write_checkpoints, changes, map_rows, journal_rows)
+        except Exception as e:
+            logger.error(f"保存检查点失败: {e}")
+            # 写入失败时保留未提交的变更，下次重试
+            for checkpoint, message_id in changes.items():
+                dirty_checkpoints.setdefault(checkpoint, message_id)
+            dirty_message_map[:0] = map_rows
+            dirty_journal[:0] = journal_rows
 
 async def is_user_allowed(user_id: int) -> bool:
     """检查用户是否在白名单中"""
@@ -135,17 +742,271 @@ async def get_chat_id_from_message(message: Message) -> Optional[int]:
                 return message.forward.chat_id
     return None
 
-async def add_new_rule(user_id: int, rule_name: str):
+def parse_filter_spec(text: str) -> dict:
+    """解析过滤/改写规格，例如 "keywords=招聘,兼职; media=photo,video; min_length=10; replace=旧=>新; strip_links=1"
+    
+    格式错误时抛出 ValueError
+    """
+    spec = {}
+    for item in text.split(";"):
+        item = item.strip()
+        if not item:
+            continue
+        key, sep, value = item.partition("=")
+        key, value = key.strip().lower(), value.strip()
+        if not sep or not value:
+            raise ValueError(f"无法解析 '{item}'，格式应为 名称=值")
+        
+        if key in ("keywords", "exclude"):
+            spec[key] = [word.strip() for word in value.split(",") if word.strip()]
+        elif key == "regex":
+            try:
+                re.compile(value)
+            except re.error as e:
+                raise ValueError(f"正则表达式无效: {e}")
+            spec[key] = value
+        elif key == "media":
+            kinds = [kind.strip().lower() for kind in value.split(",") if kind.strip()]
+            unknown = [kind for kind in kinds if kind not in MEDIA_KINDS]
+            if unknown:
+                raise ValueError(f"未知的媒体类型 {', '.join(unknown)}，可选：{', '.join(MEDIA_KINDS)}")
+            spec[key] = kinds
+        elif key in ("senders", "block_senders"):
+            try:
+                spec[key] = [int(sender) for sender in value.split(",") if sender.strip()]
+            except ValueError:
+                raise ValueError(f"{key} 应为逗号分隔的用户ID")
+        elif key == "min_length":
+            if not value.isdigit():
+                raise ValueError("min_length 应为整数")
+            spec[key] = int(value)
+        elif key == "replace":
+            old, arrow, new = value.partition("=>")
+            if not arrow or not old:
+                raise ValueError("replace 的格式应为 旧文本=>新文本")
+            spec.setdefault(key, []).append([old, new])
+        elif key == "strip_links":
+            spec[key] = value.lower() in ("1", "true", "yes", "on")
+        else:
+            raise ValueError(f"未知的过滤项 '{key}'")
+    return spec
+
+def check_filter_spec(spec) -> None:
+    """检查已是 JSON 形式的过滤规格（如导入的规则）的字段和类型，有误时抛出 ValueError"""
+    def is_int(value) -> bool:
+        return isinstance(value, int) and not isinstance(value, bool)
+    
+    def check_list(key: str, value, valid, kind: str):
+        if not isinstance(value, list) or not all(valid(v) for v in value):
+            raise ValueError(f"{key} 应为{kind}的列表")
+    
+    if not isinstance(spec, dict):
+        raise ValueError("filters 应为 JSON 对象")
+    for key, value in spec.items():
+        if key in ("keywords", "exclude"):
+            check_list(key, value, lambda v: isinstance(v, str) and v.strip(), "非空字符串")
+        elif key == "regex":
+            if not isinstance(value, str):
+                raise ValueError("regex 应为字符串")
+            try:
+                re.compile(value)
+            except re.error as e:
+                raise ValueError(f"正则表达式无效: {e}")
+        elif key == "media":
+            check_list(key, value, lambda v: isinstance(v, str), "字符串")
+            unknown = [kind for kind in value if kind not in MEDIA_KINDS]
+            if unknown:
+                raise ValueError(f"未知的媒体类型 {', '.join(unknown)}，可选：{', '.join(MEDIA_KINDS)}")
+        elif key in ("senders", "block_senders"):
+            check_list(key, value, is_int, "用户ID（整数）")
+        elif key == "min_length":
+            if not is_int(value) or value < 0:
+                raise ValueError("min_length 应为非负整数")
+        elif key == "replace":
+            check_list(key, value, lambda v: (isinstance(v, list) and len(v) == 2 and all(isinstance(t, str) for t in v)
+                                              and v[0]), "[旧文本, 新文本]")
+        elif key == "strip_links":
+            if not isinstance(value, bool):
+                raise ValueError("strip_links 应为 true 或 false")
+        else:
+            raise ValueError(f"未知的过滤项 '{key}'")
+
+def format_filter_spec(spec: dict) -> str:
+    """过滤规格的可读形式（与 parse_filter_spec 的输入格式一致）"""
+    items = []
+    for key, value in spec.items():
+        if key == "replace":
+            items.extend(f"replace={old}=>{new}" for old, new in value)
+        elif isinstance(value, list):
+            items.append(f"{key}={','.join(str(v) for v in value)}")
+        elif isinstance(value, bool):
+            items.append(f"{key}={int(value)}")
+        else:
+            items.append(f"{key}={value}")
+    return "; ".join(items)
+
+def message_media_kind(message: Message) -> str:
+    """消息的媒体类型（带链接预览的消息按文本处理）"""
+    if not message.media or message.web_preview:
+        return "text"
+    for kind in ("photo", "gif", "sticker", "voice", "video", "audio", "document", "poll"):
+        if getattr(message, kind, None):
+            return kind
+    return "other"
+
+def _compile_words(words: List[str]) -> Optional["re.Pattern"]:
+    """多个关键词合并为一个正则，一次扫描完成匹配"""
+    if not words:
+        return None
+    return re.compile("|".join(re.escape(word) for word in sorted(words, key=len, reverse=True)), re.IGNORECASE)
+
+class RuleFilter:
+    """编译后的规则过滤和改写，每条规则只在规则变化时编译一次"""
+    
+    def __init__(self, spec: dict):
+        self.keywords = _compile_words(spec.get("keywords", []))
+        self.exclude = _compile_words(spec.get("exclude", []))
+        self.pattern = re.compile(spec["regex"]) if spec.get("regex") else None
+        self.media_kinds = set(spec.get("media", []))
+        self.senders = set(spec.get("senders", []))
+        self.blocked_senders = set(spec.get("block_senders", []))
+        self.min_length = spec.get("min_length", 0)
+        
+        replacements = dict(spec.get("replace", []))
+        self.replacements = replacements
+        self.replace_pattern = _compile_words(list(replacements)) if replacements else None
+        if self.replace_pattern:
+            # 替换区分大小写
+            self.replace_pattern = re.compile(self.replace_pattern.pattern)
+        self.strip_links = spec.get("strip_links", False)
+    
+    @property
+    def rewrites(self) -> bool:
+        return bool(self.replace_pattern or self.strip_links)
+    
+    def accepts(self, unit: List[Message]) -> bool:
+        """判断一个发送单元（一条消息或一个相册）是否转发"""
+        text = "\n".join(m.message for m in unit if m.message)
+        if len(text) < self.min_length:
+            return False
+        
+        sender_id = unit[0].sender_id
+        if self.senders and sender_id not in self.senders:
+            return False
+        if sender_id in self.blocked_senders:
+            return False
+        
+        if self.media_kinds and not any(message_media_kind(m) in self.media_kinds for m in unit):
+            return False
+        
+        if self.exclude and self.exclude.search(text):
+            return False
+        if self.keywords and not self.keywords.search(text):
+            return False
+        if self.pattern and not self.pattern.search(text):
+            return False
+        return True
+    
+    def rewrite(self, text: str) -> str:
+        if not text:
+            return text
+        if self.replace_pattern:
+            text = self.replace_pattern.sub(lambda match: self.replacements[match.group(0)], text)
+        if self.strip_links:
+            text = LINK_PATTERN.sub("", text).strip()
+        return text
+
+def get_rule_filter(rule_name: Optional[str]) -> Optional[RuleFilter]:
+    return rule_filters.get(rule_name) if rule_name else None
+
+class SkippedUnit(list):
+    """被规则过滤掉的发送单元：仍按顺序经过发送队列以推进检查点，但不发送"""
+
+class DigestUnit(list):
+    """合并模式下合并为一条发送的多条短文本消息"""
+
+def check_digest_settings(window, size):
+    """检查合并模式的参数，有误时抛出 ValueError"""
+    if not isinstance(window, int) or window <= 0:
+        raise ValueError("合并窗口应为正整数（秒）")
+    if not isinstance(size, int) or not DIGEST_MIN_SIZE <= size <= MESSAGE_LENGTH_LIMIT:
+        raise ValueError(f"合并长度应在 {DIGEST_MIN_SIZE} 到 {MESSAGE_LENGTH_LIMIT} 之间")
+
+def get_digest_settings(rule_name: Optional[str]) -> Optional[dict]:
+    rule = forwarding_rules.get(rule_name) if rule_name else None
+    return rule.get("digest") if rule else None
+
+def is_digest_message(message: Message) -> bool:
+    """合并模式下可以合并的消息：不超过 DIGEST_TEXT_LIMIT 的纯文本（可带链接预览）"""
+    return bool(message.message) and len(message.message) <= DIGEST_TEXT_LIMIT and message_media_kind(message) == "text"
+
+def digest_line_prefix(message: Message) -> str:
+    """合并消息中每一条的前缀：发送时间和发送者（频道消息为署名）"""
+    sender = message.sender
+    name = message.post_author or (utils.get_display_name(sender) if sender else "")
+    time_text = message.date.astimezone().strftime("%H:%M")
+    return f"[{time_text}] {name}: " if name else f"[{time_text}] "
+
+def digest_line_length(message: Message) -> int:
+    return len(digest_line_prefix(message)) + len(message.message) + len(DIGEST_SEPARATOR)
+
+def coalesce_units(units: List[List[Message]], settings: dict) -> List[List[Message]]:
+    """把连续的可合并消息按时间窗口（按消息时间）和长度上限合并为 DigestUnit
+    
+    被过滤的单元不打断合并，排在所在的合并单元之后，以便检查点在合并消息发出后才越过它们
+    """
+    result = []
+    digest: Optional[DigestUnit] = None
+    skipped = []
+    length = 0
+    
+    def close():
+        nonlocal digest
+        if digest:
+            result.append(digest)
+            result.extend(skipped)
+            skipped.clear()
+        digest = None
+    
+    for unit in units:
+        if isinstance(unit, SkippedUnit):
+            (skipped if digest else result).append(unit)
+            continue
+        if len(unit) > 1 or not is_digest_message(unit[0]):
+            close()
+            result.append(unit)
+            continue
+        
+        message = unit[0]
+        line = digest_line_length(message)
+        if digest and (length + line > settings["size"]
+                       or (message.date - digest[0].date).total_seconds() > settings["window"]):
+            close()
+        if not digest:
+            digest = DigestUnit()
+            length = 0
+        digest.append(message)
+        length += line
+    close()
+    return result
+
+async def add_new_rule(user_id: int, rule_name: str, filter_spec: str = ""):
     """添加新的转发规则流程"""
     if rule_name in forwarding_rules:
         return f"规则名 '{rule_name}' 已存在，请使用其他名称。"
     
+    try:
+        filters = parse_filter_spec(filter_spec)
+    except ValueError as e:
+        return f"过滤条件有误：{e}"
+    
     if user_id not in user_states:
         user_states[user_id] = UserState()
     
     user_states[user_id].state = BotState.WAITING_SOURCE
     user_states[user_id].temp_rule_name = rule_name
-    save_user_states()
+    user_states[user_id].temp_filters = filters
+    await save_store(user_ids=[user_id])
     
     return "请转发一条源群组/频道的消息，用于获取源群组/频道的ID。"
 
@@ -158,7 +1019,7 @@ async def process_source_message(user_id: int, message: Message):
     
     user_states[user_id].source_chat_id = chat_id
     user_states[user_id].state = BotState.WAITING_TARGET
-    save_user_states()
+    await save_store(user_ids=[user_id])
     
     return "请转发一条目标群组/频道的消息，用于获取目标群组/频道的ID。"
 
@@ -173,389 +1034,2625 @@ async def process_target_message(user_id: int, message: Message):
     source_chat_id = user_states[user_id].source_chat_id
     
     # 添加新规则
-    forwarding_rules[rule_name] = {
+    rule = {
         "source_chat_id": source_chat_id,
         "target_chat_id": chat_id,
+        "mode": MODE_FORWARD,
         "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         "created_by": user_id
     }
+    if user_states[user_id].temp_filters:
+        rule["filters"] = user_states[user_id].temp_filters
+    put_rule(rule_name, rule)
     
-    # 初始化最后查看的消息ID
-    if source_chat_id not in last_message_ids:
-        last_message_ids[source_chat_id] = 0
+    # 初始化最后查看的消息ID；已有检查点的 (源, 目标) 沿用进度，否则补发源的全部历史
+    if (source_chat_id, chat_id) not in last_message_ids:
+        last_message_ids[(source_chat_id, chat_id)] = 0
+        pending_backfills.add(rule_name)
     
     # 重置用户状态
     user_states[user_id].state = BotState.IDLE
     user_states[user_id].temp_rule_name = ""
+    user_states[user_id].temp_filters = None
     user_states[user_id].source_chat_id = None
     user_states[user_id].target_chat_id = None
     
-    save_rules()
-    save_user_states()
+    # 规则和用户状态在同一事务中保存
+    await save_store(rule_names=[rule_name], user_ids=[user_id])
     
     return f"规则【{rule_name}】添加成功，开始转发。"
 
-async def list_rules():
-    """列出所有转发规则"""
+def paginate_reply(header: str, entries: List[str]) -> List[str]:
+    """把逐条的回复内容拼成若干条不超过消息长度上限的消息，条目不跨消息拆开"""
+    pages = []
+    page = header
+    for entry in entries:
+        if page and len(helpers.add_surrogate(page + entry)) > MESSAGE_LENGTH_LIMIT:
+            pages.append(page)
+            page = ""
+        page += entry
+    pages.append(page)
+    # 单个条目本身超长时（如很长的过滤条件）再按长度拆分
+    return [chunk for page in pages for chunk, _ in split_formatted_text(page, None, MESSAGE_LENGTH_LIMIT)]
+
+async def list_rules() -> List[str]:
+    """列出所有转发规则（规则多时分成多条消息）"""
     if not forwarding_rules:
-        return "当前没有转发规则。"
+        return ["当前没有转发规则。"]
     
-    result = "当前转发规则列表：\n\n"
+    entries = []
     for name, rule in forwarding_rules.items():
-        result += f"规则名：{name}\n"
+        result = f"规则名：{name}\n"
         result += f"源群组/频道ID：{rule['source_chat_id']}\n"
         result += f"目标群组/频道ID：{rule['target_chat_id']}\n"
+        result += f"转发模式：{rule.get('mode', MODE_FORWARD)}\n"
+        if rule.get("paused"):
+            result += "状态：已暂停\n"
+        if rule.get("filters"):
+            result += f"过滤/改写：{format_filter_spec(rule['filters'])}\n"
+        if rule.get("digest"):
+            result += f"合并发送：{rule['digest']['window']} 秒内的短消息合并，每条不超过 {rule['digest']['size']} 字\n"
+        if name in backfill_jobs:
+            job = backfill_jobs[name]
+            result += f"补发进度：{job.done}/{job.total}，剩余约 {job.remaining} 条\n"
         result += f"创建时间：{rule['created_at']}\n"
         result += f"创建者ID：{rule['created_by']}\n"
         result += "-" * 30 + "\n"
+        entries.append(result)
     
-    return result
+    return paginate_reply("当前转发规则列表：\n\n", entries)
 
-async def delete_rule(rule_name: str):
-    """删除转发规则"""
+async def set_rule_filters(rule_name: str, filter_spec: str):
+    """设置规则的过滤和改写条件（为空时清除）"""
     if rule_name not in forwarding_rules:
         return f"规则 '{rule_name}' 不存在。"
     
-    del forwarding_rules[rule_name]
-    save_rules()
-    return f"规则 '{rule_name}' 已删除。"
+    try:
+        filters = parse_filter_spec(filter_spec)
+    except ValueError as e:
+        return f"过滤条件有误：{e}"
+    
+    rule = dict(forwarding_rules[rule_name])
+    if filters:
+        rule["filters"] = filters
+    else:
+        rule.pop("filters", None)
+    put_rule(rule_name, rule)
+    await save_store(rule_names=[rule_name])
+    if not filters:
+        return f"规则 '{rule_name}' 的过滤条件已清除。"
+    return f"规则 '{rule_name}' 的过滤条件已设置为：{format_filter_spec(filters)}"
+
+async def set_rule_mode(rule_name: str, mode: str):
+    """设置规则的转发模式"""
+    if rule_name not in forwarding_rules:
+        return f"规则 '{rule_name}' 不存在。"
+    
+    if mode not in (MODE_FORWARD, MODE_COPY):
+        return f"未知的转发模式 '{mode}'，可选：{MODE_FORWARD} / {MODE_COPY}"
+    
+    forwarding_rules[rule_name]["mode"] = mode
+    await save_store(rule_names=[rule_name])
+    return f"规则 '{rule_name}' 的转发模式已设置为 {mode}。"
 
-async def forward_messages(client: TelegramClient, source_chat_id: int, target_chat_id: int):
-    """转发消息从源群组/频道到目标群组/频道"""
+async def set_rule_digest(rule_name: str, window: Optional[int], size: int = MESSAGE_LENGTH_LIMIT):
+    """开启或关闭（window 为 None）规则的合并模式"""
+    if rule_name not in forwarding_rules:
+        return f"规则 '{rule_name}' 不存在。"
+    
+    rule = forwarding_rules[rule_name]
+    if window is None:
+        if not rule.pop("digest", None):
+            return f"规则 '{rule_name}' 没有开启合并模式。"
+        await save_store(rule_names=[rule_name])
+        return f"规则 '{rule_name}' 已关闭合并模式。"
+    
     try:
-        # 获取源群组的历史消息
-        last_id = last_message_ids.get(source_chat_id, 0)
-        
-        # 初始化从最早到最晚的消息转发
-        if last_id == 0:
-            # 从头开始克隆
-            # 我们先获取总消息数量的估计
-            total_count = 0
-            async for _ in client.iter_messages(source_chat_id, limit=1):
-                total_count += 1
-            
-            logger.info(f"开始初始克隆，源群组/频道总消息数约为: {total_count}")
-            
-            # 如果是初次克隆，我们从最早的消息开始
-            # 获取最早的最多200条消息
-            earliest_messages = []
-            async for message in client.iter_messages(source_chat_id, limit=200, reverse=True):
-                earliest_messages.append(message)
-            
-            if earliest_messages:
-                logger.info(f"获取到 {len(earliest_messages)} 条历史消息")
-                
-                # 按照ID排序确保顺序
-                earliest_messages.sort(key=lambda m: m.id)
-                
-                # 按群组，将相同albumID的消息分组
-                album_groups = {}
-                standalone_messages = []
-                
-                for message in earliest_messages:
-                    # 如果消息是相册的一部分
-                    if hasattr(message, 'grouped_id') and message.grouped_id:
-                        if message.grouped_id not in album_groups:
-                            album_groups[message.grouped_id] = []
-                        album_groups[message.grouped_id].append(message)
-                    else:
-                        standalone_messages.append(message)
-                
-                # 转发所有相册（多媒体组）
-                forwarded_count = 0
-                for album_id, album_messages in album_groups.items():
-                    try:
-                        # 排序相册消息
-                        album_messages.sort(key=lambda m: m.id)
-                        
-                        # 从相册中提取所有媒体文件
-                        media_files = []
-                        caption = None
-                        
-                        for msg in album_messages:
-                            if msg.media:
-                                media_files.append(msg.media)
-                                # 使用第一个有文本的消息作为标题
-                                if not caption and msg.message:
-                                    caption = msg.message
-                        
-                        # 一次性发送整个相册
-                        if media_files:
-                            await client.send_file(
-                                target_chat_id,
-                                file=media_files,  # 发送多个媒体文件
-                                caption=caption if caption else "",
-                                parse_mode='md',
-                                silent=album_messages[0].silent if album_messages else False
-                            )
-                            forwarded_count += 1
-                            
-                            # 更新最后处理的消息ID
-                            last_message_id = max(m.id for m in album_messages)
-                            last_message_ids[source_chat_id] = max(last_message_ids.get(source_chat_id, 0), last_message_id)
-                            
-                            # 休息一秒防止封号
-                            await asyncio.sleep(1)
-                    except Exception as e:
-                        logger.error(f"转发相册失败 (AlbumID: {album_id}): {e}")
-                
-                # 转发独立消息
-                for message in standalone_messages:
-                    # 不转发系统消息、表情包和投票
-                    if message.action or not message.message and not message.media:
-                        continue
-                    
-                    # 转发消息（无引用）
-                    try:
-                        await client.send_message(
-                            target_chat_id,
-                            message.message,
-                            file=message.media,
-                            silent=message.silent,
-                            parse_mode='md'
-                        )
-                        forwarded_count += 1
-                        
-                        # 更新最后处理的消息ID
-                        last_message_ids[source_chat_id] = max(last_message_ids.get(source_chat_id, 0), message.id)
-                        
-                        # 休息一秒，防止封号
-                        await asyncio.sleep(1)
-                    except Exception as e:
-                        logger.error(f"转发消息失败 (ID: {message.id}): {e}")
-                
-                return forwarded_count
-        else:
-            # 获取新消息
-            messages = await client.get_messages(
-                source_chat_id, 
-                limit=50,  # 一次获取更多消息
-                min_id=last_id
-            )
-            
-            if not messages:
-                return 0
-            
-            # 按照ID排序，确保按发送顺序转发
-            messages = sorted(messages, key=lambda m: m.id)
-            
-            # 按群组，将相同albumID的消息分组
-            album_groups = {}
-            standalone_messages = []
-            
-            for message in messages:
-                # 如果消息是相册的一部分
-                if hasattr(message, 'grouped_id') and message.grouped_id:
-                    if message.grouped_id not in album_groups:
-                        album_groups[message.grouped_id] = []
-                    album_groups[message.grouped_id].append(message)
-                else:
-                    standalone_messages.append(message)
-            
-            # 转发所有相册（多媒体组）
-            forwarded_count = 0
-            for album_id, album_messages in album_groups.items():
-                try:
-                    # 排序相册消息
-                    album_messages.sort(key=lambda m: m.id)
-                    
-                    # 从相册中提取所有媒体文件
-                    media_files = []
-                    caption = None
-                    
-                    for msg in album_messages:
-                        if msg.media:
-                            media_files.append(msg.media)
-                            # 使用第一个有文本的消息作为标题
-                            if not caption and msg.message:
-                                caption = msg.message
-                    
-                    # 一次性发送整个相册
-                    if media_files:
-                        await client.send_file(
-                            target_chat_id,
-                            file=media_files,  # 发送多个媒体文件
-                            caption=caption if caption else "",
-                            parse_mode='md',
-                            silent=album_messages[0].silent if album_messages else False
-                        )
-                        forwarded_count += 1
-                        
-                        # 更新最后处理的消息ID
-                        last_message_id = max(m.id for m in album_messages)
-                        last_message_ids[source_chat_id] = max(last_message_ids[source_chat_id], last_message_id)
-                        
-                        # 休息一秒防止封号
-                        await asyncio.sleep(1)
-                except Exception as e:
-                    logger.error(f"转发相册失败 (AlbumID: {album_id}): {e}")
-            
-            # 转发独立消息
-            for message in standalone_messages:
-                # 不转发系统消息、表情包和投票
-                if message.action or not message.message and not message.media:
-                    continue
-                
-                # 转发消息（无引用）
-                try:
-                    await client.send_message(
-                        target_chat_id,
-                        message.message,
-                        file=message.media,
-                        silent=message.silent,
-                        parse_mode='md'
-                    )
-                    forwarded_count += 1
-                    
-                    # 更新最后处理的消息ID
-                    last_message_ids[source_chat_id] = max(last_message_ids[source_chat_id], message.id)
-                    
-                    # 休息一秒，防止封号
-                    await asyncio.sleep(1)
-                except Exception as e:
-                    logger.error(f"转发消息失败 (ID: {message.id}): {e}")
-            
-            return forwarded_count
-    except Exception as e:
-        logger.error(f"获取或转发消息失败: {e}")
-        if isinstance(e, FloodWaitError):
-            logger.info(f"需要等待 {e.seconds} 秒")
-            await asyncio.sleep(e.seconds)
-        return 0
+        check_digest_settings(window, size)
+    except ValueError as e:
+        return f"合并参数有误：{e}"
+    rule["digest"] = {"window": window, "size": size}
+    await save_store(rule_names=[rule_name])
+    return f"规则 '{rule_name}' 已开启合并模式：{window} 秒内的短文本消息合并为一条，每条不超过 {size} 字。"
 
-async def forward_comment_messages(client: TelegramClient, source_chat_id: int, target_chat_id: int):
-    """转发频道评论区消息"""
+async def set_rule_paused(rule_name: str, paused: bool):
+    """暂停或恢复规则：暂停期间不转发，检查点保留，恢复后从检查点继续"""
+    if rule_name not in forwarding_rules:
+        return f"规则 '{rule_name}' 不存在。"
+    
+    rule = forwarding_rules[rule_name]
+    if bool(rule.get("paused")) == paused:
+        return f"规则 '{rule_name}' {'已经处于暂停状态' if paused else '没有暂停'}。"
+    
+    if paused:
+        rule["paused"] = True
+    else:
+        rule.pop("paused", None)
+    await save_store(rule_names=[rule_name])
+    if paused:
+        return f"规则 '{rule_name}' 已暂停。"
+    return f"规则 '{rule_name}' 已恢复，将从暂停前的位置继续转发。"
+
+async def start_rule_backfill(rule_name: str, from_id: int = 0):
+    """重新补发规则的历史消息：从 from_id 之后直到当前检查点"""
+    if rule_name not in forwarding_rules:
+        return f"规则 '{rule_name}' 不存在。"
+    if rule_name in backfill_jobs:
+        job = backfill_jobs[rule_name]
+        return f"规则 '{rule_name}' 正在补发，进度 {job.done}/{job.total}。"
+    worker = rule_workers.get(rule_name)
+    if worker is None or not worker.ready:
+        return f"规则 '{rule_name}' 已暂停或尚未就绪，无法补发。"
+    
+    end_id = last_message_ids.get(worker.checkpoint, 0)
+    if from_id >= end_id:
+        return f"规则 '{rule_name}' 在消息 {from_id} 之后没有需要补发的消息。"
+    
+    # 频道消息ID连续，用ID差估算条数
+    job = BackfillJob(worker, end_id, cursor=from_id, total=end_id - from_id)
+    await job._save()
+    backfill_jobs[rule_name] = job
+    job.start()
+    return f"规则 '{rule_name}' 开始补发消息 {from_id + 1} 至 {end_id}，可用 /list 查看进度。"
+
+def export_rules() -> io.BytesIO:
+    """导出所有规则为 JSON 文件（格式与旧版 rules.json 相同）"""
+    data = io.BytesIO(json.dumps(forwarding_rules, ensure_ascii=False, indent=2).encode("utf-8"))
+    data.name = f"rules-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    return data
+
+async def import_rules(user_id: int, data: bytes):
+    """批量导入规则（JSON 对象：规则名 -> 规则），同名规则会被覆盖；先全部校验，有错误时不导入任何规则"""
     try:
-        # 尝试获取频道的评论区
-        # 由于GetRepliesRequest直接使用有困难，我们改用另一种方法
+        imported = json.loads(data.decode("utf-8"))
+    except (UnicodeDecodeError, ValueError) as e:
+        return f"导入失败，文件不是有效的 JSON：{e}"
+    if not isinstance(imported, dict) or not imported:
+        return "导入失败，文件内容应为 规则名 -> 规则 的 JSON 对象。"
+    
+    rules = {}
+    for rule_name, rule in imported.items():
         try:
-            # 首先获取一条源频道消息
-            source_messages = await client.get_messages(source_chat_id, limit=1)
-            if not source_messages:
-                return 0
-                
-            # 获取频道实体
-            source_entity = await client.get_entity(source_chat_id)
-            
-            # 如果是频道，尝试找到其讨论组
-            if isinstance(source_entity, Channel) and source_entity.megagroup == False:
-                # 检查频道是否有链接的讨论组
-                if hasattr(source_entity, 'linked_chat_id') and source_entity.linked_chat_id:
-                    discussion_chat_id = source_entity.linked_chat_id
-                    
-                    # 转发评论消息
-                    last_id = last_message_ids.get(discussion_chat_id, 0)
-                    messages = await client.get_messages(
-                        discussion_chat_id,
-                        limit=10,
-                        min_id=last_id
-                    )
-                    
-                    if not messages:
-                        return 0
-                        
-                    messages = sorted(messages, key=lambda m: m.id)
-                    
-                    forwarded_count = 0
-                    for message in messages:
-                        # 跳过系统消息和空消息
-                        if message.action or not message.message and not message.media:
-                            continue
-                            
-                        # 转发消息
-                        try:
-                            await client.send_message(
-                                target_chat_id,
-                                f"💬 评论: {message.message}",
-                                file=message.media,
-                                silent=message.silent
-                            )
-                            forwarded_count += 1
-                            
-                            # 更新最后处理的消息ID
-                            if discussion_chat_id not in last_message_ids:
-                                last_message_ids[discussion_chat_id] = 0
-                            last_message_ids[discussion_chat_id] = max(last_message_ids[discussion_chat_id], message.id)
-                            
-                            # 休息一秒，防止封号
-                            await asyncio.sleep(1)
-                        except Exception as e:
-                            logger.error(f"转发评论消息失败 (ID: {message.id}): {e}")
-                    
-                    return forwarded_count
-        except Exception as e:
-            logger.error(f"获取评论区失败: {e}")
-        
-        return 0
-    except Exception as e:
-        logger.error(f"转发评论失败: {e}")
-        return 0
+            if not isinstance(rule, dict):
+                raise ValueError("规则应为 JSON 对象")
+            for key in ("source_chat_id", "target_chat_id"):
+                if not isinstance(rule.get(key), int):
+                    raise ValueError(f"缺少 {key} 或不是整数")
+            if rule.get("mode", MODE_FORWARD) not in (MODE_FORWARD, MODE_COPY):
+                raise ValueError(f"未知的转发模式 '{rule['mode']}'")
+            if rule.get("filters"):
+                check_filter_spec(rule["filters"])
+            if rule.get("digest"):
+                check_digest_settings(rule["digest"].get("window"), rule["digest"].get("size"))
+        except (ValueError, AttributeError, TypeError) as e:
+            return f"导入失败，规则 '{rule_name}' 有误：{e}"
+        rule.setdefault("mode", MODE_FORWARD)
+        rule.setdefault("created_at", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        rule.setdefault("created_by", user_id)
+        rules[rule_name] = rule
+    
+    replaced = sum(1 for rule_name in rules if rule_name in forwarding_rules)
+    for rule_name, rule in rules.items():
+        put_rule(rule_name, rule)
+        # 导入的规则不补发历史：已有检查点的沿用进度，否则从源的最新消息开始
+        pending_backfills.discard(rule_name)
+        checkpoint = (rule["source_chat_id"], rule["target_chat_id"])
+        last_message_ids.setdefault(checkpoint, 0)
+    await save_store(rule_names=list(rules))
+    return f"已导入 {len(rules)} 条规则，其中覆盖已有规则 {replaced} 条。"
 
-async def check_new_messages(client: TelegramClient):
-    """检查所有规则的新消息"""
-    while True:
-        try:
-            total_forwarded = 0
-            for rule_name, rule in forwarding_rules.items():
-                source_id = rule["source_chat_id"]
-                target_id = rule["target_chat_id"]
-                
-                # 转发主频道/群组消息
-                forwarded = await forward_messages(client, source_id, target_id)
-                total_forwarded += forwarded
-                
-                # 尝试转发评论区消息
-                comment_forwarded = await forward_comment_messages(client, source_id, target_id)
-                total_forwarded += comment_forwarded
-                
-                if forwarded > 0 or comment_forwarded > 0:
-                    logger.info(f"规则 '{rule_name}' 转发了 {forwarded + comment_forwarded} 条消息")
-            
-            if total_forwarded > 0:
-                logger.info(f"本轮共转发了 {total_forwarded} 条消息")
-            
-            # 等待20秒后再次检查
-            await asyncio.sleep(20)
-        except Exception as e:
-            logger.error(f"检查新消息过程中出错: {e}")
-            await asyncio.sleep(30)  # 出错后等待长一点的时间
+async def delete_rule(rule_name: str):
+    """删除转发规则"""
+    if rule_name not in forwarding_rules:
+        return f"规则 '{rule_name}' 不存在。"
+    
+    rule = pop_rule(rule_name)
+    checkpoint = (rule["source_chat_id"], rule["target_chat_id"])
+    if not find_rules(*checkpoint):
+        forget_checkpoint(checkpoint)
+    rule_metrics.pop(rule_name, None)
+    await save_store(rule_names=[rule_name])
+    return f"规则 '{rule_name}' 已删除。"
 
-async def handle_user_message(event):
-    """处理用户消息"""
-    # 获取发送者ID
-    sender = await event.get_sender()
-    user_id = sender.id
+class TokenBucket:
+    """令牌桶：按速率补充令牌，FloodWait 期间整体暂停"""
     
-    # 检查用户是否在白名单中
-    if not await is_user_allowed(user_id):
-        return
+    def __init__(self, rate: float, burst: float, max_rate: float):
+        self.rate = rate
+        self.burst = burst
+        self.max_rate = max_rate
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.successes = 0
+        # 上次限流时实际达到的速率，降速以它为基准，恢复到它之前不必小步试探
+        self.limit = rate
+        # 最近几次发放令牌的时间，用于估算实际速率
+        self.sent_times = deque(maxlen=RATE_INCREASE_INTERVAL)
     
-    message = event.message
-    text = message.text if message.text else ""
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
     
-    # 处理命令
-    if text.startswith("/"):
-        parts = text.split()
-        command = parts[0].lower()
+    def wait_time(self, now: float) -> float:
+        """距离下一个可用令牌还需等待的秒数"""
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+    
+    def consume(self, now: float):
+        self.tokens -= 1
+        self.sent_times.append(now)
+    
+    def observed_rate(self) -> float:
+        """最近实际的发送速率（样本不足时按当前速率）"""
+        if len(self.sent_times) < 2 or self.sent_times[-1] <= self.sent_times[0]:
+            return self.rate
+        return (len(self.sent_times) - 1) / (self.sent_times[-1] - self.sent_times[0])
+    
+    def on_success(self):
+        """连续成功一定次数后提高速率：低于上次限流时的速率时快速恢复，之后小步逼近真实限制"""
+        self.successes += 1
+        if self.successes >= RATE_INCREASE_INTERVAL:
+            self.successes = 0
+            if self.rate < self.limit:
+                self.rate = min(self.limit, self.rate * RATE_RECOVERY_FACTOR)
+            else:
+                self.rate = min(self.max_rate, self.rate * RATE_INCREASE_FACTOR)
+    
+    def on_flood_wait(self, now: float, seconds: float, factor: float) -> bool:
+        """遇到 FloodWait 时降到触发限流时实际速率的 factor 倍；同一次限流（暂停期间）只降一次，返回是否降速"""
+        blocked = now < self.blocked_until
+        self.tokens = min(self.tokens, 0)
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        if blocked:
+            return False
+        self.successes = 0
+        # 以触发限流时的实际速率为准，但不因连续几次限流而无限下探
+        self.limit = max(min(self.rate, self.observed_rate()), self.limit * RATE_LIMIT_DECAY)
+        self.rate = max(MIN_SEND_RATE, self.limit * factor)
+        # 暂停期间不发送，不计入之后的速率估算
+        self.sent_times.clear()
+        return True
+
+class RateLimiter:
+    """整个会话共享的发送调度器：账号级和目标级令牌桶 + 优先级队列"""
+    
+    def __init__(self):
+        self.account = TokenBucket(ACCOUNT_SEND_RATE, ACCOUNT_SEND_BURST, ACCOUNT_MAX_RATE)
+        self.targets: Dict[int, TokenBucket] = {}
+        # 等待发送的请求：(优先级, 序号, 目标ID, future)
+        self.waiters: List[Tuple[int, int, int, asyncio.Future]] = []
+        self.seq = 0
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+    
+    def _target(self, target_chat_id: int) -> TokenBucket:
+        if target_chat_id not in self.targets:
+            self.targets[target_chat_id] = TokenBucket(TARGET_SEND_RATE, TARGET_SEND_BURST, TARGET_MAX_RATE)
+        return self.targets[target_chat_id]
+    
+    async def acquire(self, target_chat_id: int, priority: int):
+        """等待获得向目标发送一条消息的许可"""
+        future = asyncio.get_running_loop().create_future()
+        self.seq += 1
+        heapq.heappush(self.waiters, (priority, self.seq, target_chat_id, future))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        self.wakeup.set()
+        await future
+    
+    def on_success(self, target_chat_id: int):
+        self.account.on_success()
+        self._target(target_chat_id).on_success()
+    
+    def on_flood_wait(self, target_chat_id: int, seconds: float):
+        """根据 FloodWait 调整速率：目标暂停并减半，账号整体小幅降速；多个发送方遇到同一次限流时只调整一次"""
+        now = time.monotonic()
+        if not self._target(target_chat_id).on_flood_wait(now, seconds, 0.5):
+            return
+        self.account.on_flood_wait(now, 0, 0.8)
+        logger.info(f"目标 {target_chat_id} 触发限流，暂停 {seconds} 秒，"
+                    f"目标速率降为 {self.targets[target_chat_id].rate:.2f}/s，账号速率降为 {self.account.rate:.2f}/s")
+        self.wakeup.set()
+    
+    def _grant(self) -> Optional[float]:
+        """按优先级发放许可，返回下次需要检查的等待时间"""
+        now = time.monotonic()
+        next_wait = None
+        remaining = []
+        
+        while self.waiters:
+            item = heapq.heappop(self.waiters)
+            priority, seq, target_chat_id, future = item
+            if future.done():
+                continue
+            
+            account_wait = self.account.wait_time(now)
+            if account_wait > 0:
+                # 账号令牌不足时所有请求都要等待，低优先级不能插队
+                remaining.append(item)
+                next_wait = account_wait if next_wait is None else min(next_wait, account_wait)
+                break
+            
+            target_wait = self._target(target_chat_id).wait_time(now)
+            if target_wait > 0:
+                # 该目标受限时不阻塞其他目标
+                remaining.append(item)
+                next_wait = target_wait if next_wait is None else min(next_wait, target_wait)
+                continue
+            
+            self.account.consume(now)
+            self.targets[target_chat_id].consume(now)
+            future.set_result(None)
+        
+        for item in remaining:
+            heapq.heappush(self.waiters, item)
+        return next_wait
+    
+    async def _run(self):
+        while True:
+            self.wakeup.clear()
+            next_wait = self._grant()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), next_wait)
+            except asyncio.TimeoutError:
+                pass
+
+# 全局发送调度器
+rate_limiter = RateLimiter()
+
+class SessionPool:
+    """转发账号池：规则按稳定哈希分配到账号，账号被长时间限流或失去访问权限时迁移到其他账号"""
+    
+    def __init__(self):
+        self.clients: Dict[str, TelegramClient] = {}
+        self.limiters: Dict[str, RateLimiter] = {}
+        # 账号 -> 限流解除时间
+        self.limited_until: Dict[str, float] = {}
+        # 规则 -> 已失去访问权限的账号
+        self.excluded: Dict[str, Set[str]] = {}
+    
+    def add(self, session_name: str, client: TelegramClient):
+        self.clients[session_name] = client
+        if session_name != ADMIN_SESSION:
+            # 每个账号有自己的限速；管理账号使用全局的 rate_limiter
+            self.limiters[session_name] = RateLimiter()
+    
+    def name_of(self, client: TelegramClient) -> Optional[str]:
+        for session_name, session_client in self.clients.items():
+            if session_client is client:
+                return session_name
+        return None
+    
+    def limiter(self, session_name: Optional[str]) -> RateLimiter:
+        return self.limiters.get(session_name) or rate_limiter
+    
+    def session_for(self, rule_name: str) -> str:
+        """最高随机权重哈希：账号增减时只有少量规则迁移，限流解除后规则回到原账号"""
+        now = time.time()
+        candidates = [name for name in self.clients if name not in self.excluded.get(rule_name, ())] or list(self.clients)
+        available = [name for name in candidates if self.limited_until.get(name, 0) <= now] or candidates
+        return max(available, key=lambda name: hashlib.sha1(f"{name}:{rule_name}".encode("utf-8")).digest())
+    
+    def mark_limited(self, session_name: str, seconds: float) -> bool:
+        """记录账号被长时间限流，返回是否有其他账号可以接管"""
+        now = time.time()
+        self.limited_until[session_name] = now + seconds
+        return any(self.limited_until.get(name, 0) <= now for name in self.clients if name != session_name)
+    
+    def exclude(self, rule_name: str, session_name: str) -> bool:
+        """规则在该账号上失去访问权限，返回是否有其他账号可以接管"""
+        excluded = self.excluded.setdefault(rule_name, set())
+        excluded.add(session_name)
+        return any(name not in excluded for name in self.clients)
+    
+    def expire_limits(self) -> bool:
+        """清除已解除的限流，返回是否有账号恢复"""
+        now = time.time()
+        expired = [name for name, until in self.limited_until.items() if until <= now]
+        for name in expired:
+            del self.limited_until[name]
+        return bool(expired)
+
+session_pool = SessionPool()
+
+def schedule_rebalance(reason: str):
+    """在当前任务之外重新分配规则（被迁移的规则的发送任务会被取消）"""
+    logger.warning(f"重新分配规则到其他账号: {reason}")
+    asyncio.get_running_loop().call_soon(apply_rule_changes)
+
+class RuleMetrics:
+    """单条规则的统计：端到端延迟、API 调用、FloodWait 和失败次数"""
+    
+    def __init__(self):
+        self.messages = 0
+        self.api_calls = 0
+        self.flood_wait_seconds = 0.0
+        self.failures = 0
+        self.filtered = 0
+        self.latency_sum = 0.0
+        self.latency_count = 0
+        # 直方图各桶的计数（不含 +Inf，+Inf 即 latency_count）
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+        # 最近的延迟样本，用于 /stats 的分位数
+        self.recent_latencies = deque(maxlen=LATENCY_SAMPLE_SIZE)
+    
+    def observe_latency(self, seconds: float):
+        self.latency_sum += seconds
+        self.latency_count += 1
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.latency_buckets[index] += 1
+        self.recent_latencies.append(seconds)
+    
+    def percentile(self, fraction: float) -> Optional[float]:
+        if not self.recent_latencies:
+            return None
+        samples = sorted(self.recent_latencies)
+        return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+def get_rule_metrics(rule_name: Optional[str] = None) -> Optional[RuleMetrics]:
+    """取规则的统计（默认为当前任务正在处理的规则）"""
+    rule_name = rule_name or current_rule.get()
+    if rule_name is None:
+        return None
+    if rule_name not in rule_metrics:
+        rule_metrics[rule_name] = RuleMetrics()
+    return rule_metrics[rule_name]
+
+def record_api_call(count: int = 1):
+    metrics = get_rule_metrics()
+    if metrics:
+        metrics.api_calls += count
+
+def record_flood_wait(seconds: float):
+    metrics = get_rule_metrics()
+    if metrics:
+        metrics.flood_wait_seconds += seconds
+
+def record_failure(error: Optional[Exception] = None, message_ids: List[int] = ()):
+    metrics = get_rule_metrics()
+    if metrics:
+        metrics.failures += 1
+    if trace_recorder and error is not None:
+        trace_recorder.write("error", rule=current_rule.get(), ids=list(message_ids),
+                             error=type(error).__name__, detail=str(error)[:200])
+
+def record_filtered(count: int = 1):
+    metrics = get_rule_metrics()
+    if metrics:
+        metrics.filtered += count
+
+def record_delivered(messages: List[Message], priority: int):
+    """记录送达的消息；补发的历史消息不计入端到端延迟"""
+    if trace_recorder and messages:
+        trace_recorder.write("sent", rule=current_rule.get(), chat=utils.get_peer_id(messages[0].peer_id),
+                             ids=[m.id for m in messages])
+    metrics = get_rule_metrics()
+    if not metrics:
+        return
+    metrics.messages += len(messages)
+    if priority == PRIORITY_BACKFILL:
+        return
+    now = time.time()
+    for message in messages:
+        if message.date:
+            metrics.observe_latency(max(now - message.date.timestamp(), 0.0))
+
+class TraceRecorder:
+    """消息流轨迹记录：每行一个紧凑的 JSON 事件，同一条消息只记录第一次见到的时间"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "a", encoding="utf-8", buffering=1)
+        # 聊天ID -> 已记录的最大消息ID（重新拉取时不重复记录）
+        self.seen_ids: Dict[int, int] = {}
+        self.linked: Set[int] = set()
+    
+    def write(self, event: str, **fields):
+        record = {"ev": event, "t": round(time.time(), 3)}
+        record.update((key, value) for key, value in fields.items() if value is not None)
+        try:
+            self.file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        except OSError as e:
+            logger.error(f"写入轨迹文件 {self.path} 失败: {e}")
+    
+    def record_rules(self):
+        """记录规则和讨论组的拓扑，重放时据此建立源和目标"""
+        rules = {}
+        for rule_name, rule in forwarding_rules.items():
+            info = {
+                "source": rule["source_chat_id"],
+                "target": rule["target_chat_id"],
+                "mode": rule.get("mode", MODE_FORWARD),
+                "digest": rule.get("digest"),
+                "paused": rule.get("paused"),
+            }
+            rules[rule_name] = {key: value for key, value in info.items() if value is not None}
+        self.write("rules", rules=rules)
+    
+    def record_messages(self, chat_id: int, messages: List[Message], source_chat_id: Optional[int] = None):
+        """记录新见到的消息；source_chat_id 表示 chat_id 是该频道的讨论组（评论流）"""
+        if source_chat_id is not None and chat_id not in self.linked:
+            self.linked.add(chat_id)
+            self.write("link", source=source_chat_id, discussion=chat_id)
+        last_id = self.seen_ids.get(chat_id, 0)
+        for message in messages:
+            if message.id <= last_id:
+                continue
+            reply_to = message.reply_to
+            fwd_from = message.fwd_from
+            self.write(
+                "msg",
+                chat=chat_id,
+                id=message.id,
+                date=int(message.date.timestamp()) if message.date else None,
+                group=message.grouped_id,
+                kind=message_media_kind(message),
+                size=media_file_size(message.media),
+                len=len(message.message) if message.message else None,
+                reply=reply_to.reply_to_msg_id if reply_to else None,
+                top=reply_to.reply_to_top_id if reply_to else None,
+                post=fwd_from.channel_post if fwd_from else None,
+                service=1 if message.action else None,
+            )
+        if messages:
+            self.seen_ids[chat_id] = max(last_id, max(m.id for m in messages))
+
+def find_rule_name(source_chat_id: int, target_chat_id: int) -> Optional[str]:
+    rule_names = find_rules(source_chat_id, target_chat_id)
+    return rule_names[0] if rule_names else None
+
+async def send_with_rate_limit(target_chat_id: int, priority: int, send):
+    """在全局调度器下执行一次发送，限流和临时错误时重新排队，而不是丢弃"""
+    attempt = 0
+    session_name = current_session.get()
+    limiter = session_pool.limiter(session_name)
+    while True:
+        await limiter.acquire(target_chat_id, priority)
+        record_api_call()
+        try:
+            result = await send()
+        except (FloodWaitError, SlowModeWaitError) as e:
+            record_flood_wait(e.seconds)
+            if trace_recorder:
+                trace_recorder.write("flood", rule=current_rule.get(), target=target_chat_id, seconds=e.seconds)
+            limiter.on_flood_wait(target_chat_id, e.seconds)
+            # 账号被长时间限流：规则迁移到其他账号，本次发送由新账号从检查点重新开始
+            if (isinstance(e, FloodWaitError) and e.seconds >= SESSION_FLOOD_MOVE_SECONDS
+                    and session_pool.mark_limited(session_name, e.seconds)):
+                schedule_rebalance(f"账号 {session_name} 需要等待 {e.seconds} 秒")
+            continue
+        except ChannelPrivateError:
+            rule_name = current_rule.get()
+            if rule_name and session_pool.exclude(rule_name, session_name):
+                schedule_rebalance(f"账号 {session_name} 无法访问规则 '{rule_name}' 的目标")
+            raise
+        except (ServerError, ConnectionError, asyncio.TimeoutError) as e:
+            attempt += 1
+            if attempt > MAX_SEND_RETRIES:
+                raise
+            logger.warning(f"发送到 {target_chat_id} 失败，第 {attempt} 次重试: {e}")
+            await asyncio.sleep(min(2 ** attempt, 60))
+            continue
+        
+        limiter.on_success(target_chat_id)
+        return result
+
+def group_album_messages(messages: List[Message]) -> List[List[Message]]:
+    """按相册分组消息，返回按源顺序排列的发送单元（每个单元是一个相册或一条独立消息）"""
+    # 按照ID排序，确保按发送顺序转发
+    messages = sorted(messages, key=lambda m: m.id)
+    
+    # 按群组，将相同albumID的消息分组
+    album_groups = {}
+    units = []
+    
+    for message in messages:
+        # 如果消息是相册的一部分
+        if hasattr(message, 'grouped_id') and message.grouped_id:
+            if message.grouped_id not in album_groups:
+                album_groups[message.grouped_id] = []
+                units.append(album_groups[message.grouped_id])
+            album_groups[message.grouped_id].append(message)
+        else:
+            units.append([message])
+    
+    # 各目标按最大消息ID去重，发送单元必须保持源顺序
+    return units
+
+async def fetch_new_messages(client: TelegramClient, source_chat_id: int, last_id: int) -> List[Message]:
+    """从源群组/频道拉取 last_id 之后的消息（从旧到新）"""
+    # reverse=True 保证从 last_id 之后最旧的消息开始，积压时不会跳过
+    source_fetch_calls[source_chat_id] = source_fetch_calls.get(source_chat_id, 0) + 1
+    return await client.get_messages(
+        source_chat_id,
+        limit=FETCH_PAGE_SIZE,
+        min_id=last_id,
+        reverse=True
+    )
+
+def remember_forwarded(checkpoint: Tuple[int, int], source_message_id: int, target_message_id: int):
+    """记录 (源, 目标) 下源消息ID对应的目标消息ID，写入会在后台批量提交"""
+    id_map = forwarded_message_ids.setdefault(checkpoint, OrderedDict())
+    target_ids = id_map.setdefault(source_message_id, [])
+    if target_message_id in target_ids:
+        return
+    target_ids.append(target_message_id)
+    id_map.move_to_end(source_message_id)
+    if len(id_map) > FORWARDED_ID_LIMIT:
+        id_map.popitem(last=False)
+    dirty_message_map.append((checkpoint[0], checkpoint[1], source_message_id, target_message_id))
+
+def _query_forwarded(checkpoint: Tuple[int, int], source_message_ids: List[int]) -> List[Tuple[int, int]]:
+    conn = open_database()
+    placeholders = ",".join("?" * len(source_message_ids))
+    with db_lock:
+        return conn.execute(
+            "SELECT source_msg_id, target_msg_id FROM message_map "
+            f"WHERE source_chat_id = ? AND target_chat_id = ? AND source_msg_id IN ({placeholders})",
+            (checkpoint[0], checkpoint[1], *source_message_ids)
+        ).fetchall()
+
+async def find_forwarded(checkpoint: Tuple[int, int], source_message_ids: List[int]) -> Dict[int, List[int]]:
+    """查找源消息在目标中对应的消息ID（先查内存，再查数据库索引）"""
+    result: Dict[int, List[int]] = {}
+    missing = []
+    id_map = forwarded_message_ids.get(checkpoint, {})
+    for source_message_id in source_message_ids:
+        if source_message_id in id_map:
+            result[source_message_id] = list(id_map[source_message_id])
+        else:
+            missing.append(source_message_id)
+    
+    if missing:
+        for source_message_id, target_message_id in await asyncio.to_thread(_query_forwarded, checkpoint, missing):
+            result.setdefault(source_message_id, []).append(target_message_id)
+    return result
+
+async def lookup_forwarded(checkpoint: Tuple[int, int], source_message_id: int) -> Optional[int]:
+    """查找源消息在目标中对应的第一条消息ID"""
+    target_ids = (await find_forwarded(checkpoint, [source_message_id])).get(source_message_id)
+    return target_ids[0] if target_ids else None
+
+def _delete_forwarded(checkpoint: Tuple[int, int], source_message_ids: List[int]):
+    conn = open_database()
+    with db_lock, conn:
+        conn.executemany(
+            "DELETE FROM message_map WHERE source_chat_id = ? AND target_chat_id = ? AND source_msg_id = ?",
+            [(checkpoint[0], checkpoint[1], source_message_id) for source_message_id in source_message_ids]
+        )
+
+async def forget_forwarded(checkpoint: Tuple[int, int], source_message_ids: List[int]):
+    """删除源消息的ID对应关系"""
+    id_map = forwarded_message_ids.get(checkpoint, {})
+    for source_message_id in source_message_ids:
+        id_map.pop(source_message_id, None)
+    await asyncio.to_thread(_delete_forwarded, checkpoint, source_message_ids)
+
+def pair_sent_messages(source_messages: List[Message], sent) -> List[Tuple[int, int]]:
+    """把发出的消息和源消息按顺序对应起来，返回 (源消息ID, 目标消息ID) 列表"""
+    if sent is None:
+        return []
+    if not isinstance(sent, list):
+        sent = [sent]
+    return [(source.id, target.id) for source, target in zip(source_messages, sent) if target is not None]
+
+def media_key(media) -> Optional[Tuple[str, int]]:
+    """媒体缓存键：Telegram 图片/文件ID"""
+    if isinstance(media, MessageMediaPhoto) and media.photo:
+        return ("photo", media.photo.id)
+    if isinstance(media, MessageMediaDocument) and media.document:
+        return ("document", media.document.id)
+    return None
+
+def resolve_media(message: Message):
+    """优先使用已上传过的同一媒体，避免重复上传"""
+    key = media_key(message.media)
+    cached = media_cache.get(key) if key else None
+    if cached is None:
+        return message.media
+    input_media, stored_at = cached
+    if time.time() - stored_at > MEDIA_CACHE_TTL:
+        # 文件引用会过期，过期前主动淘汰
+        del media_cache[key]
+        return message.media
+    media_cache.move_to_end(key)
+    return input_media
+
+def remember_media(source_messages: List[Message], sent):
+    """记录源媒体第一次发出后得到的文件句柄，供其他目标和重复内容复用"""
+    if sent is None:
+        return
+    if not isinstance(sent, list):
+        sent = [sent]
+    for source, target in zip(source_messages, sent):
+        key = media_key(source.media)
+        if not key or key in media_cache or target is None or not target.media:
+            continue
+        try:
+            media_cache[key] = (utils.get_input_media(target.media), time.time())
+        except Exception:
+            continue
+        if len(media_cache) > MEDIA_CACHE_SIZE:
+            media_cache.popitem(last=False)
+
+def forget_media(messages: List[Message]):
+    """文件引用失效时淘汰缓存"""
+    for message in messages:
+        key = media_key(message.media)
+        if key:
+            media_cache.pop(key, None)
+
+def media_file_size(media) -> Optional[int]:
+    """文件大小（仅文件类媒体有准确大小，图片较小直接顺序下载）"""
+    if isinstance(media, MessageMediaDocument) and media.document:
+        return media.document.size
+    return None
+
+def media_file_name(media) -> str:
+    if isinstance(media, MessageMediaDocument) and media.document:
+        for attribute in media.document.attributes:
+            if isinstance(attribute, DocumentAttributeFilename):
+                return attribute.file_name
+        return "file"
+    return "photo.jpg"
+
+class MediaTransfer:
+    """受保护来源的媒体中转：分块并行下载到临时文件（mmap 写入，不整块放进内存），再分块并行上传"""
+    
+    def __init__(self):
+        # 媒体缓存键 -> 下载任务（结果为临时文件路径和大小），同一文件只下载一次
+        self.spools: Dict[Tuple[str, int], asyncio.Task] = {}
+        # 正在使用临时文件的发送数，归零后删除临时文件
+        self.users: Dict[Tuple[str, int], int] = {}
+        # 所有文件共享的分块并发数；下载和上传分开计数，预下载不会挤占当前的上传
+        self.download_slots = asyncio.Semaphore(TRANSFER_WORKERS)
+        self.upload_slots = asyncio.Semaphore(TRANSFER_WORKERS)
+    
+    def prefetch(self, client: TelegramClient, messages: List[Message]):
+        """提前下载下一个发送单元的媒体，与当前单元的上传重叠"""
+        for message in messages:
+            key = media_key(message.media)
+            if not key or key in self.spools or key in media_cache:
+                continue
+            # 清理已下载但没有被使用的临时文件
+            for old_key, old_task in list(self.spools.items()):
+                if len(self.spools) < TRANSFER_PREFETCH_LIMIT:
+                    break
+                if old_key not in self.users and old_task.done():
+                    self._discard(old_key, old_task)
+            if len(self.spools) >= TRANSFER_PREFETCH_LIMIT:
+                return
+            self.spools[key] = asyncio.create_task(self._download(client, message.media))
+    
+    async def reupload(self, client: TelegramClient, messages: List[Message]) -> list:
+        """下载并重新上传一组媒体，返回可直接发送的 InputMedia 列表"""
+        return list(await asyncio.gather(*(self._reupload_one(client, m) for m in messages)))
+    
+    async def _reupload_one(self, client: TelegramClient, message: Message):
+        key = media_key(message.media)
+        if not key:
+            return message.media
+        
+        task = self.spools.get(key)
+        if task is None or task.done() and (task.cancelled() or task.exception()):
+            task = self.spools[key] = asyncio.create_task(self._download(client, message.media))
+        self.users[key] = self.users.get(key, 0) + 1
+        try:
+            path, size = await asyncio.shield(task)
+            return await self._upload(client, message.media, path, size)
+        finally:
+            self.users[key] -= 1
+            if not self.users[key]:
+                del self.users[key]
+                self._discard(key, task)
+    
+    def _discard(self, key: Tuple[str, int], task: asyncio.Task):
+        if self.spools.get(key) is task:
+            del self.spools[key]
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled() and not task.exception():
+            try:
+                os.remove(task.result()[0])
+            except OSError:
+                pass
+    
+    async def _download(self, client: TelegramClient, media) -> Tuple[str, int]:
+        size = media_file_size(media)
+        fd, path = tempfile.mkstemp(prefix="teleporter-", dir=TRANSFER_SPOOL_DIR)
+        try:
+            with os.fdopen(fd, "r+b") as f:
+                if not size or size <= TRANSFER_PART_SIZE:
+                    async with self.download_slots:
+                        await client.download_media(media, file=f)
+                    size = f.tell()
+                else:
+                    f.truncate(size)
+                    with mmap.mmap(f.fileno(), size) as view:
+                        # 按分块切成几段，每段一个并行请求流
+                        parts = -(-size // TRANSFER_PART_SIZE)
+                        step = -(-parts // TRANSFER_WORKERS)
+                        await asyncio.gather(*(
+                            self._download_range(client, media.document, view, first, min(first + step, parts), size)
+                            for first in range(0, parts, step)
+                        ))
+                        view.flush()
+            return path, size
+        except BaseException:
+            os.remove(path)
+            raise
+    
+    async def _download_range(self, client: TelegramClient, document, view: mmap.mmap, first: int, last: int, size: int):
+        async with self.download_slots:
+            position = first * TRANSFER_PART_SIZE
+            async for chunk in client.iter_download(
+                document,
+                offset=position,
+                limit=last - first,
+                request_size=TRANSFER_PART_SIZE,
+                chunk_size=TRANSFER_PART_SIZE,
+                file_size=size
+            ):
+                record_api_call()
+                view[position:position + len(chunk)] = chunk
+                position += len(chunk)
+    
+    async def _upload(self, client: TelegramClient, media, path: str, size: int):
+        big = size > TRANSFER_BIG_FILE_SIZE
+        parts = max(-(-size // TRANSFER_PART_SIZE), 1)
+        file_id = helpers.generate_random_long()
+        
+        with open(path, "rb") as f, (mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else memoryview(b"")) as view:
+            async def save_part(part: int):
+                async with self.upload_slots:
+                    data = bytes(view[part * TRANSFER_PART_SIZE:(part + 1) * TRANSFER_PART_SIZE])
+                    if big:
+                        request = SaveBigFilePartRequest(file_id, part, parts, data)
+                    else:
+                        request = SaveFilePartRequest(file_id, part, data)
+                    record_api_call()
+                    if not await client(request):
+                        raise RuntimeError(f"上传分块 {part}/{parts} 失败")
+            
+            await asyncio.gather(*(save_part(part) for part in range(parts)))
+        
+        name = media_file_name(media)
+        if big:
+            uploaded = InputFileBig(file_id, parts, name)
+        else:
+            uploaded = InputFile(file_id, parts, name, "")
+        
+        if isinstance(media, MessageMediaPhoto):
+            return InputMediaUploadedPhoto(file=uploaded)
+        return InputMediaUploadedDocument(
+            file=uploaded,
+            mime_type=media.document.mime_type,
+            attributes=media.document.attributes
+        )
+
+media_transfer: Optional[MediaTransfer] = None
+
+def _moved_entity(entity, offset: int, length: int):
+    moved = copy.copy(entity)
+    moved.offset = offset
+    moved.length = length
+    return moved
+
+def prefix_formatted_text(prefix: str, text: str, entities) -> Tuple[str, list]:
+    """在带格式的文本前加前缀，实体按前缀的 UTF-16 长度后移"""
+    shift = len(helpers.add_surrogate(prefix))
+    return prefix + text, [_moved_entity(e, e.offset + shift, e.length) for e in entities or []]
+
+def split_formatted_text(text: str, entities, first_limit: int, limit: int = MESSAGE_LENGTH_LIMIT) -> List[Tuple[str, list]]:
+    """按长度上限拆分带格式的文本，尽量在换行或空格处断开；实体裁剪到各片段并调整偏移（均按 UTF-16 计）"""
+    # 代理对形式下 Python 的字符串长度和下标与 Telegram 的 UTF-16 偏移一致
+    text = helpers.add_surrogate(text or "")
+    chunks = []
+    start = 0
+    chunk_limit = first_limit
+    while True:
+        end = next_start = len(text)
+        if end - start > chunk_limit:
+            end = next_start = start + chunk_limit
+            # 不把代理对拆开
+            if "\ud800" <= text[end - 1] <= "\udbff":
+                end = next_start = end - 1
+            # 后半段内（含紧接上限的位置）有换行或空格时在那里断开，分隔符本身不保留
+            for separator in ("\n", " "):
+                cut = text.rfind(separator, start + chunk_limit // 2, end + 1)
+                if cut > start:
+                    end, next_start = cut, cut + 1
+                    break
+        
+        chunk_entities = []
+        for entity in entities or []:
+            entity_start = max(entity.offset, start)
+            entity_end = min(entity.offset + entity.length, end)
+            if entity_start < entity_end:
+                chunk_entities.append(_moved_entity(entity, entity_start - start, entity_end - entity_start))
+        chunks.append((helpers.del_surrogate(text[start:end]), chunk_entities))
+        
+        start = next_start
+        chunk_limit = limit
+        if start >= len(text):
+            return chunks
+
+def send_random_id(source_chat_id: int, target_chat_id: int, message_id: Union[int, str], part: int = 0) -> int:
+    """由 (源, 目标, 源消息ID或合并的消息ID列表, 分段) 确定的 random_id：同一条消息再次发送时服务端按它去重"""
+    key = f"{source_chat_id}:{target_chat_id}:{message_id}:{part}:{send_salt.get()}"
+    return int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], "big", signed=True)
+
+def response_messages(result, random_ids: List[int]) -> List[Optional[Message]]:
+    """从发送请求返回的更新中按 random_id 的顺序取出发出的消息（只用到消息ID和媒体，不需要关联客户端）"""
+    if isinstance(result, UpdateShortSentMessage):
+        # 私聊的精简结果只有消息ID和媒体
+        return [Message(id=result.id, peer_id=None, date=result.date, message="", media=result.media)]
+    
+    updates = getattr(result, "updates", None) or []
+    sent_ids = {update.random_id: update.id for update in updates if isinstance(update, UpdateMessageID)}
+    sent = {}
+    for update in updates:
+        if isinstance(update, (UpdateNewMessage, UpdateNewChannelMessage)):
+            sent[update.message.id] = update.message
+    return [sent.get(sent_ids.get(random_id)) for random_id in random_ids]
+
+async def send_request(client: TelegramClient, request, random_ids: List[int]) -> List[Optional[Message]]:
+    """发送带 random_id 的原始请求；random_id 重复说明上次已经发出（崩溃或重试前），不会再发一份"""
+    try:
+        result = await client(request)
+    except RandomIdDuplicateError:
+        logger.info(f"消息此前已发出，服务端按 random_id 去重，跳过 {len(random_ids)} 条")
+        return [None] * len(random_ids)
+    return response_messages(result, random_ids)
+
+async def send_copy(client: TelegramClient, target_chat_id: int, text: str, entities: list, media, random_id: int,
+                    silent: Optional[bool] = None, reply_to: Optional[int] = None) -> Optional[Message]:
+    """复制发送一条消息（最多带一个媒体），格式实体原样传递"""
+    peer = await client.get_input_entity(target_chat_id)
+    reply = InputReplyToMessage(reply_to_msg_id=reply_to) if reply_to else None
+    if media is None:
+        request = SendMessageRequest(peer=peer, message=text, random_id=random_id, entities=entities,
+                                     reply_to=reply, silent=silent)
+    else:
+        request = SendMediaRequest(peer=peer, media=utils.get_input_media(media), message=text, random_id=random_id,
+                                   entities=entities, reply_to=reply, silent=silent)
+    return (await send_request(client, request, [random_id]))[0]
+
+async def send_album_copy(client: TelegramClient, target_chat_id: int, media_files: list, caption: str, entities: list,
+                          random_ids: List[int], silent: Optional[bool] = None) -> List[Optional[Message]]:
+    """复制发送一个相册，标题放在第一个媒体上"""
+    peer = await client.get_input_entity(target_chat_id)
+    multi_media = []
+    for index, (media, random_id) in enumerate(zip(media_files, random_ids)):
+        media = utils.get_input_media(media)
+        if isinstance(media, (InputMediaUploadedPhoto, InputMediaUploadedDocument)):
+            # 相册只接受服务器上已有的媒体，重新上传的文件先换成照片/文件引用
+            record_api_call()
+            media = utils.get_input_media(await client(UploadMediaRequest(peer=peer, media=media)))
+        multi_media.append(InputSingleMedia(
+            media=media,
+            random_id=random_id,
+            message=caption if index == 0 else "",
+            entities=entities if index == 0 else None
+        ))
+    return await send_request(client, SendMultiMediaRequest(peer=peer, multi_media=multi_media, silent=silent), random_ids)
+
+async def send_text_chunks(client: TelegramClient, target_chat_id: int, priority: int, chunks: List[Tuple[str, list]],
+                           random_ids: List[int], silent: Optional[bool] = None, reply_to: Optional[int] = None) -> List[Message]:
+    """发送拆分后剩余的文本片段（接在媒体或第一段之后）"""
+    sent = []
+    for (text, entities), random_id in zip(chunks, random_ids):
+        message = await send_with_rate_limit(target_chat_id, priority, lambda: send_copy(
+            client, target_chat_id, text, entities, None, random_id, silent, reply_to
+        ))
+        if message is not None:
+            sent.append(message)
+    return sent
+
+async def send_digest(client: TelegramClient, source_chat_id: int, target_chat_id: int, messages: List[Message],
+                      priority: int, rewrite=None, prefix: str = "", reply_to: Optional[int] = None) -> List[Message]:
+    """把多条短文本消息合并为一条发送（超长时拆分）
+    
+    random_id 由全部消息ID确定：重放时重新分组的合并消息不会沿用之前另一组的 random_id 而被服务端当作重复丢弃
+    """
+    text, entities = prefix, []
+    for message in messages:
+        body = rewrite(message.message) if rewrite else message.message
+        line_prefix = (text + DIGEST_SEPARATOR if text != prefix else text) + digest_line_prefix(message)
+        text, moved = prefix_formatted_text(line_prefix, body, message.entities if body == message.message else None)
+        entities += moved
+    
+    chunks = split_formatted_text(text, entities, MESSAGE_LENGTH_LIMIT)
+    digest_key = ",".join(str(m.id) for m in messages)
+    random_ids = [send_random_id(source_chat_id, target_chat_id, digest_key, part) for part in range(len(chunks))]
+    sent = await send_text_chunks(client, target_chat_id, priority, chunks, random_ids,
+                                  all(m.silent for m in messages), reply_to)
+    record_delivered(messages, priority)
+    return sent
+
+async def send_media_messages(client: TelegramClient, target_chat_id: int, priority: int,
+                              media_messages: List[Message], send):
+    """发送带媒体的消息：优先用缓存的文件句柄，其次直接引用源媒体，都失败时下载后重新上传"""
+    global media_transfer
+    
+    source_files = [m.media for m in media_messages]
+    cached_files = [resolve_media(m) for m in media_messages]
+    protected = any(getattr(m, 'noforwards', False) for m in media_messages)
+    
+    # 受保护的源不能直接引用其媒体，除非全部命中缓存（缓存的是自己发出的副本）
+    attempts = []
+    journal_files = take_journal_uploads(target_chat_id, media_messages)
+    if journal_files:
+        # 重放上次未完成的发送：沿用当时已上传的文件
+        attempts.append(journal_files)
+    if any(c is not s for c, s in zip(cached_files, source_files)):
+        if not protected or all(c is not s for c, s in zip(cached_files, source_files)):
+            attempts.append(cached_files)
+    if not protected:
+        attempts.append(source_files)
+    
+    for files in attempts:
+        try:
+            return await send_with_rate_limit(target_chat_id, priority, lambda: send(files))
+        except DIRECT_MEDIA_ERRORS as e:
+            # 缓存的文件引用失效或源禁止引用
+            forget_media(media_messages)
+            logger.info(f"直接发送媒体失败，尝试下一种方式: {e}")
+    
+    if media_transfer is None:
+        media_transfer = MediaTransfer()
+    files = await media_transfer.reupload(client, media_messages)
+    await journal_uploads(target_chat_id, media_messages, files)
+    return await send_with_rate_limit(target_chat_id, priority, lambda: send(files))
+
+async def forward_messages(client: TelegramClient, target_chat_id: int, messages: List[Message],
+                           priority: int = PRIORITY_LIVE, rewrite=None) -> List[Tuple[int, int]]:
+    """转发一个发送单元（一个相册或一条独立消息）到目标群组/频道，返回 (源消息ID, 目标消息ID) 列表；rewrite 为规则的文本改写"""
+    rewrite = rewrite or (lambda text: text)
+    source_chat_id = utils.get_peer_id(messages[0].peer_id)
+    
+    def formatted(message: Message, limit: int) -> List[Tuple[str, list]]:
+        # 原样使用源消息的格式实体，不再解析 Markdown；文本被改写后原实体的偏移失效，按纯文本发送
+        text = rewrite(message.message)
+        return split_formatted_text(text, message.entities if text == message.message else None, limit)
+    
+    # 相册（多媒体组）
+    if len(messages) > 1 or messages[0].grouped_id:
+        # 排序相册消息
+        album_messages = sorted(messages, key=lambda m: m.id)
+        
+        # 从相册中提取所有媒体文件
+        media_messages = []
+        caption_message = None
+        
+        for msg in album_messages:
+            if msg.media:
+                media_messages.append(msg)
+                # 使用第一个有文本的消息作为标题
+                if not caption_message and msg.message:
+                    caption_message = msg
+        
+        if not media_messages:
+            return []
+        
+        chunks = formatted(caption_message, CAPTION_LENGTH_LIMIT) if caption_message else [("", [])]
+        caption, caption_entities = chunks[0]
+        random_ids = [send_random_id(source_chat_id, target_chat_id, m.id) for m in media_messages]
+        
+        # 一次性发送整个相册
+        sent = await send_media_messages(client, target_chat_id, priority, media_messages, lambda media_files: send_album_copy(
+            client, target_chat_id, media_files, caption, caption_entities, random_ids, album_messages[0].silent
+        ))
+        # 超长标题的剩余部分作为文本接在相册之后
+        extra = await send_text_chunks(
+            client, target_chat_id, priority, chunks[1:],
+            [send_random_id(source_chat_id, target_chat_id, caption_message.id, part) for part in range(1, len(chunks))],
+            album_messages[0].silent
+        )
+        remember_media(media_messages, sent)
+        record_delivered(media_messages, priority)
+        return pair_sent_messages(media_messages, sent) + [(caption_message.id, m.id) for m in extra]
+    
+    message = messages[0]
+    
+    # 不转发系统消息、表情包和投票
+    if message.action or not message.message and not message.media:
+        return []
+    
+    # 转发消息（无引用）
+    with_file = message.media and not message.web_preview
+    chunks = formatted(message, CAPTION_LENGTH_LIMIT if with_file else MESSAGE_LENGTH_LIMIT)
+    text, entities = chunks[0]
+    if not text and not message.media:
+        return []
+    random_ids = [send_random_id(source_chat_id, target_chat_id, message.id, part) for part in range(len(chunks))]
+    send = lambda media_files: send_copy(
+        client, target_chat_id, text, entities, media_files[0] if media_files else None, random_ids[0], message.silent
+    )
+    # 链接预览不是可发送的媒体，由服务端重新生成
+    if with_file:
+        sent = await send_media_messages(client, target_chat_id, priority, [message], send)
+    else:
+        sent = await send_with_rate_limit(target_chat_id, priority, lambda: send([]))
+    extra = await send_text_chunks(client, target_chat_id, priority, chunks[1:], random_ids[1:], message.silent)
+    remember_media([message], sent)
+    record_delivered([message], priority)
+    return pair_sent_messages([message], sent) + [(message.id, m.id) for m in extra]
+
+async def resolve_comment_thread(client: TelegramClient, source_chat_id: int, discussion_chat_id: int, top_message_id: int) -> Optional[int]:
+    """讨论组中的帖子ID -> 源频道帖子ID（频道帖子会自动转发到讨论组作为评论串的起点）"""
+    key = (discussion_chat_id, top_message_id)
+    if key not in comment_thread_posts:
+        top_message = await client.get_messages(discussion_chat_id, ids=top_message_id)
+        remember_comment_thread(source_chat_id, discussion_chat_id, top_message)
+        comment_thread_posts.setdefault(key, None)
+    return comment_thread_posts[key]
+
+def remember_comment_thread(source_chat_id: int, discussion_chat_id: int, message: Optional[Message]) -> bool:
+    """如果消息是频道帖子自动转发到讨论组的副本，记录其对应的源帖子ID"""
+    fwd = getattr(message, 'fwd_from', None)
+    if not fwd or message.reply_to or not fwd.channel_post or not fwd.from_id:
+        return False
+    if utils.get_peer_id(fwd.from_id) != source_chat_id:
+        return False
+    
+    comment_thread_posts[(discussion_chat_id, message.id)] = fwd.channel_post
+    if len(comment_thread_posts) > FORWARDED_ID_LIMIT:
+        comment_thread_posts.popitem(last=False)
+    return True
+
+async def forward_comment_messages(client: TelegramClient, source_chat_id: int, target_chat_ids: List[int]):
+    """转发频道评论区消息：分页追到最新，按帖子分组，作为回复挂到目标中对应的帖子下"""
+    try:
+        # 尝试获取频道的评论区
+        try:
+            # 频道信息和讨论组ID基本不变，使用缓存
+            chat_info = await get_chat_info(client, source_chat_id)
+            
+            # 只有链接了讨论组的频道才有评论区
+            if not chat_info["broadcast"] or not chat_info["linked_chat_id"]:
+                return 0
+            discussion_chat_id = chat_info["linked_chat_id"]
+            
+            # 每个目标各自的评论检查点，从最落后的目标开始拉取
+            target_last_ids = {
+                target_chat_id: last_message_ids.get((discussion_chat_id, target_chat_id), 0)
+                for target_chat_id in target_chat_ids
+            }
+            cursor = min(target_last_ids.values())
+            
+            # 分页拉取，直到追上最新评论（单轮有上限，剩余的下一轮继续）
+            pass_ids = []
+            threads: Dict[int, List[Message]] = {}
+            while len(pass_ids) < COMMENT_PASS_LIMIT:
+                page = await client.get_messages(
+                    discussion_chat_id,
+                    limit=COMMENT_PAGE_SIZE,
+                    min_id=cursor,
+                    reverse=True
+                )
+                if not page:
+                    break
+                if trace_recorder:
+                    trace_recorder.record_messages(discussion_chat_id, page, source_chat_id)
+                
+                for message in page:
+                    pass_ids.append(message.id)
+                    # 频道帖子的自动转发副本：记录评论串对应的帖子，本身不转发
+                    if remember_comment_thread(source_chat_id, discussion_chat_id, message):
+                        continue
+                    # 跳过系统消息和空消息
+                    if message.action or not message.message and not message.media:
+                        continue
+                    
+                    reply_to = message.reply_to
+                    top_id = (reply_to.reply_to_top_id or reply_to.reply_to_msg_id) if reply_to else 0
+                    threads.setdefault(top_id, []).append(message)
+                
+                cursor = page[-1].id
+                if len(page) < COMMENT_PAGE_SIZE:
+                    break
+            
+            if not pass_ids:
+                return 0
+            
+            # 按评论串分组发送；检查点只推进到之前的消息都已处理的位置
+            pass_ids.sort()
+            processed: Set[int] = set(pass_ids) - {m.id for thread in threads.values() for m in thread}
+            
+            # 合并模式的目标：本评论串中攒下、尚未发出的短评论
+            digests: Dict[int, List[Message]] = {}
+            
+            async def flush_digest(target_chat_id: int, post_id: Optional[int]) -> int:
+                messages = digests.pop(target_chat_id)
+                rule_name = find_rule_name(source_chat_id, target_chat_id)
+                rule_filter = get_rule_filter(rule_name)
+                reply_to_id = await lookup_forwarded((source_chat_id, target_chat_id), post_id) if post_id else None
+                rule_token = current_rule.set(rule_name)
+                try:
+                    await send_digest(client, discussion_chat_id, target_chat_id, messages, PRIORITY_COMMENT,
+                                      rule_filter.rewrite if rule_filter else None, COMMENT_PREFIX, reply_to_id)
+                    return len(messages)
+                except Exception as e:
+                    record_failure(e, [m.id for m in messages])
+                    logger.error(f"转发合并评论失败 (ID: {messages[0].id}-{messages[-1].id}): {e}")
+                    return 0
+                finally:
+                    current_rule.reset(rule_token)
+            
+            forwarded_count = 0
+            for top_id, comments in threads.items():
+                post_id = await resolve_comment_thread(client, source_chat_id, discussion_chat_id, top_id) if top_id else None
+                
+                for message in comments:
+                    for target_chat_id in target_chat_ids:
+                        if message.id <= target_last_ids[target_chat_id]:
+                            continue
+                        
+                        rule_name = find_rule_name(source_chat_id, target_chat_id)
+                        rule_filter = get_rule_filter(rule_name)
+                        if rule_filter and not rule_filter.accepts([message]):
+                            rule_token = current_rule.set(rule_name)
+                            record_filtered()
+                            current_rule.reset(rule_token)
+                            continue
+                        
+                        # 合并模式：直接回复帖子的短评论先攒着，按时间窗口和长度上限合并发送（楼中楼单独发送）
+                        digest_settings = get_digest_settings(rule_name)
+                        if digest_settings:
+                            mergeable = is_digest_message(message) and not (message.reply_to and message.reply_to.reply_to_top_id)
+                            pending = digests.get(target_chat_id)
+                            if pending and (not mergeable
+                                            or sum(map(digest_line_length, pending + [message])) > digest_settings["size"]
+                                            or (message.date - pending[0].date).total_seconds() > digest_settings["window"]):
+                                forwarded_count += await flush_digest(target_chat_id, post_id)
+                            if mergeable:
+                                digests.setdefault(target_chat_id, []).append(message)
+                                continue
+                        text = rule_filter.rewrite(message.message) if rule_filter else message.message
+                        chunks = split_formatted_text(
+                            *prefix_formatted_text(COMMENT_PREFIX, text, message.entities if text == message.message else None),
+                            CAPTION_LENGTH_LIMIT if message.media and not message.web_preview else MESSAGE_LENGTH_LIMIT
+                        )
+                        
+                        # 回复目标中对应的评论（楼中楼）或帖子
+                        reply_to_id = None
+                        if message.reply_to and message.reply_to.reply_to_top_id:
+                            reply_to_id = await lookup_forwarded((discussion_chat_id, target_chat_id), message.reply_to.reply_to_msg_id)
+                        if reply_to_id is None and post_id:
+                            reply_to_id = await lookup_forwarded((source_chat_id, target_chat_id), post_id)
+                        
+                        # 转发消息
+                        rule_token = current_rule.set(rule_name)
+                        try:
+                            random_ids = [send_random_id(discussion_chat_id, target_chat_id, message.id, part)
+                                          for part in range(len(chunks))]
+                            send = lambda media_files: send_copy(
+                                client, target_chat_id, chunks[0][0], chunks[0][1], media_files[0] if media_files else None,
+                                random_ids[0], message.silent, reply_to_id
+                            )
+                            if message.media and not message.web_preview:
+                                sent = await send_media_messages(client, target_chat_id, PRIORITY_COMMENT, [message], send)
+                            else:
+                                sent = await send_with_rate_limit(target_chat_id, PRIORITY_COMMENT, lambda: send([]))
+                            extra = await send_text_chunks(client, target_chat_id, PRIORITY_COMMENT, chunks[1:],
+                                                           random_ids[1:], message.silent, reply_to_id)
+                            forwarded_count += 1
+                            record_delivered([message], PRIORITY_COMMENT)
+                            for source_id, target_id in pair_sent_messages([message], sent) + [(message.id, m.id) for m in extra]:
+                                remember_forwarded((discussion_chat_id, target_chat_id), source_id, target_id)
+                        except Exception as e:
+                            record_failure(e, [message.id])
+                            logger.error(f"转发评论消息失败 (ID: {message.id}): {e}")
+                        finally:
+                            current_rule.reset(rule_token)
+                    
+                    processed.add(message.id)
+                
+                for target_chat_id in list(digests):
+                    forwarded_count += await flush_digest(target_chat_id, post_id)
+                
+                # 更新最后处理的消息ID
+                watermark = 0
+                for message_id in pass_ids:
+                    if message_id not in processed:
+                        break
+                    watermark = message_id
+                for target_chat_id in target_chat_ids:
+                    advance_checkpoint((discussion_chat_id, target_chat_id), watermark)
+            
+            # 只有自动转发副本和系统消息时也要推进检查点
+            for target_chat_id in target_chat_ids:
+                advance_checkpoint((discussion_chat_id, target_chat_id), pass_ids[-1])
+            
+            return forwarded_count
+        except ChannelPrivateError as e:
+            # 失去频道或讨论组的访问权限，下次重新解析
+            invalidate_chat_info(source_chat_id)
+            logger.error(f"获取评论区失败: {e}")
+        except Exception as e:
+            logger.error(f"获取评论区失败: {e}")
+        
+        return 0
+    except Exception as e:
+        logger.error(f"转发评论失败: {e}")
+        return 0
+
+def is_forwardable(message: Message) -> bool:
+    """消息是否需要转发（不转发系统消息、表情包和投票）"""
+    return not (message.action or not message.message and not message.media)
+
+async def forward_native_batch(client: TelegramClient, source_chat_id: int, target_chat_id: int,
+                               units: List[List[Message]], priority: int = PRIORITY_LIVE,
+                               drop_captions: bool = False) -> List[Tuple[int, int]]:
+    """服务端批量转发（隐藏来源，不重新上传媒体），一次请求最多转发100条消息，返回 (源消息ID, 目标消息ID) 列表"""
+    messages = [m for unit in units for m in unit if is_forwardable(m)]
+    if not messages:
+        return []
+    
+    async def forward(batch: List[Message]) -> List[Optional[Message]]:
+        # 同一请求内的相册消息会保持为相册
+        random_ids = [send_random_id(source_chat_id, target_chat_id, m.id) for m in batch]
+        request = ForwardMessagesRequest(
+            from_peer=await client.get_input_entity(source_chat_id),
+            id=[m.id for m in batch],
+            random_id=random_ids,
+            to_peer=await client.get_input_entity(target_chat_id),
+            silent=units[0][0].silent,
+            drop_author=True,
+            drop_media_captions=drop_captions
+        )
+        if len(batch) == len(messages) and len(units) > 1:
+            # 整批中只要有一条上次已发出，服务端就拒绝整个请求，交给下面按发送单元逐个重发
+            return response_messages(await client(request), random_ids)
+        return await send_request(client, request, random_ids)
+    
+    try:
+        sent = await send_with_rate_limit(target_chat_id, priority, lambda: forward(messages))
+    except RandomIdDuplicateError:
+        sent = []
+        for unit in units:
+            batch = [m for m in unit if is_forwardable(m)]
+            if batch:
+                sent += await send_with_rate_limit(target_chat_id, priority, lambda: forward(batch))
+    record_delivered(messages, priority)
+    return pair_sent_messages(messages, sent)
+
+class AlbumAssembler:
+    """流式相册组装：按源顺序输出发送单元，相册凑齐（或等待超时）后才整体输出"""
+    
+    def __init__(self):
+        # 尚未确认完整的相册（总在已处理消息的末尾）
+        self.pending: List[Message] = []
+        self.pending_since = 0.0
+    
+    def reset(self):
+        self.pending = []
+    
+    def feed(self, messages: List[Message], complete: bool = False) -> List[List[Message]]:
+        """输入一批按ID排序的消息，返回已完整的发送单元；complete 表示本批末尾的相册已完整"""
+        units = []
+        for message in sorted(messages, key=lambda m: m.id):
+            if self.pending and message.grouped_id != self.pending[0].grouped_id:
+                units.append(self.pending)
+                self.pending = []
+            
+            if not message.grouped_id:
+                units.append([message])
+                continue
+            
+            if not self.pending:
+                self.pending_since = time.monotonic()
+            self.pending.append(message)
+            # 一个相册最多10条
+            if len(self.pending) >= ALBUM_MAX_SIZE:
+                units.append(self.pending)
+                self.pending = []
+        
+        if complete:
+            units.extend(self.flush())
+        return units
+    
+    def flush(self) -> List[List[Message]]:
+        """输出等待中的相册"""
+        units = [self.pending] if self.pending else []
+        self.pending = []
+        return units
+    
+    def hold_remaining(self) -> Optional[float]:
+        """等待中的相册还能再等多少秒"""
+        if not self.pending:
+            return None
+        return max(0.0, self.pending_since + ALBUM_HOLD_SECONDS - time.monotonic())
+
+class SourceWorker:
+    """单个源群组/频道的拉取和相册分组阶段：每轮只拉取一次，再分发到该源的所有规则"""
+    
+    def __init__(self, client: TelegramClient, source_chat_id: int, session_name: str = ADMIN_SESSION):
+        self.client = client
+        self.source_chat_id = source_chat_id
+        self.session_name = session_name
+        
+        # 该源下的规则流水线
+        self.rules: Dict[str, "RuleWorker"] = {}
+        
+        # 拉取阶段 -> 分组阶段：每项是 (优先级, 一批原始消息, 末尾相册是否完整, 拉取代数)
+        self.message_queue: asyncio.Queue = asyncio.Queue(maxsize=MESSAGE_QUEUE_SIZE)
+        self.assembler = AlbumAssembler()
+        
+        # 已拉取（已进入流水线）的最大消息ID，加入第一条规则时确定
+        self.fetched_id: Optional[int] = None
+        # 每次退回拉取位置加一，退回前拉取的旧批次不再发给重新同步的规则
+        self.generation = 0
+        self.assembled_generation = 0
+        # 实时推送收到、尚未进入流水线的消息
+        self.pushed_messages: Dict[int, Message] = {}
+        # 推送或拉取中见到的最大消息ID，随更新状态一起保存
+        self.seen_id = 0
+        self.sweep_requested = True
+        self.fetch_event = asyncio.Event()
+        self.fetch_event.set()
+        
+        # 评论区转发数
+        self.forwarded_count = 0
+        self.tasks: List[asyncio.Task] = []
+    
+    def start(self):
+        """启动拉取、分组和评论区任务"""
+        self.tasks = [
+            asyncio.create_task(self._fetch_loop()),
+            asyncio.create_task(self._group_loop()),
+            asyncio.create_task(self._comment_loop()),
+        ]
+    
+    def stop(self):
+        """停止该源的所有任务"""
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+    
+    def add_rule(self, worker: "RuleWorker"):
+        """加入一条规则；新规则落后时从它的检查点重新拉取"""
+        self.rules[worker.rule_name] = worker
+        if worker.ready:
+            self.resync(worker)
+    
+    def remove_rule(self, rule_name: str):
+        self.rules.pop(rule_name, None)
+    
+    def resync(self, worker: "RuleWorker"):
+        """从规则的位置重新拉取，该规则只接收重新拉取之后的批次，其他规则自动去重"""
+        if self.fetched_id is None or worker.enqueued_id < self.fetched_id:
+            self.fetched_id = worker.enqueued_id
+            self.generation += 1
+        worker.min_generation = self.generation
+        self.request_sweep()
+    
+    def push(self, messages: List[Message]):
+        """接收实时推送的新消息"""
+        for message in messages:
+            self.pushed_messages[message.id] = message
+            self.seen_id = max(self.seen_id, message.id)
+        
+        # 下游积压太多时丢弃推送缓存，之后从检查点重新拉取，保证内存有界
+        if len(self.pushed_messages) > PUSH_BUFFER_SIZE:
+            self.pushed_messages.clear()
+            self.sweep_requested = True
+        self.fetch_event.set()
+    
+    def request_sweep(self):
+        """请求一次兜底拉取"""
+        self.sweep_requested = True
+        self.fetch_event.set()
+    
+    async def _enqueue(self, messages: List[Message], priority: int, complete: bool, generation: int):
+        """把一批消息送入分组阶段（队列满时等待，形成背压）"""
+        if generation != self.generation:
+            return
+        self.fetched_id = max(self.fetched_id, max(m.id for m in messages))
+        self.seen_id = max(self.seen_id, self.fetched_id)
+        if trace_recorder:
+            trace_recorder.record_messages(self.source_chat_id, messages)
+        await self.message_queue.put((priority, messages, complete, generation))
+    
+    async def _ingest(self):
+        """拉取阶段：优先使用推送的消息，有缺口或兜底扫描时才调用接口拉取"""
+        if self.fetched_id is None:
+            return
+        
+        pushed = sorted(
+            (m for m in self.pushed_messages.values() if m.id > self.fetched_id),
+            key=lambda m: m.id
+        )
+        self.pushed_messages.clear()
+        
+        # 推送的消息紧接检查点时直接使用，无需任何接口调用（推送的相册总是完整的）
+        if pushed and not self.sweep_requested and self.fetched_id and pushed[0].id == self.fetched_id + 1:
+            await self._enqueue(pushed, PRIORITY_LIVE, True, self.generation)
+            return
+        
+        self.sweep_requested = False
+        while self.rules:
+            # 整页积压按补发处理，让位于其他规则的实时消息
+            generation = self.generation
+            messages = await fetch_new_messages(self.client, self.source_chat_id, self.fetched_id)
+            if generation != self.generation:
+                # 拉取期间位置被退回，丢弃本页从新位置重新拉取
+                continue
+            if not messages:
+                break
+            backlog = len(messages) >= FETCH_PAGE_SIZE
+            await self._enqueue(messages, PRIORITY_BACKFILL if backlog else PRIORITY_LIVE, False, generation)
+            if not backlog:
+                break
+    
+    async def _fetch_loop(self):
+        """拉取阶段"""
+        current_session.set(self.session_name)
+        while True:
+            await self.fetch_event.wait()
+            gate = catch_up_gates.get(self.session_name)
+            if gate:
+                await gate.wait()
+            self.fetch_event.clear()
+            try:
+                await self._ingest()
+            except FloodWaitError as e:
+                logger.info(f"源 {self.source_chat_id} 拉取消息需要等待 {e.seconds} 秒")
+                await asyncio.sleep(e.seconds)
+                self.request_sweep()
+            except ChannelPrivateError as e:
+                invalidate_chat_info(self.source_chat_id)
+                logger.error(f"源 {self.source_chat_id} 获取消息失败: {e}")
+                # 该账号失去了源的访问权限，把这个源的规则迁移到其他账号
+                # 每条规则都要记下该账号，不能在第一条可迁移的规则处短路
+                movable = []
+                for rule_name in list(self.rules):
+                    movable.append(session_pool.exclude(rule_name, self.session_name))
+                if any(movable):
+                    schedule_rebalance(f"账号 {self.session_name} 无法访问源 {self.source_chat_id}")
+            except Exception as e:
+                logger.error(f"源 {self.source_chat_id} 获取消息失败: {e}")
+    
+    def _dispatch(self, priority: int, units: List[List[Message]], generation: int):
+        for unit in units:
+            for worker in list(self.rules.values()):
+                worker.offer(priority, unit, generation)
+    
+    async def _group_loop(self):
+        """相册分组阶段：流式组装相册，分组一次，分发到所有目标"""
+        priority = PRIORITY_LIVE
+        while True:
+            try:
+                item = await asyncio.wait_for(self.message_queue.get(), self.assembler.hold_remaining())
+            except asyncio.TimeoutError:
+                # 等不到相册的剩余部分，按现有部分发送
+                self._dispatch(priority, self.assembler.flush(), self.assembled_generation)
+                continue
+            
+            priority, messages, complete, generation = item
+            try:
+                if generation != self.assembled_generation:
+                    # 位置被退回：等待中的相册会被重新拉取
+                    self.assembler.reset()
+                    self.assembled_generation = generation
+                self._dispatch(priority, self.assembler.feed(messages, complete), generation)
+            finally:
+                self.message_queue.task_done()
+    
+    async def _comment_loop(self):
+        """评论区转发"""
+        current_session.set(self.session_name)
+        while True:
+            # 新规则确定评论区起点之前不参与
+            target_chat_ids = sorted({worker.target_chat_id for worker in self.rules.values() if worker.ready})
+            if target_chat_ids:
+                forwarded = await forward_comment_messages(self.client, self.source_chat_id, target_chat_ids)
+                if forwarded:
+                    logger.info(f"源 {self.source_chat_id} 转发了 {forwarded} 条评论")
+                    self.forwarded_count += forwarded
+            await asyncio.sleep(POLL_INTERVAL)
+
+def chunk_units(units: List[List[Message]], size: int) -> List[List[List[Message]]]:
+    """把发送单元切成每批不超过 size 条消息的批次（相册不拆分）"""
+    batches = []
+    batch = []
+    count = 0
+    for unit in units:
+        if batch and count + len(unit) > size:
+            batches.append(batch)
+            batch = []
+            count = 0
+        batch.append(unit)
+        count += len(unit)
+    if batch:
+        batches.append(batch)
+    return batches
+
+class RuleWorker:
+    """单条规则（源 -> 目标）的发送阶段，有自己的有界队列和检查点"""
+    
+    def __init__(self, client: TelegramClient, rule_name: str, source_chat_id: int, target_chat_id: int,
+                 session_name: str = ADMIN_SESSION):
+        self.client = client
+        self.session_name = session_name
+        self.rule_name = rule_name
+        self.source_chat_id = source_chat_id
+        self.target_chat_id = target_chat_id
+        self.checkpoint = (source_chat_id, target_chat_id)
+        
+        # 分组阶段 -> 发送阶段：每项是 (优先级, 一个相册或一条独立消息)
+        self.send_queue: asyncio.Queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        
+        # 已进入发送队列的最大消息ID，用于去重
+        self.enqueued_id = last_message_ids.get(self.checkpoint, 0)
+        # 新规则确定补发范围之前不接收实时消息
+        self.ready = True
+        # 只接收该代数及之后拉取的批次（重新同步后旧批次可能有缺口）
+        self.min_generation = 0
+        # 发送队列满时暂停接收，清空后再从检查点补拉
+        self.lagging = False
+        # 批量转发时取出但放不进本批的发送单元
+        self.carry: Optional[Tuple[int, List[Message]]] = None
+        # 源禁止转发时本规则改用复制发送
+        self.forward_restricted = False
+        # 启动时从发送日志接管、需要先重放的消息ID
+        self.replay_ids: List[int] = []
+        
+        self.forwarded_count = 0
+        self.tasks: List[asyncio.Task] = []
+    
+    def start(self):
+        """启动发送任务"""
+        self.tasks = [asyncio.create_task(self._send_loop())]
+    
+    def stop(self):
+        """停止发送任务"""
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+    
+    def offer(self, priority: int, unit: List[Message], generation: int):
+        """接收分组阶段分发的发送单元（不阻塞同源的其他目标）"""
+        last_id = max(m.id for m in unit)
+        if not self.ready or self.lagging or generation < self.min_generation or last_id <= self.enqueued_id:
+            return
+        try:
+            self.send_queue.put_nowait((priority, unit))
+            self.enqueued_id = last_id
+        except asyncio.QueueFull:
+            # 该目标跟不上：暂停接收，稍后从 enqueued_id 补拉，保证内存有界
+            self.lagging = True
+            logger.info(f"规则 '{self.rule_name}' 发送积压，暂停接收新消息")
+    
+    def _source_protected(self) -> bool:
+        return self.forward_restricted or chat_info_cache.get(self.source_chat_id, {}).get("noforwards", False)
+    
+    def _use_native_forward(self) -> bool:
+        rule = forwarding_rules.get(self.rule_name, {})
+        if chat_info_cache.get(self.source_chat_id, {}).get("noforwards"):
+            return False
+        # 原生转发无法改写文本
+        rule_filter = get_rule_filter(self.rule_name)
+        if rule_filter and rule_filter.rewrites:
+            return False
+        return rule.get("mode", MODE_FORWARD) == MODE_FORWARD and not self.forward_restricted
+    
+    async def _next_item(self) -> Tuple[int, List[Message]]:
+        if self.carry is not None:
+            item, self.carry = self.carry, None
+            return item
+        return await self.send_queue.get()
+    
+    def _collect_batch(self, priority: int, unit: List[Message]) -> List[List[Message]]:
+        """把队列中已就绪、优先级相同的发送单元合并为一次转发请求（相册不拆分）"""
+        units = [unit]
+        count = len(unit)
+        while self.carry is None and not self.send_queue.empty():
+            item = self.send_queue.get_nowait()
+            if item[0] != priority or count + len(item[1]) > FORWARD_BATCH_SIZE:
+                self.carry = item
+                break
+            units.append(item[1])
+            count += len(item[1])
+        return units
+    
+    async def _collect_digest(self, priority: int, unit: List[Message], settings: dict) -> List[List[Message]]:
+        """合并模式：等待窗口期内陆续到达的短文本消息，凑够长度或遇到不可合并的单元时提前结束"""
+        units = [unit]
+        length = digest_line_length(unit[0])
+        deadline = time.monotonic() + settings["window"]
+        while self.carry is None and length < settings["size"] and len(units) < FORWARD_BATCH_SIZE:
+            if self.send_queue.empty():
+                # 积压暂停接收期间不会再有新消息入队，不必等满窗口
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self.lagging:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.send_queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                item = self.send_queue.get_nowait()
+            
+            if item[0] != priority or len(item[1]) > 1 or not is_digest_message(item[1][0]):
+                self.carry = item
+                break
+            units.append(item[1])
+            length += digest_line_length(item[1][0])
+        return units
+    
+    def _record(self, pairs: List[Tuple[int, int]]):
+        """记录源消息与目标消息的对应关系"""
+        for source_id, target_id in pairs:
+            remember_forwarded(self.checkpoint, source_id, target_id)
+    
+    async def _copy_units(self, units: List[List[Message]], priority: int, on_delivered):
+        """逐个复制发送（原生转发不可用时的回退路径）"""
+        global media_transfer
+        rule_filter = get_rule_filter(self.rule_name)
+        for index, unit in enumerate(units):
+            if isinstance(unit, SkippedUnit):
+                on_delivered(max(m.id for m in unit))
+                continue
+            # 受保护的源需要下载后重新上传：提前下载下一个单元，与本单元的上传重叠
+            if index + 1 < len(units) and (self._source_protected() or any(getattr(m, 'noforwards', False) for m in units[index + 1])):
+                if media_transfer is None:
+                    media_transfer = MediaTransfer()
+                media_transfer.prefetch(self.client, units[index + 1])
+            try:
+                pairs = await forward_messages(self.client, self.target_chat_id, unit, priority,
+                                               rule_filter.rewrite if rule_filter else None)
+                self._record(pairs)
+                if pairs:
+                    self.forwarded_count += 1
+            except Exception as e:
+                record_failure(e, [m.id for m in unit])
+                if len(unit) > 1 or unit[0].grouped_id:
+                    logger.error(f"转发相册失败 (AlbumID: {unit[0].grouped_id}): {e}")
+                else:
+                    logger.error(f"转发消息失败 (ID: {unit[0].id}): {e}")
+            
+            on_delivered(max(m.id for m in unit))
+    
+    async def deliver(self, units: List[List[Message]], priority: int, on_delivered):
+        """发送一组发送单元：优先原生批量转发，不可用时逐个复制；每完成一部分回调 on_delivered(最大消息ID)"""
+        rule_filter = get_rule_filter(self.rule_name)
+        if rule_filter:
+            # 被过滤的单元保留在原位，检查点仍按顺序推进
+            units = [unit if rule_filter.accepts(unit) else SkippedUnit(unit) for unit in units]
+            skipped = sum(len(unit) for unit in units if isinstance(unit, SkippedUnit))
+            if skipped:
+                record_filtered(skipped)
+        digest_settings = get_digest_settings(self.rule_name)
+        if digest_settings:
+            units = coalesce_units(units, digest_settings)
+        
+        for batch in chunk_units(units, FORWARD_BATCH_SIZE):
+            sendable = [unit for unit in batch if not isinstance(unit, SkippedUnit)]
+            if not sendable:
+                on_delivered(max(m.id for u in batch for m in u))
+                continue
+            
+            # 先落盘发送日志再发送；崩溃后重放时沿用同样的 random_id
+            message_ids = [m.id for unit in sendable for m in unit]
+            await journal_sends(self.checkpoint, message_ids)
+            await self._deliver_batch(batch, sendable, priority, on_delivered)
+            journal_done(self.checkpoint, message_ids)
+    
+    async def _send_digest(self, unit: DigestUnit, priority: int):
+        rule_filter = get_rule_filter(self.rule_name)
+        try:
+            await send_digest(self.client, self.source_chat_id, self.target_chat_id, unit, priority,
+                              rule_filter.rewrite if rule_filter else None)
+            self.forwarded_count += len(unit)
+        except Exception as e:
+            record_failure(e, [m.id for m in unit])
+            logger.error(f"发送合并消息失败 (ID: {unit[0].id}-{unit[-1].id}): {e}")
+    
+    async def _deliver_batch(self, batch: List[List[Message]], sendable: List[List[Message]], priority: int, on_delivered):
+        if any(isinstance(unit, DigestUnit) for unit in batch):
+            # 合并消息单独发送，其间的其他单元照常成批发送，整体保持源顺序
+            segment = []
+            for unit in batch + [None]:
+                if unit is not None and not isinstance(unit, DigestUnit):
+                    segment.append(unit)
+                    continue
+                if segment:
+                    await self._deliver_batch(segment, [u for u in segment if not isinstance(u, SkippedUnit)],
+                                              priority, on_delivered)
+                    segment = []
+                if unit is not None:
+                    await self._send_digest(unit, priority)
+                    on_delivered(max(m.id for m in unit))
+            return
+        
+        if not self._use_native_forward():
+            await self._copy_units(batch, priority, on_delivered)
+            return
+        
+        if any(getattr(m, 'noforwards', False) for u in batch for m in u):
+            logger.info(f"规则 '{self.rule_name}' 的源开启了内容保护，改用复制发送")
+            self.forward_restricted = True
+            await self._copy_units(batch, priority, on_delivered)
+            return
+        
+        try:
+            rule = forwarding_rules.get(self.rule_name, {})
+            pairs = await forward_native_batch(
+                self.client, self.source_chat_id, self.target_chat_id, sendable, priority,
+                drop_captions=rule.get("drop_captions", False)
+            )
+            self._record(pairs)
+            self.forwarded_count += sum(1 for u in sendable if any(is_forwardable(m) for m in u))
+            on_delivered(max(m.id for u in batch for m in u))
+        except ChatForwardsRestrictedError:
+            logger.info(f"规则 '{self.rule_name}' 的源禁止转发，改用复制发送")
+            self.forward_restricted = True
+            await self._copy_units(batch, priority, on_delivered)
+        except Exception as e:
+            logger.warning(f"规则 '{self.rule_name}' 批量转发失败，改为逐条复制: {e}")
+            await self._copy_units(batch, priority, on_delivered)
+    
+    def restore_journal(self, journal: Dict[int, str], has_backfill_job: bool):
+        """接管发送日志中上次未完成的发送：实时部分在发送新消息前重放，补发部分由补发任务按进度重发"""
+        checkpoint_id = last_message_ids.get(self.checkpoint, 0)
+        pending = sorted(message_id for message_id, salt in journal.items() if not salt and message_id > checkpoint_id)
+        # 检查点已提交的、以及补发任务已不存在的条目直接清除
+        journal_done(self.checkpoint, [
+            message_id for message_id, salt in journal.items()
+            if salt and not has_backfill_job or not salt and message_id <= checkpoint_id
+        ])
+        if pending:
+            self.replay_ids = pending
+            self.enqueued_id = max(self.enqueued_id, pending[-1])
+    
+    async def _replay_journal(self):
+        """重放未完成的发送：已发出的由服务端按 random_id 去重，没发出的补发"""
+        message_ids, self.replay_ids = self.replay_ids, []
+        try:
+            messages = [m for m in await self.client.get_messages(self.source_chat_id, ids=message_ids) if m]
+        except Exception as e:
+            logger.error(f"规则 '{self.rule_name}' 读取待重放的消息失败，改为从检查点重新拉取: {e}")
+            self.enqueued_id = last_message_ids.get(self.checkpoint, 0)
+            source_worker = source_workers.get((self.session_name, self.source_chat_id))
+            if source_worker:
+                source_worker.resync(self)
+            return
+        
+        logger.info(f"规则 '{self.rule_name}' 重放 {len(messages)} 条未完成的发送")
+        checkpoint_updater = lambda message_id: advance_checkpoint(self.checkpoint, message_id)
+        await self.deliver(group_album_messages(messages), PRIORITY_LIVE, checkpoint_updater)
+        # 源中已删除的消息不再发送
+        checkpoint_updater(message_ids[-1])
+    
+    def _restart_from_checkpoint(self, error: Exception):
+        """发送阶段出错（如写发送日志失败）：丢弃已入队的单元并暂停接收，队列清空后从检查点重新拉取"""
+        logger.error(f"规则 '{self.rule_name}' 发送出错，稍后从检查点重新拉取: {error}")
+        if self.carry is not None:
+            self.carry = None
+            self.send_queue.task_done()
+        while not self.send_queue.empty():
+            self.send_queue.get_nowait()
+            self.send_queue.task_done()
+        self.enqueued_id = last_message_ids.get(self.checkpoint, 0)
+        self.lagging = True
+    
+    async def _send_loop(self):
+        """发送阶段：限流由全局调度器控制，只阻塞本规则，不影响其他规则"""
+        current_rule.set(self.rule_name)
+        current_session.set(self.session_name)
+        if self.replay_ids:
+            try:
+                await self._replay_journal()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._restart_from_checkpoint(e)
+        while True:
+            if self.lagging and self.send_queue.empty() and self.carry is None:
+                self.lagging = False
+                source_worker = source_workers.get((self.session_name, self.source_chat_id))
+                if source_worker:
+                    source_worker.resync(self)
+            
+            priority, unit = await self._next_item()
+            units = [unit]
+            try:
+                digest_settings = get_digest_settings(self.rule_name)
+                if digest_settings and len(unit) == 1 and is_digest_message(unit[0]):
+                    units = await self._collect_digest(priority, unit, digest_settings)
+                # 受保护的源也成批取出，以便预下载下一条的媒体
+                elif self._use_native_forward() or self._source_protected():
+                    units = self._collect_batch(priority, unit)
+                
+                # 更新最后处理的消息ID
+                await self.deliver(units, priority, lambda message_id: advance_checkpoint(self.checkpoint, message_id))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._restart_from_checkpoint(e)
+                await asyncio.sleep(POLL_INTERVAL)
+            finally:
+                for _ in units:
+                    self.send_queue.task_done()
+
+class BackfillJob:
+    """历史消息补发：从最早的消息开始分页流式读取，每页保存进度，崩溃后可断点续传"""
+    
+    def __init__(self, worker: RuleWorker, end_id: int, cursor: int = 0, total: int = 0, done: int = 0,
+                 salt: Optional[str] = None):
+        self.worker = worker
+        # 补发范围为 (cursor, end_id]，end_id 之后的消息由实时流水线处理
+        self.end_id = end_id
+        self.cursor = cursor
+        self.total = total
+        self.done = done
+        # 每个任务一个随机的 random_id 盐，随进度保存：重复补发同一范围不会被服务端当成重复，断点续传时沿用
+        self.salt = salt or f"backfill:{os.urandom(8).hex()}"
+        self.task: Optional[asyncio.Task] = None
+    
+    @property
+    def remaining(self) -> int:
+        return max(self.total - self.done, 0)
+    
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+    
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+    
+    async def _save(self):
+        await asyncio.to_thread(save_backfill_job, self.worker.checkpoint, self.end_id, self.cursor, self.total, self.done,
+                                self.salt)
+    
+    async def _deliver_page(self, page: List[Message]):
+        """发送一页消息并保存进度"""
+        await self.worker.deliver(group_album_messages(page), PRIORITY_BACKFILL, lambda message_id: None)
+        self.cursor = max(m.id for m in page)
+        self.done += len(page)
+        await self._save()
+        logger.info(f"规则 '{self.worker.rule_name}' 补发进度 {self.done}/{self.total}，剩余约 {self.remaining} 条")
+    
+    async def _run(self):
+        rule_name = self.worker.rule_name
+        source_chat_id = self.worker.source_chat_id
+        current_rule.set(rule_name)
+        current_session.set(self.worker.session_name)
+        send_salt.set(self.salt)
+        logger.info(f"规则 '{rule_name}' 开始补发历史消息，共约 {self.total} 条，已完成 {self.done} 条")
+        
+        while True:
+            try:
+                page = []
+                async for message in self.worker.client.iter_messages(
+                    source_chat_id,
+                    reverse=True,
+                    min_id=self.cursor,
+                    max_id=self.end_id + 1
+                ):
+                    # 页尾的相册可能还没读完，等下一条不属于该相册的消息出现再发送
+                    if len(page) >= BACKFILL_PAGE_SIZE and not (message.grouped_id and message.grouped_id == page[-1].grouped_id):
+                        await self._deliver_page(page)
+                        page = []
+                    page.append(message)
+                
+                if page:
+                    await self._deliver_page(page)
+                break
+            except asyncio.CancelledError:
+                raise
+            except FloodWaitError as e:
+                logger.info(f"规则 '{rule_name}' 补发需要等待 {e.seconds} 秒")
+                await asyncio.sleep(e.seconds)
+            except Exception as e:
+                logger.error(f"规则 '{rule_name}' 补发失败，稍后从消息 {self.cursor} 继续: {e}")
+                await asyncio.sleep(POLL_INTERVAL)
+        
+        await asyncio.to_thread(delete_backfill_job, self.worker.checkpoint)
+        backfill_jobs.pop(rule_name, None)
+        logger.info(f"规则 '{rule_name}' 历史消息补发完成，共 {self.done} 条")
+
+async def start_comment_checkpoint(worker: RuleWorker):
+    """新规则的评论区从当前最新评论开始，历史评论不补发（否则会先于补发的帖子到达而无法挂到帖子下）"""
+    try:
+        chat_info = await get_chat_info(worker.client, worker.source_chat_id)
+        if not chat_info["broadcast"] or not chat_info["linked_chat_id"]:
+            return
+        checkpoint = (chat_info["linked_chat_id"], worker.target_chat_id)
+        # 同一目标已有其他规则在转发该评论区时沿用其进度
+        if checkpoint in last_message_ids:
+            return
+        latest = await worker.client.get_messages(chat_info["linked_chat_id"], limit=1)
+        advance_checkpoint(checkpoint, latest[0].id if latest else 0)
+    except Exception as e:
+        logger.error(f"规则 '{worker.rule_name}' 获取评论区最新消息失败: {e}")
+
+async def start_backfill(worker: RuleWorker, backfill: bool):
+    """没有检查点的规则：以源当前最新消息为界，之后的交给实时流水线；backfill 时之前的交给补发任务"""
+    while True:
+        try:
+            latest = await worker.client.get_messages(worker.source_chat_id, limit=1)
+            break
+        except Exception as e:
+            # 不能退回到从 0 开始拉取，否则整个历史都会走实时流水线
+            logger.error(f"规则 '{worker.rule_name}' 获取源最新消息失败，稍后重试: {e}")
+            await asyncio.sleep(POLL_INTERVAL)
+            if rule_workers.get(worker.rule_name) is not worker:
+                return
+    end_id = latest[0].id if latest else 0
+    total = getattr(latest, 'total', len(latest))
+    
+    advance_checkpoint(worker.checkpoint, end_id)
+    await start_comment_checkpoint(worker)
+    worker.enqueued_id = end_id
+    worker.ready = True
+    source_worker = source_workers.get((worker.session_name, worker.source_chat_id))
+    if source_worker:
+        source_worker.resync(worker)
+    
+    if backfill and end_id and rule_workers.get(worker.rule_name) is worker:
+        job = BackfillJob(worker, end_id, total=total)
+        await job._save()
+        backfill_jobs[worker.rule_name] = job
+        job.start()
+
+def sync_rule_workers():
+    """按当前规则和账号分配启动新增规则的流水线，停止已删除或已迁移规则的流水线"""
+    for rule_name in list(rule_workers):
+        worker = rule_workers[rule_name]
+        rule = forwarding_rules.get(rule_name)
+        changed = (rule is None or rule.get("paused") or rule["source_chat_id"] != worker.source_chat_id
+                   or rule["target_chat_id"] != worker.target_chat_id)
+        moved = not changed and session_pool.session_for(rule_name) != worker.session_name
+        if changed or moved:
+            worker.stop()
+            del rule_workers[rule_name]
+            source_key = (worker.session_name, worker.source_chat_id)
+            if source_key in source_workers:
+                source_workers[source_key].remove_rule(rule_name)
+            if rule_name in backfill_jobs:
+                job = backfill_jobs.pop(rule_name)
+                job.stop()
+                if moved or rule is not None and rule.get("paused"):
+                    # 迁移到其他账号或恢复后从当前进度继续补发
+                    stored_backfill_jobs[worker.checkpoint] = (job.end_id, job.cursor, job.total, job.done, job.salt)
+                else:
+                    delete_backfill_job(worker.checkpoint)
+            if moved:
+                logger.info(f"规则 '{rule_name}' 从账号 {worker.session_name} 迁移到 {session_pool.session_for(rule_name)}")
+    
+    for rule_name, rule in forwarding_rules.items():
+        if rule_name in rule_workers or rule.get("paused"):
+            continue
+        session_name = session_pool.session_for(rule_name)
+        client = session_pool.clients[session_name]
+        source_chat_id = rule["source_chat_id"]
+        source_key = (session_name, source_chat_id)
+        if source_key not in source_workers:
+            source_workers[source_key] = SourceWorker(client, source_chat_id, session_name)
+        worker = RuleWorker(client, rule_name, source_chat_id, rule["target_chat_id"], session_name)
+        journal = stored_send_journal.pop(worker.checkpoint, None)
+        if journal:
+            worker.restore_journal(journal, worker.checkpoint in stored_backfill_jobs)
+        worker.start()
+        rule_workers[rule_name] = worker
+        
+        stored_job = stored_backfill_jobs.pop(worker.checkpoint, None)
+        if stored_job:
+            # 继续上次未完成的补发
+            job = BackfillJob(worker, *stored_job)
+            backfill_jobs[rule_name] = job
+            job.start()
+        elif worker.enqueued_id == 0:
+            worker.ready = False
+            asyncio.create_task(start_backfill(worker, rule_name in pending_backfills))
+        pending_backfills.discard(rule_name)
+        
+        source_workers[source_key].add_rule(worker)
+    
+    # 启动新的源，停止已没有规则的源
+    for source_key in list(source_workers):
+        source_worker = source_workers[source_key]
+        if not source_worker.rules:
+            source_worker.stop()
+            del source_workers[source_key]
+        elif not source_worker.tasks:
+            source_worker.start()
+
+def apply_rule_changes():
+    """规则或账号分配变化后同步流水线和实时消息处理器"""
+    sync_rule_workers()
+    register_source_handlers()
+    if trace_recorder:
+        trace_recorder.record_rules()
+
+def dispatch_pushed_messages(session_name: str, source_chat_id: int, messages: List[Message]):
+    """将实时推送的新消息交给该账号上对应源的流水线"""
+    source_worker = source_workers.get((session_name, source_chat_id))
+    if source_worker:
+        source_worker.push(messages)
+
+def get_discussion_sources() -> Dict[int, int]:
+    """已知的讨论组ID -> 源频道ID"""
+    return {
+        discussion_chat_id: chat_id
+        for discussion_chat_id, chat_id in linked_channels.items()
+        if chat_id in rules_by_source
+    }
+
+def get_discussion_source(chat_id: int) -> Optional[int]:
+    """chat_id 是某个源频道的讨论组时返回该频道ID"""
+    source_chat_id = linked_channels.get(chat_id)
+    return source_chat_id if source_chat_id in rules_by_source else None
+
+async def propagate_edit(client: TelegramClient, checkpoint: Tuple[int, int], message: Message, prefix: str = ""):
+    """把源消息的编辑同步到目标中对应的消息"""
+    target_chat_id = checkpoint[1]
+    target_ids = sorted((await find_forwarded(checkpoint, [message.id])).get(message.id, []))
+    # 与转发时一样应用规则的文本改写（评论检查点的源是讨论组所属的频道）
+    source_chat_id = get_discussion_source(checkpoint[0]) or checkpoint[0] if prefix else checkpoint[0]
+    rule_filter = get_rule_filter(find_rule_name(source_chat_id, target_chat_id))
+    text = rule_filter.rewrite(message.message) if rule_filter else message.message
+    chunks = split_formatted_text(
+        *prefix_formatted_text(prefix, text, message.entities if text == message.message else None),
+        CAPTION_LENGTH_LIMIT if message.media and not message.web_preview else MESSAGE_LENGTH_LIMIT
+    )
+    # 拆分发送的消息逐段编辑；未拆分时（包括同一条消息的多份副本）每条都用完整文本
+    edits = zip(target_ids, chunks) if len(chunks) > 1 else ((target_id, chunks[0]) for target_id in target_ids)
+    for target_message_id, (text, entities) in edits:
+        try:
+            await send_with_rate_limit(target_chat_id, PRIORITY_LIVE, lambda: client.edit_message(
+                target_chat_id,
+                target_message_id,
+                text,
+                formatting_entities=entities
+            ))
+        except MessageNotModifiedError:
+            pass
+        except Exception as e:
+            logger.error(f"同步编辑失败 (ID: {message.id} -> {target_message_id}): {e}")
+
+async def propagate_deletes(client: TelegramClient, checkpoint: Tuple[int, int], source_message_ids: List[int]):
+    """把源消息的删除同步到目标，按批调用 delete_messages"""
+    target_chat_id = checkpoint[1]
+    found = await find_forwarded(checkpoint, source_message_ids)
+    target_ids = [target_id for ids in found.values() for target_id in ids]
+    if not target_ids:
+        return
+    
+    for start in range(0, len(target_ids), DELETE_BATCH_SIZE):
+        batch = target_ids[start:start + DELETE_BATCH_SIZE]
+        try:
+            await send_with_rate_limit(target_chat_id, PRIORITY_LIVE, lambda: client.delete_messages(target_chat_id, batch))
+        except Exception as e:
+            logger.error(f"同步删除失败 (目标: {target_chat_id}): {e}")
+    
+    await forget_forwarded(checkpoint, list(found))
+    logger.info(f"已同步删除 {checkpoint[0]} -> {target_chat_id} 的 {len(target_ids)} 条消息")
+
+def get_affected_checkpoints(chat_id: int, session_name: Optional[str] = None) -> List[Tuple[Tuple[int, int], str]]:
+    """源群组/频道或其讨论组对应的所有 (检查点, 评论前缀)；指定账号时只包括该账号上的规则"""
+    def on_session(rule_name: str) -> bool:
+        worker = rule_workers.get(rule_name)
+        return session_name is None or worker is not None and worker.session_name == session_name
+    
+    result = []
+    for rule_name in find_rules(source_chat_id=chat_id):
+        if on_session(rule_name):
+            result.append(((chat_id, forwarding_rules[rule_name]["target_chat_id"]), ""))
+    source_chat_id = get_discussion_source(chat_id)
+    if source_chat_id is not None:
+        for rule_name in find_rules(source_chat_id=source_chat_id):
+            if on_session(rule_name):
+                result.append(((chat_id, forwarding_rules[rule_name]["target_chat_id"]), COMMENT_PREFIX))
+    # 同一 (源, 目标) 可能有多条规则
+    return list(dict.fromkeys(result))
+
+async def on_source_edited(event):
+    """源消息被编辑时同步到目标"""
+    try:
+        # 每个账号只同步自己转发的消息（只能编辑自己发送的消息）
+        session_name = session_pool.name_of(event.client)
+        for checkpoint, prefix in get_affected_checkpoints(event.chat_id, session_name):
+            await propagate_edit(event.client, checkpoint, event.message, prefix)
+    except Exception as e:
+        logger.error(f"处理消息编辑失败: {e}")
+
+async def on_source_deleted(event):
+    """源消息被删除时同步到目标"""
+    try:
+        session_name = session_pool.name_of(event.client)
+        if event.chat_id is not None:
+            # 处理器不按聊天过滤，无关聊天的删除在这里直接丢弃
+            if event.chat_id not in rules_by_source and get_discussion_source(event.chat_id) is None:
+                return
+            chat_ids = [event.chat_id]
+        else:
+            # 普通群组的删除事件不带聊天ID（这类消息ID在账号内唯一），逐个检查普通群组源
+            chat_ids = list(basic_group_sources)
+        
+        for chat_id in chat_ids:
+            for checkpoint, _ in get_affected_checkpoints(chat_id, session_name):
+                await propagate_deletes(event.client, checkpoint, list(event.deleted_ids))
+    except Exception as e:
+        logger.error(f"处理消息删除失败: {e}")
+
+async def on_source_message(event):
+    """源群组/频道新消息（非相册）"""
+    dispatch_pushed_messages(session_pool.name_of(event.client), event.chat_id, [event.message])
+
+async def on_source_album(event):
+    """源群组/频道新相册"""
+    dispatch_pushed_messages(session_pool.name_of(event.client), event.chat_id, list(event.messages))
+
+def register_source_handlers():
+    """按当前规则和账号分配（重新）注册各账号的源群组/频道实时消息处理器"""
+    for session_name, client in session_pool.clients.items():
+        _register_session_handlers(session_name, client)
+
+def _register_session_handlers(session_name: str, client: TelegramClient):
+    for callback, event_builder in source_event_handlers.pop(session_name, []):
+        client.remove_event_handler(callback, event_builder)
+    
+    source_chat_ids = sorted(source_chat_id for name, source_chat_id in source_workers if name == session_name)
+    if not source_chat_ids:
+        return
+    
+    # 相册的每一条消息也会触发 NewMessage，交给 Album 处理器整体转发
+    # 普通群组的删除事件不带聊天ID，删除处理器不按聊天过滤
+    discussion_chat_ids = [chat_id for chat_id, source_chat_id in get_discussion_sources().items() if source_chat_id in source_chat_ids]
+    edit_chat_ids = source_chat_ids + sorted(discussion_chat_ids)
+    handlers = [
+        (on_source_message, events.NewMessage(chats=source_chat_ids, func=lambda e: not e.message.grouped_id)),
+        (on_source_album, events.Album(chats=source_chat_ids)),
+        (on_source_edited, events.MessageEdited(chats=edit_chat_ids)),
+        (on_source_deleted, events.MessageDeleted()),
+    ]
+    for callback, event_builder in handlers:
+        client.add_event_handler(callback, event_builder)
+        source_event_handlers.setdefault(session_name, []).append((callback, type(event_builder)))
+    
+    logger.info(f"账号 {session_name} 已注册 {len(source_chat_ids)} 个源群组/频道的实时消息处理器")
+
+async def store_update_state(session_name: str, client: TelegramClient):
+    """保存账号当前的更新状态，以及此刻各源已见到的最大消息ID"""
+    state = await client(GetStateRequest())
+    # 先取状态再取各源的位置：状态之前的更新都已推送，位置不会比状态旧
+    seen = {
+        source_chat_id: worker.seen_id
+        for (name, source_chat_id), worker in source_workers.items()
+        if name == session_name and worker.seen_id
+    }
+    await asyncio.to_thread(save_update_state, session_name, state.pts, state.qts, int(state.date.timestamp()), seen)
+
+async def catch_up(session_name: str, client: TelegramClient):
+    """用保存的更新状态取回停机或断线期间错过的消息，交给正常的转发流水线
+    
+    追赶期间该账号的源暂停拉取；通用差异不包含频道（含超级群组）的消息，这些源仍按检查点扫描
+    """
+    gate = catch_up_gates.setdefault(session_name, asyncio.Event())
+    try:
+        saved = await asyncio.to_thread(load_update_state, session_name)
+        if saved is None:
+            # 首次运行，没有可比较的状态，由扫描处理
+            return
+        pts, qts, date, seen = saved
+        
+        recovered: Dict[int, Dict[int, Message]] = {}
+        # 差异太多时全部退回到按检查点扫描
+        too_long = False
+        requests = 0
+        while True:
+            difference = await client(GetDifferenceRequest(pts=pts, date=date, qts=qts))
+            requests += 1
+            if isinstance(difference, DifferenceEmpty):
+                break
+            if isinstance(difference, DifferenceTooLong):
+                too_long = True
+                break
+            
+            entities = {utils.get_peer_id(entity): entity for entity in difference.users + difference.chats}
+            messages = list(difference.new_messages)
+            for update in difference.other_updates:
+                if isinstance(update, (UpdateNewMessage, UpdateNewChannelMessage)):
+                    messages.append(update.message)
+            for message in messages:
+                if isinstance(message, MessageEmpty):
+                    continue
+                # 原始请求返回的消息需要绑定客户端和实体，之后才能像 get_messages 的结果一样使用
+                message._finish_init(client, entities, None)
+                recovered.setdefault(utils.get_peer_id(message.peer_id), {})[message.id] = message
+            
+            state = difference.intermediate_state if isinstance(difference, DifferenceSlice) else difference.state
+            pts, qts, date = state.pts, state.qts, state.date
+            if not isinstance(difference, DifferenceSlice):
+                break
+        
+        recovered_count = 0
+        swept = 0
+        for (name, source_chat_id), worker in source_workers.items():
+            if name != session_name or worker.fetched_id is None:
+                continue
+            # 频道的新消息只能通过扫描取回；停机前还有未转发完的消息、或者差异不完整时也需要扫描
+            if (too_long or utils.resolve_id(source_chat_id)[1] is PeerChannel
+                    or worker.fetched_id < seen.get(source_chat_id, worker.fetched_id + 1)):
+                worker.request_sweep()
+                swept += 1
+            messages = recovered.get(source_chat_id)
+            if messages:
+                worker.push(sorted(messages.values(), key=lambda m: m.id))
+                recovered_count += len(messages)
+        logger.info(f"账号 {session_name} 追赶完成：{requests} 次差异请求取回 {recovered_count} 条消息，{swept} 个源需要扫描")
+    except Exception as e:
+        # 取不到差异时退回到按检查点扫描所有源
+        logger.error(f"账号 {session_name} 追赶错过的消息失败，改为扫描: {e}")
+        for (name, _), worker in source_workers.items():
+            if name == session_name:
+                worker.request_sweep()
+    finally:
+        gate.set()
+        catch_up_gates.pop(session_name, None)
+
+async def update_state_loop(session_name: str, client: TelegramClient):
+    """定期保存账号的更新状态；断线重连后先追赶错过的消息"""
+    connected = True
+    last_saved = time.monotonic()
+    while True:
+        await asyncio.sleep(CONNECTION_CHECK_INTERVAL)
+        try:
+            if not client.is_connected():
+                if connected:
+                    logger.warning(f"账号 {session_name} 连接断开，等待重连")
+                connected = False
+                continue
+            if not connected:
+                connected = True
+                logger.info(f"账号 {session_name} 已重连，开始追赶错过的消息")
+                await catch_up(session_name, client)
+            elif time.monotonic() - last_saved < UPDATE_STATE_SAVE_INTERVAL:
+                continue
+            await store_update_state(session_name, client)
+            last_saved = time.monotonic()
+        except Exception as e:
+            logger.error(f"账号 {session_name} 保存或追赶更新状态失败: {e}")
+
+async def check_new_messages(client: TelegramClient):
+    """定期触发所有规则的兜底扫描（实时推送之外的安全网）"""
+    global sweep_count
+    last_total = 0
+    while True:
+        try:
+            # 限流解除的账号收回原来分配给它的规则
+            if session_pool.expire_limits():
+                apply_rule_changes()
+            for source_worker in list(source_workers.values()):
+                source_worker.request_sweep()
+            sweep_count += 1
+            
+            total_forwarded = (sum(worker.forwarded_count for worker in rule_workers.values())
+                               + sum(worker.forwarded_count for worker in source_workers.values()))
+            if total_forwarded > last_total:
+                logger.info(f"本轮共转发了 {total_forwarded - last_total} 条消息")
+            last_total = total_forwarded
+            
+            await asyncio.sleep(SWEEP_INTERVAL)
+        except Exception as e:
+            logger.error(f"检查新消息过程中出错: {e}")
+            await asyncio.sleep(30)  # 出错后等待长一点的时间
+
+def _metric_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def render_metrics() -> str:
+    """按 Prometheus 文本格式输出所有指标"""
+    lines = []
+    
+    def add(name: str, kind: str, help_text: str, samples: List[Tuple[str, object]]):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+    
+    rules = sorted(set(rule_metrics) | set(rule_workers))
+    metrics = {rule_name: get_rule_metrics(rule_name) for rule_name in rules}
+    rule_label = {rule_name: f'rule="{_metric_label(rule_name)}"' for rule_name in rules}
+    
+    add("teleporter_messages_forwarded_total", "counter", "Messages delivered to the target.",
+        [(rule_label[r], metrics[r].messages) for r in rules])
+    add("teleporter_api_calls_total", "counter", "Telegram API calls made while delivering.",
+        [(rule_label[r], metrics[r].api_calls) for r in rules])
+    add("teleporter_flood_wait_seconds_total", "counter", "Seconds of FloodWait/SlowModeWait received.",
+        [(rule_label[r], metrics[r].flood_wait_seconds) for r in rules])
+    add("teleporter_failures_total", "counter", "Messages that failed to send.",
+        [(rule_label[r], metrics[r].failures) for r in rules])
+    add("teleporter_filtered_messages_total", "counter", "Messages skipped by rule filters.",
+        [(rule_label[r], metrics[r].filtered) for r in rules])
+    add("teleporter_send_queue_depth", "gauge", "Units waiting in the rule's send queue.",
+        [(rule_label[r], rule_workers[r].send_queue.qsize()) for r in rules if r in rule_workers])
+    
+    histogram = []
+    for r in rules:
+        for bound, count in zip(LATENCY_BUCKETS, metrics[r].latency_buckets):
+            histogram.append((f'{rule_label[r]},le="{bound}"', count))
+        histogram.append((f'{rule_label[r]},le="+Inf"', metrics[r].latency_count))
+    lines.append("# HELP teleporter_latency_seconds Source message date to target send.")
+    lines.append("# TYPE teleporter_latency_seconds histogram")
+    for labels, value in histogram:
+        lines.append(f"teleporter_latency_seconds_bucket{{{labels}}} {value}")
+    for r in rules:
+        lines.append(f"teleporter_latency_seconds_sum{{{rule_label[r]}}} {metrics[r].latency_sum}")
+        lines.append(f"teleporter_latency_seconds_count{{{rule_label[r]}}} {metrics[r].latency_count}")
+    
+    add("teleporter_source_queue_depth", "gauge", "Fetched batches waiting to be grouped.",
+        [(f'session="{_metric_label(session)}",source="{s}"', worker.message_queue.qsize())
+         for (session, s), worker in source_workers.items()])
+    add("teleporter_fetch_calls_total", "counter", "get_messages calls made to poll a source.",
+        [(f'source="{s}"', count) for s, count in source_fetch_calls.items()])
+    add("teleporter_sweeps_total", "counter", "Fallback sweeps triggered.", [("", sweep_count)])
+    return "\n".join(lines) + "\n"
+
+async def handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """极简 HTTP：任何路径都返回指标文本"""
+    try:
+        await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5)
+        body = render_metrics().encode("utf-8")
+        writer.write(
+            b"HTTP/1.0 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            + f"Content-Length: {len(body)}\r\n\r\n".encode("ascii")
+            + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server():
+    """在本机启动指标端点"""
+    try:
+        await asyncio.start_server(handle_metrics_request, METRICS_HOST, METRICS_PORT)
+        logger.info(f"指标端点已启动: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    except OSError as e:
+        logger.warning(f"指标端点启动失败: {e}")
+
+async def show_stats() -> List[str]:
+    """各规则的统计，按延迟从高到低只列出最慢的 STATS_TOP_RULES 条规则，方便找出慢规则"""
+    if not forwarding_rules:
+        return ["当前没有设置任何转发规则"]
+    
+    def format_seconds(value: Optional[float]) -> str:
+        return "-" if value is None else f"{value:.1f}s"
+    
+    rows = []
+    for rule_name in forwarding_rules:
+        metrics = get_rule_metrics(rule_name)
+        worker = rule_workers.get(rule_name)
+        rows.append((metrics.percentile(0.95) or 0, (
+            f"规则: {rule_name}\n"
+            f"  已转发: {metrics.messages} 条，过滤: {metrics.filtered} 条，失败: {metrics.failures} 次\n"
+            f"  延迟 p50/p95: {format_seconds(metrics.percentile(0.5))} / {format_seconds(metrics.percentile(0.95))}\n"
+            f"  API 调用/条: {metrics.api_calls / metrics.messages if metrics.messages else 0:.2f}\n"
+            f"  发送队列: {worker.send_queue.qsize() if worker else 0}，FloodWait 累计: {metrics.flood_wait_seconds:.0f}s\n"
+        )))
+    rows.sort(key=lambda row: row[0], reverse=True)
+    entries = [row[1] + "\n" for row in rows[:STATS_TOP_RULES]]
+    if len(rows) > STATS_TOP_RULES:
+        entries.append(f"其余 {len(rows) - STATS_TOP_RULES} 条规则的延迟更低，未列出")
+    return paginate_reply("转发统计：\n\n", entries)
+
+async def handle_user_message(event):
+    """处理用户消息（注册时已限定为白名单用户的私聊）"""
+    # 发送者ID直接取自更新，不请求发送者实体
+    user_id = event.sender_id
+    
+    # 检查用户是否在白名单中
+    if not await is_user_allowed(user_id):
+        return
+    
+    message = event.message
+    text = message.text if message.text else ""
+    
+    # 处理命令
+    if text.startswith("/"):
+        parts = text.split()
+        command = parts[0].lower()
         
         if command == "/add" and len(parts) > 1:
-            rule_name = " ".join(parts[1:])
-            response = await add_new_rule(user_id, rule_name)
+            # /add 规则名 | 过滤条件
+            rule_name, _, filter_spec = text[len(parts[0]):].partition("|")
+            response = await add_new_rule(user_id, rule_name.strip(), filter_spec.strip())
             await event.respond(response)
-        elif command == "/list":
-            response = await list_rules()
+        elif command == "/filter" and len(parts) > 1:
+            # /filter 规则名 | 过滤条件（省略条件则清除）
+            rule_name, _, filter_spec = text[len(parts[0]):].partition("|")
+            response = await set_rule_filters(rule_name.strip(), filter_spec.strip())
+            apply_rule_changes()
             await event.respond(response)
+        elif command == "/list":
+            for response in await list_rules():
+                await event.respond(response)
         elif command == "/delete" and len(parts) > 1:
             rule_name = " ".join(parts[1:])
             response = await delete_rule(rule_name)
+            apply_rule_changes()
+            await event.respond(response)
+        elif command == "/mode" and len(parts) > 2:
+            rule_name = " ".join(parts[1:-1])
+            response = await set_rule_mode(rule_name, parts[-1].lower())
             await event.respond(response)
+        elif command == "/digest" and len(parts) > 2:
+            # /digest 规则名 秒数 [长度]，或 /digest 规则名 off
+            args = parts[1:]
+            if args[-1].lower() == "off":
+                response = await set_rule_digest(" ".join(args[:-1]), None)
+            else:
+                numbers = []
+                while len(args) > 1 and len(numbers) < 2 and args[-1].isdigit():
+                    numbers.insert(0, int(args.pop()))
+                if numbers:
+                    response = await set_rule_digest(" ".join(args), *numbers)
+                else:
+                    response = "用法：/digest 规则名 秒数 [长度]，或 /digest 规则名 off"
+            await event.respond(response)
+        elif command in ("/pause", "/resume") and len(parts) > 1:
+            rule_name = " ".join(parts[1:])
+            response = await set_rule_paused(rule_name, command == "/pause")
+            apply_rule_changes()
+            await event.respond(response)
+        elif command == "/backfill" and len(parts) > 1:
+            # /backfill 规则名 [起始消息ID]
+            from_id = 0
+            if len(parts) > 2 and parts[-1].isdigit():
+                from_id = int(parts[-1])
+                parts = parts[:-1]
+            response = await start_rule_backfill(" ".join(parts[1:]), from_id)
+            await event.respond(response)
+        elif command == "/export":
+            if not forwarding_rules:
+                await event.respond("当前没有转发规则。")
+            else:
+                await event.respond(f"共 {len(forwarding_rules)} 条规则", file=export_rules())
+        elif command == "/import":
+            # 规则文件作为本条消息的附件，或回复一条带规则文件的消息
+            source = message if message.file else await message.get_reply_message()
+            if not source or not source.file:
+                await event.respond("请把规则 JSON 文件和 /import 一起发送，或用 /import 回复规则文件。")
+                return
+            response = await import_rules(user_id, await source.download_media(file=bytes))
+            apply_rule_changes()
+            await event.respond(response)
+        elif command == "/stats":
+            for response in await show_stats():
+                await event.respond(response)
         elif command == "/help":
             help_text = (
                 "机器人命令列表：\n"
-                "/add [规则名] - 添加新的转发规则\n"
+                "/add [规则名] | [过滤条件] - 添加新的转发规则，过滤条件可省略\n"
+                "/filter [规则名] | [过滤条件] - 设置或清除规则的过滤和改写条件\n"
                 "/list - 列出所有转发规则\n"
                 "/delete [规则名] - 删除指定的转发规则\n"
-                "/help - 显示此帮助信息"
+                "/mode [规则名] [forward|copy] - 设置转发模式（原生批量转发/逐条复制）\n"
+                f"/digest [规则名] [秒数] [长度] - 合并模式：窗口内的短文本消息和评论合并为一条发送，长度默认 {MESSAGE_LENGTH_LIMIT}；off 关闭\n"
+                "/pause [规则名] - 暂停规则\n"
+                "/resume [规则名] - 恢复规则，从暂停前的位置继续转发\n"
+                "/backfill [规则名] [起始消息ID] - 补发该消息之后的历史消息，省略则补发全部\n"
+                "/export - 导出所有规则为 JSON 文件\n"
+                "/import - 随规则 JSON 文件发送或回复规则文件，批量导入规则（同名覆盖）\n"
+                "/stats - 查看延迟最高的规则的延迟、API 调用、队列和错误统计\n"
+                "/help - 显示此帮助信息\n\n"
+                "过滤条件用分号分隔，例如：keywords=招聘,兼职; exclude=广告; regex=^#新闻; "
+                "media=photo,video; senders=123,456; block_senders=789; min_length=10; "
+                "replace=旧文本=>新文本; strip_links=1"
             )
             await event.respond(help_text)
         return
@@ -569,21 +3666,34 @@ async def handle_user_message(event):
             await event.respond(response)
         elif state == BotState.WAITING_TARGET:
             response = await process_target_message(user_id, message)
+            apply_rule_changes()
             await event.respond(response)
 
 async def main():
-    # 加载规则和用户状态
+    # 加载检查点、补发进度、规则和用户状态
+    load_checkpoints()
+    load_backfill_jobs()
+    load_send_journal()
+    load_chat_info_cache()
     load_rules()
     load_user_states()
     
-    # 创建客户端
-    client = TelegramClient('session_name', API_ID, API_HASH)
+    global trace_recorder
+    if TRACE_FILE:
+        trace_recorder = TraceRecorder(TRACE_FILE)
+        logger.info(f"消息流轨迹记录到 {TRACE_FILE}")
     
-    # 注册消息处理器
-    @client.on(events.NewMessage)
+    # 创建客户端（管理账号）
+    client = TelegramClient(ADMIN_SESSION, API_ID, API_HASH)
+    
+    # 注册消息处理器：只处理白名单用户的私聊，其他聊天的消息在事件构造阶段就被丢弃
+    @client.on(events.NewMessage(func=lambda e: e.is_private and e.sender_id in ALLOWED_USERS))
     async def on_message(event):
         await handle_user_message(event)
     
+    # 频道信息变化时清除聊天信息缓存
+    client.add_event_handler(on_channel_update, events.Raw(UpdateChannel))
+    
     # 启动客户端
     await client.start()
     logger.info("机器人已启动")
@@ -593,11 +3703,40 @@ async def main():
         await client.sign_in(PHONE, code=None, password=PASSWORD)
         logger.info("已登录")
     
-    # 启动消息检查任务
+    # 转发账号池：与管理账号同名的会话直接复用管理账号的连接，其他账号首次运行时在控制台登录
+    for session_name in WORKER_SESSIONS:
+        # 追赶完停机期间的消息之前，该账号的源不开始拉取
+        catch_up_gates[session_name] = asyncio.Event()
+        if session_name == ADMIN_SESSION:
+            session_pool.add(session_name, client)
+            continue
+        worker_client = TelegramClient(session_name, API_ID, API_HASH)
+        worker_client.add_event_handler(on_channel_update, events.Raw(UpdateChannel))
+        await worker_client.start()
+        session_pool.add(session_name, worker_client)
+        logger.info(f"转发账号 {session_name} 已启动")
+    
+    # 启动各规则的转发流水线并注册源群组/频道的实时消息处理器
+    apply_rule_changes()
+    
+    # 取回停机期间错过的消息，之后开始实时处理；此后定期保存更新状态，断线重连时再次追赶
+    await asyncio.gather(*(catch_up(name, worker_client) for name, worker_client in session_pool.clients.items()))
+    for name, worker_client in session_pool.clients.items():
+        asyncio.create_task(update_state_loop(name, worker_client))
+    
+    # 启动兜底扫描、检查点提交任务和指标端点
     asyncio.create_task(check_new_messages(client))
+    asyncio.create_task(checkpoint_flush_loop())
+    await start_metrics_server()
     
-    # 保持客户端运行
-    await client.run_until_disconnected()
+    # 保持客户端运行，退出前提交所有检查点
+    try:
+        await client.run_until_disconnected()
+    finally:
+        flush_checkpoints()
+        for worker_client in session_pool.clients.values():
+            if worker_client is not client:
+                await worker_client.disconnect()
 
 if __name__ == "__main__":
     # 运行主函数